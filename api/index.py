@@ -6,7 +6,12 @@ server_path = os.path.join(os.path.dirname(__file__), '..', 'server')
 sys.path.insert(0, server_path)
 
 # Import and export the FastAPI app
+# Startup events are not guaranteed to run on Vercel, so the shared HTTP
+# session in utils.http_session is created lazily on the first request and
+# reused across warm invocations of this function. The Supabase, Stripe and
+# OpenAI clients are likewise built on first use, so importing the app (and
+# answering health checks) stays cheap on a cold start.
 from main import app
 
 # Export for Vercel
-app = app 
\ No newline at end of file
+app = app 
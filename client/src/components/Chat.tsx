@@ -1,7 +1,7 @@
 import { Box, Flex, Heading, Text, useToast, Input, Button, Icon, IconButton } from '@chakra-ui/react';
 import { ArrowRightIcon, ChevronLeftIcon } from '@chakra-ui/icons';
 import { useState, useCallback, useRef, useEffect } from 'react';
-import { chatService } from '../services/api';
+import { chatService, NEW_SESSION } from '../services/api';
 import MessageList from './MessageList';
 import { Message } from '../types/chat';
 
@@ -97,6 +97,8 @@ export default function Chat({ onBackClick }: ChatProps = {}) {
   const [isLoading, setIsLoading] = useState(false);
   const toast = useToast();
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  // Server-side conversation, so history isn't resent with every message
+  const sessionIdRef = useRef<string>();
 
   // Scroll to bottom function
   const scrollToBottom = useCallback(() => {
@@ -157,9 +159,12 @@ export default function Chat({ onBackClick }: ChatProps = {}) {
       // Send message and handle streaming response
       await chatService.sendMessageStream(
         trimmedInput,
-        (_, __, fullContent) => {
+        (_, __, fullContent, metadata) => {
+          if (metadata?.sessionId) sessionIdRef.current = metadata.sessionId;
           updateLastMessage(fullContent, false);
-        }
+        },
+        undefined,
+        sessionIdRef.current ?? NEW_SESSION
       );
     } catch (error) {
       console.error('Error sending message:', error);
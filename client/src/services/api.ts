@@ -4,24 +4,54 @@ import { StreamCallback } from '../types/chat';
 // Environment-aware API configuration
 const isDevelopment = import.meta.env.DEV;
 const API_URL = isDevelopment ? 'http://localhost:8000' : '/api';
-const WS_URL = isDevelopment ? 'ws://localhost:8000' : 
-    `${window.location.protocol === 'https:' ? 'wss:' : 'ws:'}//${window.location.host}/api`;
 
 interface ChatResponse {
     answer: string;
     context?: string;
+    session_id?: string;
+    source?: 'llm' | 'bank'; // 'bank' when answered from a stored question explanation
+    match_confidence?: number;
+    matched_id?: string;
 }
 
 interface ErrorResponse {
     detail: string;
 }
 
+export interface BatchChatItem {
+    message: string;
+    context?: string;
+    depth?: 'basic' | 'detailed';
+}
+
+export interface BatchChatResult {
+    index: number;
+    answer?: string;
+    error?: string;
+    source?: 'llm' | 'bank';
+    matched_id?: string;
+}
+
+// Streaming protocol v1: one start frame, delta frames, then end (or error)
+const STREAM_PROTOCOL_VERSION = 1;
+
+const toHex = (buffer: ArrayBuffer): string =>
+    Array.from(new Uint8Array(buffer), (byte) => byte.toString(16).padStart(2, '0')).join('');
+
 interface StreamMessage {
-    type: 'stream' | 'end' | 'error';
-    content: string;
-    full_content?: string;
+    type: 'start' | 'delta' | 'end' | 'error';
+    v?: number;
+    seq?: number;
+    content?: string;
+    frames?: number;
+    length?: number;
+    sha256?: string;
     metadata?: {
         ragContext?: string;
+        sessionId?: string;
+        source?: 'llm' | 'bank';
+        matchConfidence?: number;
+        matchedId?: string;
         toolCalls?: Array<{
             tool: string;
             input: string;
@@ -53,13 +83,18 @@ const handleAxiosError = (error: unknown): never => {
     throw new Error('An unexpected error occurred.');
 };
 
+// Send as the sessionId to start a conversation; without one the server keeps no history
+export const NEW_SESSION = 'new';
+
 export const chatService = {
-    // Non-streaming API call
-    async sendMessage(message: string, context?: string): Promise<ChatResponse> {
+    // Non-streaming API call. Pass NEW_SESSION to start a conversation, then
+    // the session_id from the previous response to continue it; the server
+    // keeps its history.
+    async sendMessage(message: string, context?: string, sessionId?: string): Promise<ChatResponse> {
         try {
             const response = await axios.post<ChatResponse>(
                 `${API_URL}/chat/with-context`,
-                { message, context },
+                { message, context, session_id: sessionId },
                 {
                     headers: getHeaders(),
                     timeout: 30000, // Increased timeout for serverless functions
@@ -72,62 +107,100 @@ export const chatService = {
         }
     },
 
-    // WebSocket streaming implementation
-    // Note: WebSocket functionality may be limited on Vercel serverless functions
-    // Consider implementing Server-Sent Events (SSE) as an alternative
-    async sendMessageStream(message: string, onStream: StreamCallback, context?: string): Promise<void> {
-        // For production deployment, fall back to non-streaming if WebSocket fails
-        if (!isDevelopment) {
-            console.warn('WebSocket streaming may not work on Vercel. Using fallback to regular API call.');
-            try {
-                const response = await this.sendMessage(message, context);
-                onStream(response.answer, true, response.answer);
-                return;
-            } catch (error) {
-                throw error;
-            }
+    // Answer many messages in one request; results come back in item order,
+    // each with either an answer or its own error
+    async sendBatch(items: BatchChatItem[], context?: string): Promise<BatchChatResult[]> {
+        try {
+            const response = await axios.post<{ results: BatchChatResult[] }>(
+                `${API_URL}/chat/batch`,
+                { items, context },
+                {
+                    headers: getHeaders(),
+                    timeout: 60000,
+                }
+            );
+
+            return response.data.results;
+        } catch (error) {
+            return handleAxiosError(error);
         }
+    },
 
-        return new Promise((resolve, reject) => {
-            const ws = new WebSocket(`${WS_URL}/ws/chat`);
-            
-            ws.onopen = () => {
-                ws.send(JSON.stringify({ message, context }));
-            };
-
-            ws.onmessage = (event) => {
-                try {
-                    const data: StreamMessage = JSON.parse(event.data);
-                    
-                    switch (data.type) {
-                        case 'stream':
-                            onStream(data.content, false, data.full_content || '', data.metadata);
-                            break;
-                        case 'end':
-                            onStream(data.content, true, data.content, data.metadata);
-                            ws.close();
-                            resolve();
-                            break;
-                        case 'error':
-                            reject(new Error(data.content));
-                            ws.close();
-                            break;
+    // Server-Sent Events streaming implementation
+    // Works on Vercel serverless functions as well as local uvicorn
+    // The start frame's metadata carries the sessionId to send with the next message
+    async sendMessageStream(message: string, onStream: StreamCallback, context?: string, sessionId?: string): Promise<void> {
+        let response: Response;
+        try {
+            response = await fetch(`${API_URL}/chat/stream`, {
+                method: 'POST',
+                headers: { ...getHeaders(), 'Accept': 'text/event-stream' },
+                body: JSON.stringify({ message, context, session_id: sessionId }),
+            });
+        } catch {
+            throw new Error('Connection failed. Please check if the server is running.');
+        }
+
+        if (!response.ok || !response.body) {
+            const errorData = await response.json().catch(() => null) as ErrorResponse | null;
+            throw new Error(errorData?.detail || `Server error: ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        const encoder = new TextEncoder();
+        let buffer = '';
+        let fullContent = '';
+        let metadata: StreamMessage['metadata'];
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop() || '';
+
+            for (const event of events) {
+                if (!event.startsWith('data: ')) continue;
+                const data: StreamMessage = JSON.parse(event.slice(6));
+
+                switch (data.type) {
+                    case 'start':
+                        if (data.v !== STREAM_PROTOCOL_VERSION) {
+                            throw new Error(`Unsupported stream protocol version: ${data.v}`);
+                        }
+                        metadata = data.metadata;
+                        break;
+                    case 'delta': {
+                        const chunk = data.content ?? '';
+                        fullContent += chunk;
+                        onStream(chunk, false, fullContent, metadata);
+                        break;
                     }
-                } catch (error) {
-                    reject(error);
-                    ws.close();
+                    case 'end': {
+                        // The length and sha256 cover the UTF-8 bytes of the full answer
+                        const bytes = encoder.encode(fullContent);
+                        if (data.length !== undefined && bytes.length !== data.length) {
+                            throw new Error('Stream was not reassembled correctly');
+                        }
+                        // crypto.subtle only exists in secure contexts (https, localhost)
+                        if (data.sha256 !== undefined && globalThis.crypto?.subtle) {
+                            const digest = toHex(await crypto.subtle.digest('SHA-256', bytes));
+                            if (digest !== data.sha256) {
+                                throw new Error('Stream was not reassembled correctly');
+                            }
+                        }
+                        onStream('', true, fullContent, metadata);
+                        return;
+                    }
+                    case 'error':
+                        throw new Error(data.content || 'Streaming failed');
                 }
-            };
-
-            ws.onerror = () => {
-                reject(new Error('WebSocket connection error'));
-            };
-
-            ws.onclose = () => {
-                // If we didn't resolve yet, this was an unexpected close
-                // This redundant resolve is safe and prevents potential hangs
-                resolve();
-            };
-        });
+            }
+        }
+
+        // Closed without an end frame: the answer is truncated
+        throw new Error('Stream ended before the answer was complete');
     }
 }; 
\ No newline at end of file
@@ -6,6 +6,10 @@ export interface Message {
     isThinking?: boolean;
     metadata?: {
         ragContext?: string;
+        sessionId?: string;
+        source?: 'llm' | 'bank';
+        matchConfidence?: number;
+        matchedId?: string;
         toolCalls?: Array<{
             tool: string;
             input: string;
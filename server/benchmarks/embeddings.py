@@ -0,0 +1,184 @@
+"""
+Compare embedding backends on latency, memory and retrieval agreement.
+
+Each backend runs in its own interpreter so peak RSS is measured in
+isolation. Queries are the question texts from the question bank plus a few
+free-form questions; every query is searched against the existing
+data/ukcat_embeddings FAISS index, and the top-k results of each backend are
+compared with the first (reference) backend.
+
+Usage (from the server directory):
+    python benchmarks/embeddings.py
+    python benchmarks/embeddings.py --backends torch onnx --k 3 --json embeddings.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+INDEX_PATH = os.path.join(SERVER_DIR, "data", "ukcat_embeddings", "index.faiss")
+EXTRA_QUERIES = [
+    "How do I calculate percentage change?",
+    "What does 'Can't tell' mean in verbal reasoning?",
+    "How should I split my time in quantitative reasoning?",
+    "Explain how to work out average speed",
+    "Tips for true/false/can't tell questions",
+]
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def load_queries():
+    from utils.question_bank import question_bank
+
+    texts = [q["question_text"] for q in question_bank.snapshot.questions.values() if q.get("question_text")]
+    return texts + EXTRA_QUERIES
+
+def run_worker(backend: str, k: int, repeat: int, output: str):
+    """Runs in a child process: load one backend and record everything the parent compares"""
+    import faiss
+    import numpy as np
+    from utils.embeddings import EMBEDDING_MODEL, CachedEmbeddings, OnnxEmbeddings
+
+    queries = load_queries()
+    baseline_rss = _peak_rss_mb()
+
+    started = time.perf_counter()
+    if backend == "onnx":
+        embeddings = OnnxEmbeddings()
+    else:
+        from langchain.embeddings import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    embeddings.embed_query("warmup")
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            started = time.perf_counter()
+            embeddings.embed_query(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents(queries), dtype=np.float32)
+    batch_ms = (time.perf_counter() - started) * 1000
+
+    cached = CachedEmbeddings(embeddings)
+    cached.embed_documents(queries)
+    started = time.perf_counter()
+    cached.embed_documents(queries)
+    cached_ms = (time.perf_counter() - started) * 1000
+
+    index = faiss.read_index(INDEX_PATH)
+    _, ids = index.search(vectors, min(k, index.ntotal))
+
+    with open(output, "w") as f:
+        json.dump({
+            "backend": backend,
+            "load_ms": load_ms,
+            "latencies_ms": latencies,
+            "batch_ms": batch_ms,
+            "cached_batch_ms": cached_ms,
+            "rss_mb": _peak_rss_mb() - baseline_rss,
+            "peak_rss_mb": _peak_rss_mb(),
+            "vectors": vectors.tolist(),
+            "top_k": ids.tolist(),
+        }, f)
+
+def run_backend(backend: str, k: int, repeat: int) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+        output = tmp.name
+    try:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", backend,
+             "--k", str(k), "--repeat", str(repeat), "--output", output],
+            cwd=SERVER_DIR,
+            check=True,
+        )
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+
+def compare(reference: dict, candidate: dict) -> dict:
+    import numpy as np
+
+    a = np.asarray(reference["vectors"])
+    b = np.asarray(candidate["vectors"])
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    overlaps = [
+        len(set(x) & set(y)) / len(x)
+        for x, y in zip(reference["top_k"], candidate["top_k"]) if x
+    ]
+    top1 = [x[0] == y[0] for x, y in zip(reference["top_k"], candidate["top_k"]) if x]
+    return {
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "top_k_overlap": statistics.mean(overlaps) if overlaps else 0.0,
+        "top_1_agreement": sum(top1) / len(top1) if top1 else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="*", default=["torch", "onnx"], help="the first one is the reference")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the query set for latency")
+    parser.add_argument("--json", help="write the summary to this file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.k, args.repeat, args.output)
+        return
+
+    results = {backend: run_backend(backend, args.k, args.repeat) for backend in args.backends}
+    reference = results[args.backends[0]]
+
+    summary = {}
+    print(f"{'backend':<8} {'load':>9} {'p50':>8} {'p95':>8} {'batch':>9} {'cached':>8} {'rss':>8}  agreement vs {args.backends[0]}")
+    for backend, result in results.items():
+        latencies = result["latencies_ms"]
+        row = {
+            "load_ms": result["load_ms"],
+            "p50_ms": statistics.median(latencies),
+            "p95_ms": _percentile(latencies, 95),
+            "batch_ms": result["batch_ms"],
+            "cached_batch_ms": result["cached_batch_ms"],
+            "rss_mb": result["rss_mb"],
+            "peak_rss_mb": result["peak_rss_mb"],
+        }
+        if result is not reference:
+            row["agreement"] = compare(reference, result)
+        summary[backend] = row
+
+        agreement = row.get("agreement")
+        agreement_text = (
+            f"cos mean {agreement['mean_cosine']:.4f} min {agreement['min_cosine']:.4f}, "
+            f"top-{args.k} overlap {agreement['top_k_overlap']:.2%}, top-1 {agreement['top_1_agreement']:.2%}"
+            if agreement else "reference"
+        )
+        print(
+            f"{backend:<8} {row['load_ms']:7.0f}ms {row['p50_ms']:6.2f}ms {row['p95_ms']:6.2f}ms "
+            f"{row['batch_ms']:7.1f}ms {row['cached_batch_ms']:6.2f}ms {row['rss_mb']:6.0f}MB  {agreement_text}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compare two load-test result files written by benchmarks/loadtest/run.py.
+
+Prints throughput and latency percentiles side by side for every scenario
+and concurrency level present in both files. A run regresses when a
+latency percentile or the error rate rises, or throughput falls, by more
+than --threshold percent. The exit status is 1 if anything regressed, so
+this can gate CI.
+
+Usage (from the server directory):
+    python benchmarks/loadtest/compare.py baseline.json candidate.json
+    python benchmarks/loadtest/compare.py baseline.json candidate.json --threshold 5 --metrics p95 p99
+"""
+import sys
+import json
+import argparse
+
+LATENCY_METRICS = ("p50", "p95", "p99", "mean", "max")
+
+def load(path: str):
+    with open(path) as f:
+        data = json.load(f)
+    rows = {}
+    for scenario, runs in data["results"].items():
+        for run in runs:
+            rows[(scenario, run["concurrency"])] = run
+    return data.get("meta", {}), rows
+
+def _change(before: float, after: float) -> float:
+    if before == 0:
+        return 0.0 if after == 0 else float("inf")
+    return (after - before) / before * 100
+
+def _describe(meta) -> str:
+    commit = meta.get("commit") or "unknown"
+    return f"{commit}{' (dirty)' if meta.get('dirty') else ''} at {meta.get('timestamp', '?')}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    parser.add_argument("--metrics", nargs="*", default=["p50", "p95", "p99"], choices=LATENCY_METRICS)
+    args = parser.parse_args()
+
+    baseline_meta, baseline = load(args.baseline)
+    candidate_meta, candidate = load(args.candidate)
+    print(f"baseline:  {_describe(baseline_meta)}")
+    print(f"candidate: {_describe(candidate_meta)}")
+
+    header = f"{'scenario':<18} {'c':>4} {'req/s':>17}"
+    for metric in args.metrics:
+        header += f" {metric + ' ms':>22}"
+    print(header + "  errors")
+
+    regressions = []
+    for key in sorted(set(baseline) & set(candidate)):
+        before, after = baseline[key], candidate[key]
+        scenario, concurrency = key
+
+        throughput = _change(before["throughput_rps"], after["throughput_rps"])
+        line = f"{scenario:<18} {concurrency:>4} {after['throughput_rps']:8.1f} ({throughput:+6.1f}%)"
+        if throughput < -args.threshold:
+            regressions.append(f"{scenario} c={concurrency}: throughput {throughput:+.1f}%")
+
+        for metric in args.metrics:
+            change = _change(before["latency_ms"][metric], after["latency_ms"][metric])
+            line += f" {after['latency_ms'][metric]:10.1f} ({change:+7.1f}%)"
+            if change > args.threshold:
+                regressions.append(f"{scenario} c={concurrency}: {metric} {change:+.1f}%")
+
+        line += f"  {before['error_rate']:.1%} -> {after['error_rate']:.1%}"
+        if after["error_rate"] > before["error_rate"] + args.threshold / 100:
+            regressions.append(f"{scenario} c={concurrency}: error rate {before['error_rate']:.1%} -> {after['error_rate']:.1%}")
+        print(line)
+
+    missing = sorted(set(baseline) ^ set(candidate))
+    if missing:
+        print("Only in one file: " + ", ".join(f"{scenario} c={concurrency}" for scenario, concurrency in missing))
+
+    if regressions:
+        print(f"\nRegressions beyond {args.threshold:g}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print(f"\nNo regressions beyond {args.threshold:g}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Local stand-ins for OpenAI, Supabase and Stripe, for offline load tests.
+
+Serves three aiohttp apps on consecutive ports starting at --port:
+
+  port      OpenAI chat completions (POST /v1/chat/completions), with
+            configurable latency, token pacing, answer length and error rate,
+            streamed or not, and embeddings (POST /v1/embeddings)
+  port + 1  Supabase auth (/auth/v1/user, JWKS) and the profiles REST table;
+            a profile is created on first read for any user id
+  port + 2  Stripe customers (honouring Idempotency-Key, searchable by
+            metadata user_id), prices by lookup
+            key, checkout sessions, billing portal sessions and subscriptions
+
+Point the API at them with OPENAI_API_BASE, SUPABASE_URL and STRIPE_API_BASE.
+benchmarks/loadtest/run.py starts this automatically.
+
+Usage (from the server directory):
+    python benchmarks/loadtest/fake_services.py
+    python benchmarks/loadtest/fake_services.py --port 9100 --openai-latency-ms 800 --token-interval-ms 30
+"""
+import json
+import time
+import zlib
+import uuid
+import random
+import asyncio
+import argparse
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+EMBEDDING_DIMENSIONS = 256
+
+ANSWER_WORDS = (
+    "To solve this, first identify the quantities given in the question, then set up the "
+    "ratio and check each option against it. Eliminating the answers that break the ratio "
+    "leaves a single option, which is the correct one."
+).split()
+
+class FakeOpenAI:
+    def __init__(self, latency_ms: float, token_interval_ms: float, answer_tokens: int, error_rate: float):
+        self.latency = latency_ms / 1000
+        self.token_interval = token_interval_ms / 1000
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+
+    def _answer_tokens(self):
+        return [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(self.answer_tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.latency)
+            return web.json_response({"error": {"message": "Injected failure", "type": "server_error"}}, status=500)
+
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        tokens = self._answer_tokens()
+        created = int(time.time())
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.latency + self.token_interval * len(tokens))
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        await asyncio.sleep(self.latency)
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(self.token_interval)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = {"id": completion_id, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        """Hashed bag-of-words vectors, so rewordings of a question land close together"""
+        body = await request.json()
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs or []
+        await asyncio.sleep(self.latency / 4)
+        data = []
+        for index, text in enumerate(inputs):
+            vector = [0.0] * EMBEDDING_DIMENSIONS
+            for word in str(text).lower().split():
+                vector[zlib.crc32(word.strip("?!.,").encode()) % EMBEDDING_DIMENSIONS] += 1.0
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        return web.json_response({"object": "list", "data": data, "model": body.get("model")})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        return app
+
+class FakeSupabase:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.profiles = {}
+
+    def _profile(self, user_id: str) -> dict:
+        if user_id not in self.profiles:
+            self.profiles[user_id] = {
+                "id": user_id,
+                "email": f"{user_id}@loadtest.local",
+                "full_name": "Load Test",
+                "subscription_status": "free",
+                "stripe_customer_id": None,
+            }
+        return self.profiles[user_id]
+
+    @staticmethod
+    def _id_filter(request: web.Request) -> str:
+        value = request.query.get("id", "")
+        return value[3:] if value.startswith("eq.") else value
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        # Tokens are not checked: the API verifies them locally before ever calling this
+        from jose import jwt
+
+        await asyncio.sleep(self.latency)
+        token = request.headers.get("Authorization", "")[len("Bearer "):]
+        claims = jwt.get_unverified_claims(token)
+        return web.json_response({
+            "id": claims["sub"],
+            "aud": "authenticated",
+            "role": "authenticated",
+            "email": claims.get("email"),
+            "app_metadata": {},
+            "user_metadata": {},
+            "created_at": "2024-01-01T00:00:00Z",
+        })
+
+    async def jwks(self, request: web.Request) -> web.Response:
+        return web.json_response({"keys": []})
+
+    async def select_profiles(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        return web.json_response([self._profile(self._id_filter(request))])
+
+    async def insert_profiles(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        rows = await request.json()
+        rows = rows if isinstance(rows, list) else [rows]
+        for row in rows:
+            self.profiles[row["id"]] = {**self._profile(row["id"]), **row}
+        return web.json_response([self.profiles[row["id"]] for row in rows], status=201)
+
+    async def update_profiles(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        profile = self._profile(self._id_filter(request))
+        profile.update(await request.json())
+        return web.json_response([profile])
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/auth/v1/user", self.get_user)
+        app.router.add_get("/auth/v1/.well-known/jwks.json", self.jwks)
+        app.router.add_get("/rest/v1/profiles", self.select_profiles)
+        app.router.add_post("/rest/v1/profiles", self.insert_profiles)
+        app.router.add_patch("/rest/v1/profiles", self.update_profiles)
+        return app
+
+class FakeStripe:
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.idempotent = {}  # Idempotency-Key -> customer, as Stripe replays them
+        self.customers = []
+
+    @staticmethod
+    async def _form(request: web.Request) -> dict:
+        return dict(parse_qsl(await request.text()))
+
+    async def create_customer(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        form = await self._form(request)
+        key = request.headers.get("Idempotency-Key")
+        if key not in self.idempotent:
+            customer = {
+                "id": f"cus_{uuid.uuid4().hex[:14]}",
+                "object": "customer",
+                "email": form.get("email"),
+                "metadata": {name[len("metadata["):-1]: value for name, value in form.items() if name.startswith("metadata[")},
+            }
+            self.customers.append(customer)
+            if not key:
+                return web.json_response(customer)
+            self.idempotent[key] = customer
+        return web.json_response(self.idempotent[key])
+
+    async def search_customers(self, request: web.Request) -> web.Response:
+        """Only the metadata['user_id']:'...' queries the API sends"""
+        await asyncio.sleep(self.latency)
+        user_id = request.query.get("query", "").partition(":")[2].strip("'")
+        found = [customer for customer in self.customers if customer["metadata"].get("user_id") == user_id][:1]
+        return web.json_response({"object": "search_result", "data": found, "has_more": False, "url": "/v1/customers/search"})
+
+    async def create_checkout_session(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        return web.json_response({
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.loadtest.local/pay/{session_id}",
+        })
+
+    async def create_portal_session(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        session_id = f"bps_{uuid.uuid4().hex[:14]}"
+        return web.json_response({
+            "id": session_id,
+            "object": "billing_portal.session",
+            "url": f"https://billing.loadtest.local/session/{session_id}",
+        })
+
+    async def list_prices(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        lookup_keys = [value for key, value in request.query.items() if key.startswith("lookup_keys")]
+        prices = [{"id": f"price_{key}", "object": "price", "lookup_key": key, "active": True} for key in lookup_keys]
+        return web.json_response({"object": "list", "data": prices, "has_more": False, "url": "/v1/prices"})
+
+    async def list_subscriptions(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        return web.json_response({"object": "list", "data": [], "has_more": False, "url": "/v1/subscriptions"})
+
+    async def retrieve_subscription(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        return web.json_response({
+            "id": request.match_info["subscription_id"],
+            "object": "subscription",
+            "status": "active",
+            "customer": "cus_loadtest",
+            "metadata": {},
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/customers", self.create_customer)
+        app.router.add_get("/v1/customers/search", self.search_customers)
+        app.router.add_post("/v1/checkout/sessions", self.create_checkout_session)
+        app.router.add_post("/v1/billing_portal/sessions", self.create_portal_session)
+        app.router.add_get("/v1/prices", self.list_prices)
+        app.router.add_get("/v1/subscriptions", self.list_subscriptions)
+        app.router.add_get("/v1/subscriptions/{subscription_id}", self.retrieve_subscription)
+        return app
+
+async def serve(args):
+    apps = [
+        ("OpenAI", FakeOpenAI(args.openai_latency_ms, args.token_interval_ms, args.answer_tokens, args.error_rate).app()),
+        ("Supabase", FakeSupabase(args.supabase_latency_ms).app()),
+        ("Stripe", FakeStripe(args.stripe_latency_ms).app()),
+    ]
+    runners = []
+    for offset, (name, app) in enumerate(apps):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, args.host, args.port + offset).start()
+        runners.append(runner)
+        print(f"Fake {name} listening on http://{args.host}:{args.port + offset}", flush=True)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100, help="first of three consecutive ports")
+    parser.add_argument("--openai-latency-ms", type=float, default=300, help="time to first token")
+    parser.add_argument("--token-interval-ms", type=float, default=10, help="delay between completion tokens")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of completions that return 500")
+    parser.add_argument("--supabase-latency-ms", type=float, default=20)
+    parser.add_argument("--stripe-latency-ms", type=float, default=150)
+    return parser
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(build_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
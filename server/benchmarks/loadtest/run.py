@@ -0,0 +1,360 @@
+"""
+Load test the API against local stand-ins for OpenAI, Supabase and Stripe.
+
+Starts benchmarks/loadtest/fake_services.py and a uvicorn server wired to it,
+then drives each scenario with a fixed number of concurrent clients and
+reports throughput and latency percentiles. Results are written as JSON,
+tagged with the git commit, for benchmarks/loadtest/compare.py.
+
+Scenarios:
+    chat               POST /api/chat, anonymous
+    chat_with_context  POST /api/chat/with-context, authenticated, with context
+    chat_stream        POST /api/chat/stream, read to the end of the stream
+    profile            GET /api/profile
+    checkout           POST /api/create-checkout-session
+    webhook            POST /api/stripe-webhook, signed subscription updates
+
+Chat messages are unique per request, so the response cache and request
+coalescing stay out of the numbers unless --repeat-messages is given.
+Admission control is off unless --admission is given, so rate limits do not
+dominate the results.
+
+Usage (from the server directory):
+    python benchmarks/loadtest/run.py
+    python benchmarks/loadtest/run.py --scenarios chat profile --concurrency 1 10 50 --requests 500
+    python benchmarks/loadtest/run.py --openai-latency-ms 800 --json results/baseline.json
+    python benchmarks/loadtest/run.py --target http://127.0.0.1:8000 --jwt-secret $SUPABASE_JWT_SECRET
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import socket
+import asyncio
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import aiohttp
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FAKE_SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_services.py")
+
+SCENARIOS = ("chat", "chat_with_context", "chat_stream", "profile", "checkout", "webhook")
+DEFAULT_SCENARIOS = ("chat", "chat_with_context", "profile", "checkout", "webhook")
+
+JWT_SECRET = "loadtest-jwt-secret"
+WEBHOOK_SECRET = "whsec_loadtest"
+PRICE_ID = "price_loadtest_premium"
+
+QUESTIONS = [
+    "How do I approach ratio questions in quantitative reasoning?",
+    "What is the fastest way to eliminate options in verbal reasoning?",
+    "Explain how to read a two-way table quickly",
+    "How should I manage time in the decision making section?",
+    "What does 'cannot say' mean in verbal reasoning?",
+]
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def _git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=SERVER_DIR, capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+def make_token(user_id: str, secret: str, role: str = "authenticated") -> str:
+    from jose import jwt
+
+    now = int(time.time())
+    return jwt.encode(
+        {"sub": user_id, "email": f"{user_id}@loadtest.local", "aud": "authenticated", "role": role, "iat": now, "exp": now + 3600},
+        secret,
+        algorithm="HS256",
+    )
+
+def sign_webhook(payload: bytes, secret: str) -> str:
+    """Stripe-Signature header for a payload, as Stripe would send it"""
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+class Scenarios:
+    """Builds the request for each scenario; i is the request number"""
+
+    def __init__(self, users, tokens, repeat_messages: bool, webhook_secret: str):
+        self.users = users
+        self.tokens = tokens
+        self.repeat_messages = repeat_messages
+        self.webhook_secret = webhook_secret
+
+    def _message(self, i: int) -> str:
+        question = QUESTIONS[i % len(QUESTIONS)]
+        return question if self.repeat_messages else f"{question} (request {i} {uuid.uuid4().hex[:8]})"
+
+    def _auth(self, i: int) -> dict:
+        return {"Authorization": f"Bearer {self.tokens[i % len(self.tokens)]}"}
+
+    def chat(self, i):
+        return "POST", "/api/chat", {}, {"message": self._message(i)}
+
+    def chat_with_context(self, i):
+        context = "The student is revising quantitative reasoning and has 20 minutes left."
+        return "POST", "/api/chat/with-context", self._auth(i), {"message": self._message(i), "context": context}
+
+    def chat_stream(self, i):
+        return "POST", "/api/chat/stream", self._auth(i), {"message": self._message(i)}
+
+    def profile(self, i):
+        return "GET", "/api/profile", self._auth(i), None
+
+    def checkout(self, i):
+        body = {"plan": "premium", "success_url": "https://loadtest.local/success", "cancel_url": "https://loadtest.local/cancel"}
+        return "POST", "/api/create-checkout-session", self._auth(i), body
+
+    def webhook(self, i):
+        user_id = self.users[i % len(self.users)]
+        event = {
+            "id": f"evt_{uuid.uuid4().hex[:24]}",
+            "object": "event",
+            "type": "customer.subscription.updated",
+            "created": int(time.time()),
+            "data": {"object": {
+                "id": f"sub_{user_id[:12]}",
+                "object": "subscription",
+                "customer": f"cus_{user_id[:12]}",
+                "status": "active" if i % 2 == 0 else "past_due",
+                "metadata": {"user_id": user_id},
+            }},
+        }
+        payload = json.dumps(event).encode()
+        headers = {"Stripe-Signature": sign_webhook(payload, self.webhook_secret), "Content-Type": "application/json"}
+        return "POST", "/api/stripe-webhook", headers, payload
+
+async def _send(session: aiohttp.ClientSession, base_url: str, request):
+    method, path, headers, body = request
+    kwargs = {"headers": headers}
+    if isinstance(body, bytes):
+        kwargs["data"] = body
+    elif body is not None:
+        kwargs["json"] = body
+
+    started = time.perf_counter()
+    try:
+        async with session.request(method, base_url + path, **kwargs) as response:
+            await response.read()  # Includes the whole stream for streaming endpoints
+            status = response.status
+    except Exception as e:
+        status = type(e).__name__
+    return time.perf_counter() - started, status
+
+async def run_scenario(base_url: str, build, concurrency: int, requests: int, warmup: int):
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=120)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for i in range(warmup):
+            await _send(session, base_url, build(i))
+
+        counter = iter(range(warmup, warmup + requests))
+        latencies, statuses = [], {}
+
+        async def client():
+            for i in counter:
+                elapsed, status = await _send(session, base_url, build(i))
+                latencies.append(elapsed * 1000)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "statuses": statuses,
+        "duration_s": duration,
+        "throughput_rps": len(latencies) / duration if duration else 0.0,
+        "latency_ms": {
+            "mean": statistics.mean(latencies),
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": max(latencies),
+        },
+    }
+
+def _wait_for(url: str, process: subprocess.Popen, timeout: float = 60):
+    import urllib.request
+    import urllib.error
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[1]} exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except urllib.error.HTTPError:
+            return  # Listening, even if this path isn't served
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+def start_services(args):
+    """Start the fakes and the API; returns (base_url, processes)"""
+    fake_port = args.fake_port or _free_port()
+    fakes = subprocess.Popen(
+        [
+            sys.executable, FAKE_SERVICES,
+            "--port", str(fake_port),
+            "--openai-latency-ms", str(args.openai_latency_ms),
+            "--token-interval-ms", str(args.token_interval_ms),
+            "--answer-tokens", str(args.answer_tokens),
+            "--error-rate", str(args.error_rate),
+            "--supabase-latency-ms", str(args.supabase_latency_ms),
+            "--stripe-latency-ms", str(args.stripe_latency_ms),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    processes = [fakes]
+    try:
+        for offset in range(3):
+            _wait_for(f"http://127.0.0.1:{fake_port + offset}/", fakes)
+
+        api_port = args.api_port or _free_port()
+        env = {
+            **os.environ,
+            "OPENAI_API_KEY": "sk-loadtest",
+            "OPENAI_API_BASE": f"http://127.0.0.1:{fake_port}/v1",
+            "SUPABASE_URL": f"http://127.0.0.1:{fake_port + 1}",
+            "SUPABASE_SERVICE_ROLE_KEY": make_token("service-role", JWT_SECRET, role="service_role"),
+            "SUPABASE_JWT_SECRET": JWT_SECRET,
+            "STRIPE_SECRET_KEY": "sk_test_loadtest",
+            "STRIPE_API_BASE": f"http://127.0.0.1:{fake_port + 2}",
+            "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+            "STRIPE_PREMIUM_PRICE_ID": PRICE_ID,
+            "ADMISSION_ENABLED": "true" if args.admission else "false",
+            "WARMUP_ON_STARTUP": "false",
+        }
+        for assignment in args.env:
+            key, _, value = assignment.partition("=")
+            env[key] = value
+
+        log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+        api = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1", "--port", str(api_port),
+                "--workers", str(args.workers), "--log-level", "warning", "--no-access-log",
+            ],
+            cwd=SERVER_DIR,
+            env=env,
+            stdout=log,
+            stderr=log,
+        )
+        processes.append(api)
+        base_url = f"http://127.0.0.1:{api_port}"
+        _wait_for(f"{base_url}/api/health", api)
+        return base_url, processes
+    except Exception:
+        stop_services(processes)
+        raise
+
+def stop_services(processes):
+    for process in reversed(processes):
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="*", default=list(DEFAULT_SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--concurrency", nargs="*", type=int, default=[10], help="one run per level")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario and level")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests before each run")
+    parser.add_argument("--users", type=int, default=50, help="distinct authenticated users")
+    parser.add_argument("--repeat-messages", action="store_true", help="reuse a few chat messages so caches can hit")
+    parser.add_argument("--admission", action="store_true", help="keep admission control (rate limits) on")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--server-log", help="write the API's output here (default: discarded)")
+    parser.add_argument("--target", help="drive an already running API instead of starting one")
+    parser.add_argument("--jwt-secret", default=JWT_SECRET, help="with --target: the server's SUPABASE_JWT_SECRET")
+    parser.add_argument("--webhook-secret", default=WEBHOOK_SECRET, help="with --target: the server's STRIPE_WEBHOOK_SECRET")
+    parser.add_argument("--fake-port", type=int, help="first port for the fake services (default: free ports)")
+    parser.add_argument("--api-port", type=int)
+    parser.add_argument("--openai-latency-ms", type=float, default=300)
+    parser.add_argument("--token-interval-ms", type=float, default=10)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--supabase-latency-ms", type=float, default=20)
+    parser.add_argument("--stripe-latency-ms", type=float, default=150)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    users = [str(uuid.UUID(int=i + 1)) for i in range(args.users)]
+    tokens = [make_token(user_id, args.jwt_secret) for user_id in users]
+    scenarios = Scenarios(users, tokens, args.repeat_messages, args.webhook_secret)
+
+    processes = []
+    if args.target:
+        base_url = args.target.rstrip("/")
+    else:
+        base_url, processes = start_services(args)
+
+    results = {}
+    try:
+        for name in args.scenarios:
+            results[name] = []
+            for concurrency in args.concurrency:
+                row = asyncio.run(run_scenario(base_url, getattr(scenarios, name), concurrency, args.requests, args.warmup))
+                results[name].append(row)
+                latency = row["latency_ms"]
+                print(
+                    f"{name:<18} c={concurrency:<4} {row['throughput_rps']:8.1f} req/s  "
+                    f"p50 {latency['p50']:8.1f}ms  p95 {latency['p95']:8.1f}ms  p99 {latency['p99']:8.1f}ms  "
+                    f"errors {row['errors']}/{row['requests']}",
+                    flush=True,
+                )
+    finally:
+        stop_services(processes)
+
+    if args.json:
+        output = {
+            "meta": {
+                **_git_revision(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "target": args.target,
+                "config": {key: value for key, value in vars(args).items() if key not in ("json", "jwt_secret", "webhook_secret")},
+            },
+            "results": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
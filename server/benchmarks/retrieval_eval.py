@@ -0,0 +1,123 @@
+"""
+Evaluate retrieval quality and latency in lexical, dense and hybrid modes.
+
+Runs against the versioned index from scripts/build_index.py, whose document
+ids ("question:qr_1", "passage:vr_inf_1", "explanation:qr_1:basic") the
+relevance labels refer to. A label matches a document id exactly or as a
+prefix ("explanation:qr_1" matches both explanation levels).
+
+The query set is the hand-written benchmarks/retrieval_queries.json plus
+queries generated from the question bank: every question id, the opening
+words of every question and a sentence from every passage.
+
+Usage (from the server directory):
+    python benchmarks/retrieval_eval.py
+    python benchmarks/retrieval_eval.py --k 5 --modes hybrid dense --json retrieval.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from utils.embeddings import create_embeddings
+from utils.index_store import load_index_store
+from utils.question_bank import question_bank
+from utils.retrieval import RETRIEVAL_MODES, RetrievalEngine
+
+QUERIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "retrieval_queries.json")
+
+def generated_queries():
+    snapshot = question_bank.snapshot
+    queries = []
+    for question in snapshot.questions.values():
+        queries.append({"query": question["id"], "relevant": [f"question:{question['id']}"]})
+        words = (question["question_text"] or "").split()
+        if words:
+            queries.append({"query": " ".join(words[:12]), "relevant": [f"question:{question['id']}"]})
+    for passage in snapshot.passages.values():
+        sentences = [s for s in re.split(r"(?<=[.!?])\s+", passage["passage_text"] or "") if len(s.split()) >= 6]
+        if sentences:
+            queries.append({"query": sentences[len(sentences) // 2], "relevant": [f"passage:{passage['id']}"]})
+    return queries
+
+def _matches(doc_id: str, label: str) -> bool:
+    return doc_id == label or doc_id.startswith(label + ":")
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def evaluate(engine: RetrievalEngine, queries, mode: str, k: int, repeat: int):
+    recalls, reciprocal_ranks, latencies, modes = [], [], [], []
+    for item in queries:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = await engine.retrieve(item["query"], k=k, mode=mode)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        retrieved = [doc.metadata["doc_id"] for doc in result.documents]
+        relevant = item["relevant"]
+        found = [label for label in relevant if any(_matches(doc_id, label) for doc_id in retrieved)]
+        recalls.append(len(found) / len(relevant))
+        first = next((rank for rank, doc_id in enumerate(retrieved, 1) if any(_matches(doc_id, l) for l in relevant)), None)
+        reciprocal_ranks.append(1 / first if first else 0.0)
+        modes.append(result.mode)
+
+    return {
+        f"recall@{k}": statistics.mean(recalls),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": _percentile(latencies, 95),
+        "fast_path_rate": modes.count("lexical_fast_path") / len(modes),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="*", default=["lexical", "dense", "hybrid"], choices=RETRIEVAL_MODES)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per query")
+    parser.add_argument("--queries", default=QUERIES_FILE, help="hand-written labelled queries")
+    parser.add_argument("--no-generated", action="store_true", help="only use the hand-written queries")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    store = load_index_store()
+    if store is None:
+        sys.exit("No versioned index found. Run python scripts/build_index.py first.")
+
+    with open(args.queries) as f:
+        queries = json.load(f)
+    if not args.no_generated:
+        queries += generated_queries()
+
+    # No batching window, so dense latency reflects the embedding and search cost
+    engine = RetrievalEngine(create_embeddings(cache=False), store, batch_window_ms=0)
+
+    async def run():
+        await engine.retrieve("warmup", k=args.k, mode="dense")
+        return {mode: await evaluate(engine, queries, mode, args.k, args.repeat) for mode in args.modes}
+
+    results = asyncio.run(run())
+
+    print(f"{len(queries)} queries against index {store.version} ({store.index.ntotal} documents)")
+    print(f"{'mode':<8} {'recall@' + str(args.k):>9} {'mrr':>6} {'p50':>9} {'p95':>9} {'fast path':>10}")
+    for mode, row in results.items():
+        print(
+            f"{mode:<8} {row[f'recall@{args.k}']:9.3f} {row['mrr']:6.3f} "
+            f"{row['p50_ms']:7.2f}ms {row['p95_ms']:7.2f}ms {row['fast_path_rate']:10.0%}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"queries": len(queries), "k": args.k, "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Serialization and compression benchmark for API payloads.
+
+Encodes representative /api/chat responses (long markdown answers) and
+question bank responses with the standard library JSONResponse and with
+FastJSONResponse, then compresses each body with gzip and, if installed,
+brotli at the configured levels. Reports encode time per call and the
+bytes that would go on the wire.
+
+With --http the question bank endpoints are also requested through the app
+with and without Accept-Encoding, to check the middleware end to end.
+
+Usage (from the server directory):
+    python benchmarks/serialization.py
+    python benchmarks/serialization.py --iterations 2000 --http --json serialization.json
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import argparse
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from fastapi.responses import JSONResponse
+
+from utils.responses import FastJSONResponse, COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY, brotli, orjson
+from utils.question_bank import question_bank
+
+ANSWER_SECTION = """## Step {n}: work out the ratio
+
+The question gives **3 adult tickets** and **2 child tickets** for £47.50, and a child ticket
+costs 60% of an adult ticket. Let the adult price be *a*:
+
+- 3a + 2 × 0.6a = 47.50
+- 4.2a = 47.50, so a ≈ £11.31
+- A child ticket is therefore 0.6 × 11.31 ≈ £6.79
+
+> Tip: in quantitative reasoning, check each option against the ratio rather than solving
+> exactly — eliminating answers that break it is usually faster.
+
+| Option | Adult | Child | Fits? |
+|--------|-------|-------|-------|
+| A      | £11.31 | £6.79 | ✓ |
+| B      | £12.00 | £5.75 | ✗ |
+
+"""
+
+def chat_payload(sections: int) -> dict:
+    """A ChatResponse body with an answer of the given number of markdown sections"""
+    answer = "".join(ANSWER_SECTION.format(n=n + 1) for n in range(sections))
+    return {"answer": answer, "context": None, "session_id": "3f2b1c9d8e7a4b6c9d0e1f2a3b4c5d6e"}
+
+def payloads():
+    question_bank.load()
+    facets = question_bank.facets()
+    page = question_bank.list_questions(page=1, page_size=20)
+    items = [
+        ("chat (short answer)", chat_payload(1)),
+        ("chat (typical answer)", chat_payload(4)),
+        ("chat (long answer)", chat_payload(12)),
+        ("questions page_size=20", page),
+        ("questions page_size=100", question_bank.list_questions(page=1, page_size=100)),
+        ("questions/facets", facets),
+    ]
+    if page["items"]:
+        items.append(("questions/{id}", page["items"][0]))
+    return items
+
+def _per_call_us(func, iterations: int, repeats: int = 5) -> float:
+    """Best of several runs, in microseconds per call"""
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        best = min(best, (time.perf_counter() - started) / iterations)
+    return best * 1e6
+
+def measure(payload, iterations: int) -> dict:
+    stdlib_body = JSONResponse(payload).body
+    fast_body = FastJSONResponse(payload).body
+    row = {
+        "stdlib_us": _per_call_us(lambda: JSONResponse(payload), iterations),
+        "fast_us": _per_call_us(lambda: FastJSONResponse(payload), iterations),
+        "stdlib_bytes": len(stdlib_body),
+        "bytes": len(fast_body),
+        "gzip_bytes": len(gzip.compress(fast_body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)),
+        "gzip_us": _per_call_us(lambda: gzip.compress(fast_body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0), max(1, iterations // 10)),
+    }
+    if brotli is not None:
+        row["br_bytes"] = len(brotli.compress(fast_body, quality=COMPRESSION_BROTLI_QUALITY))
+        row["br_us"] = _per_call_us(lambda: brotli.compress(fast_body, quality=COMPRESSION_BROTLI_QUALITY), max(1, iterations // 10))
+    return row
+
+def measure_http(paths):
+    """Wire bytes per question bank endpoint, identity vs negotiated encoding"""
+    from fastapi.testclient import TestClient
+    from main import app
+
+    results = {}
+    with TestClient(app) as client:
+        for path in paths:
+            identity = client.get(path, headers={"Accept-Encoding": "identity"})
+            negotiated = client.get(path, headers={"Accept-Encoding": "br, gzip"})
+            results[path] = {
+                "identity_bytes": int(identity.headers.get("content-length", len(identity.content))),
+                "encoding": negotiated.headers.get("content-encoding", "identity"),
+                "wire_bytes": int(negotiated.headers.get("content-length", len(negotiated.content))),
+            }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500, help="encodes per timing run")
+    parser.add_argument("--http", action="store_true", help="also request the question bank endpoints through the app")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed: FastJSONResponse falls back to the json module")
+    if brotli is None:
+        print("brotli is not installed: only gzip is measured")
+
+    results = {}
+    print(f"{'payload':<26} {'bytes':>8} {'json us':>9} {'fast us':>9} {'speedup':>8} {'gzip':>8} {'gzip us':>8} {'br':>8} {'br us':>7}")
+    for name, payload in payloads():
+        row = measure(payload, args.iterations)
+        results[name] = row
+        br = f"{row['br_bytes']:>8} {row['br_us']:>7.0f}" if "br_bytes" in row else f"{'-':>8} {'-':>7}"
+        print(
+            f"{name:<26} {row['bytes']:>8} {row['stdlib_us']:>9.1f} {row['fast_us']:>9.1f} "
+            f"{row['stdlib_us'] / row['fast_us']:>7.1f}x {row['gzip_bytes']:>8} {row['gzip_us']:>8.0f} {br}"
+        )
+
+    output = {"payloads": results}
+    if args.http:
+        print()
+        http = measure_http(["/api/questions?page_size=20", "/api/questions?page_size=100", "/api/questions/facets"])
+        for path, row in http.items():
+            saved = 1 - row["wire_bytes"] / row["identity_bytes"] if row["identity_bytes"] else 0.0
+            print(f"{path:<34} {row['identity_bytes']:>8} -> {row['wire_bytes']:>7} bytes ({row['encoding']}, {saved:.0%} saved)")
+        output["http"] = http
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
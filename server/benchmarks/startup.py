@@ -0,0 +1,124 @@
+"""
+Cold-start benchmark for the API.
+
+Reports the import time of each heavy module (measured in a fresh interpreter
+with -X importtime) and the time from launching uvicorn until the first
+successful response on each probe path.
+
+Usage (from the server directory):
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 5 --json startup.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    "fastapi",
+    "aiohttp",
+    "jose",
+    "supabase",
+    "stripe",
+    "utils.auth",
+    "utils.stripe_client",
+    "utils.openai_client_simple",
+    "main",
+]
+DEFAULT_PATHS = ["/api/health", "/api/questions/facets"]
+
+def measure_import(module: str) -> float:
+    """Cumulative import time of a module in milliseconds, in a clean interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SERVER_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # Lines look like: "import time:   self [us] |  cumulative | imported package"
+    for line in reversed(result.stderr.splitlines()):
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No importtime entry for {module}")
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _wait_for(url: str, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.01)
+    raise TimeoutError(f"No response from {url}")
+
+def measure_first_response(paths, timeout: float) -> dict:
+    """Launch uvicorn and time the first successful response on each path"""
+    port = _free_port()
+    env = dict(os.environ)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=SERVER_DIR,
+        env=env,
+    )
+    try:
+        timings = {}
+        for path in paths:
+            ready = _wait_for(f"http://127.0.0.1:{port}{path}", started + timeout)
+            timings[path] = (ready - started) * 1000
+        return timings
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--paths", nargs="*", default=DEFAULT_PATHS)
+    parser.add_argument("--runs", type=int, default=3, help="repetitions; the median is reported")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the server")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {"imports_ms": {}, "first_response_ms": {}}
+
+    print("Import time (cumulative, median of runs)")
+    for module in args.modules:
+        try:
+            samples = [measure_import(module) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"  {module:<32} failed: {e}")
+            continue
+        results["imports_ms"][module] = statistics.median(samples)
+        print(f"  {module:<32} {results['imports_ms'][module]:8.1f} ms")
+
+    print("Time to first response (from process start, median of runs)")
+    runs = [measure_first_response(args.paths, args.timeout) for _ in range(args.runs)]
+    for path in args.paths:
+        results["first_response_ms"][path] = statistics.median(run[path] for run in runs)
+        print(f"  {path:<32} {results['first_response_ms'][path]:8.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,15 @@ import sys
 import os
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Literal, Optional
 from dotenv import load_dotenv
 import logging
 import json
+import time
+import asyncio
+import threading
 
 # Add the current directory to Python path for Vercel compatibility
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -22,11 +26,39 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # Import from utils package
-from utils import openai_client
-from utils.auth import get_current_user, get_current_user_optional, get_user_profile, update_subscription_status
-from utils.stripe_client import stripe_client, SUBSCRIPTION_PLANS
+from utils import get_openai_client
+from utils.openai_client_simple import FallbackAnswer
+from utils.auth import get_current_user, get_current_user_optional, get_user_profile, get_profile_cache_stats, token_cache, get_supabase, require_admin
+from utils.stripe_client import get_stripe_client, SUBSCRIPTION_PLANS
+from utils.http_session import get_http_session, close_http_session
+from utils.executor import shutdown_executor
+from utils.streaming import encode_frames, sse_event, stream_frames
+from utils.question_bank import question_bank
+from utils.admission import admission, admit_chat, admit_chat_batch, LeasedStreamingResponse
+from utils.metrics import (
+    METRICS_ENABLED, PROMETHEUS_CONTENT_TYPE, MetricsMiddleware, register_collector, render_metrics
+)
+from utils.responses import CompressionMiddleware, FastJSONResponse
+from utils.request_log import RequestLogMiddleware, annotate, log_sampled, redact
+from utils.conversation_store import conversations
+from utils.webhook_queue import webhook_queue
+from utils.billing import CHECKOUT_DEADLINE_SECONDS, customers, resolve_price_id
+from utils.bank_router import bank_router
+
+# Subsystems are created on first use; warmup builds them in the background
+# after startup so the first real request doesn't pay for it. Off by default
+# on Vercel, where a warmup thread would compete with the request that
+# triggered the cold start.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false" if os.getenv("VERCEL") else "true").lower() == "true"
 
-app = FastAPI()
+# Batch chat limits
+BATCH_CHAT_CONCURRENCY = int(os.getenv("BATCH_CHAT_CONCURRENCY", "40"))
+BATCH_CHAT_MAX_ITEMS = int(os.getenv("BATCH_CHAT_MAX_ITEMS", "50"))
+
+app = FastAPI(default_response_class=FastJSONResponse)
+# Innermost, so the metrics and request log see the bytes actually sent
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 # Add CORS middleware - Updated for production deployment
 app.add_middleware(
@@ -39,18 +71,58 @@ app.add_middleware(
         "https://study-byte-nu.vercel.app"  # Replace with your actual domain
     ],
     allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_methods=["GET", "POST", "DELETE", "OPTIONS"],
     allow_headers=["*"],                                      
     expose_headers=["*"]
 )
+# Outermost (added last), so the request ID and log record cover every other
+# layer, CORS preflights included
+app.add_middleware(RequestLogMiddleware)
 
 class ChatRequest(BaseModel):
     message: str
     context: Optional[str] = None
+    session_id: Optional[str] = None  # "new" to start a conversation, or the returned ID to continue it; none keeps no history
+    depth: Literal["basic", "detailed"] = "detailed"  # Of stored explanations, for known bank questions
 
 class ChatResponse(BaseModel):
     answer: str
     context: Optional[str] = None
+    session_id: Optional[str] = None  # Send back with the next message to continue
+    source: Literal["llm", "bank"] = "llm"  # "bank" when answered from a stored explanation
+    match_confidence: Optional[float] = None
+    matched_id: Optional[str] = None  # The bank question answered
+
+class BatchChatItem(BaseModel):
+    message: str
+    context: Optional[str] = None
+    depth: Literal["basic", "detailed"] = "detailed"
+
+class BatchChatRequest(BaseModel):
+    items: List[BatchChatItem]
+    context: Optional[str] = None  # Shared by items without their own context
+    stream: bool = False  # Stream results as NDJSON in completion order
+
+class BatchChatResult(BaseModel):
+    index: int
+    answer: Optional[str] = None
+    error: Optional[str] = None
+    source: Literal["llm", "bank"] = "llm"
+    match_confidence: Optional[float] = None
+    matched_id: Optional[str] = None
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
+
+class ConversationTurn(BaseModel):
+    message: str
+    answer: str
+
+class ConversationResponse(BaseModel):
+    session_id: str
+    summary: str
+    summarized_turns: int  # Turns folded into the summary
+    turns: List[ConversationTurn]  # The rest, verbatim
 
 class UserProfile(BaseModel):
     id: str
@@ -68,6 +140,36 @@ class CheckoutResponse(BaseModel):
     checkout_url: str
     session_id: str
 
+def warm_up_subsystems():
+    """Initialize the lazily created clients, logging (not raising) failures"""
+    for name, init in (
+        ("openai", get_openai_client),
+        ("supabase", get_supabase),
+        ("stripe", get_stripe_client),
+    ):
+        started = time.perf_counter()
+        try:
+            init()
+            logger.info("Warmed up %s in %.0f ms", name, (time.perf_counter() - started) * 1000)
+        except Exception as e:
+            logger.warning("Warmup of %s failed: %s", name, e)
+
+@app.on_event("startup")
+async def startup_event():
+    # Open the pooled HTTP session up front so the first chat skips the handshake setup
+    await get_http_session()
+    question_bank.load()
+    await webhook_queue.start()
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=warm_up_subsystems, name="warmup", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Before the HTTP session and executor go away, since pending writes need them
+    await webhook_queue.stop()
+    await close_http_session()
+    shutdown_executor()
+
 @app.get("/")
 async def read_root():
     return {"status": "healthy", "message": "API is running"}
@@ -81,77 +183,395 @@ async def api_root():
 async def health_check():
     return {"status": "healthy", "message": "API is running"}
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, current_user = Depends(get_current_user_optional)):
+@app.get("/api/cache/stats", dependencies=[Depends(require_admin)])
+async def cache_stats():
+    """Get hit/miss counters for the in-process caches"""
+    return {
+        "profiles": get_profile_cache_stats(),
+        "auth_tokens": token_cache.stats(),
+        "responses": get_openai_client().response_cache.stats(),
+        "single_flight": get_openai_client().flights.stats(),
+        "conversations": conversations.stats(),
+        "stripe_customers": customers.stats(),
+        "bank_routing": bank_router.stats()
+    }
+
+def collect_component_metrics():
+    """Export the counters the caches, single-flight and admission already keep"""
+    client = get_openai_client()
+    caches = {
+        "auth_tokens": token_cache.stats(),
+        "profiles": get_profile_cache_stats()["local"],
+        "responses_exact": client.response_cache.stats()["exact"],
+        "responses_semantic": client.response_cache.stats()["semantic"],
+    }
+    embeddings = getattr(client, "embeddings", None)
+    if hasattr(embeddings, "stats"):
+        caches["query_embeddings"] = embeddings.stats()
+
+    flights = client.flights.stats()
+    admission_stats = admission.stats()
+    conversation_stats = conversations.stats()
+    webhook_stats = webhook_queue.stats()
+    bank_stats = bank_router.stats()
+    families = [
+        ("cache_hits_total", "counter", "Cache hits by cache",
+         [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("cache_misses_total", "counter", "Cache misses by cache",
+         [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("single_flight_requests_total", "counter", "Completion requests seen by single-flight",
+         [({}, flights["requests"])]),
+        ("single_flight_coalesced_total", "counter", "Completion requests served by another request's upstream call",
+         [({}, flights["coalesced"])]),
+        ("admission_admitted_total", "counter", "Chat requests admitted by tier",
+         [({"tier": tier}, count) for tier, count in admission_stats["admitted"].items()]),
+        ("admission_rejected_total", "counter", "Chat requests rejected by tier and reason",
+         [({"tier": tier, "reason": reason}, count)
+          for tier, reasons in admission_stats["rejected"].items() for reason, count in reasons.items()]),
+    ]
+    families += [
+        ("conversation_summaries_total", "counter", "Conversations whose older turns were folded into the summary",
+         [({}, conversation_stats["summaries"])]),
+        ("conversation_summary_failures_total", "counter", "Summarizations that failed, leaving turns verbatim",
+         [({}, conversation_stats["summary_failures"])]),
+    ]
+    families += [
+        ("webhook_events_total", "counter", "Verified Stripe webhook events by outcome",
+         [({"outcome": "duplicate"}, webhook_stats["duplicates"]),
+          ({"outcome": "accepted"}, webhook_stats["received"] - webhook_stats["duplicates"])]),
+        ("webhook_events_coalesced_total", "counter", "Webhook profile writes merged into a pending write for the same customer",
+         [({}, webhook_stats["coalesced"])]),
+        ("webhook_writes_total", "counter", "Webhook profile writes by outcome",
+         [({"outcome": "written"}, webhook_stats["written"]),
+          ({"outcome": "retried"}, webhook_stats["retries"]),
+          ({"outcome": "failed"}, webhook_stats["failed"])]),
+        ("webhook_writes_pending", "gauge", "Webhook profile writes waiting to run", [({}, webhook_stats["pending"])]),
+        ("webhook_queue_healthy", "gauge", "1 while webhook writes succeed; events are processed inline otherwise",
+         [({}, int(webhook_stats["healthy"]))]),
+    ]
+    families += [
+        ("bank_routing_checked_total", "counter", "Chat messages checked against the question bank",
+         [({}, bank_stats["checked"])]),
+        ("bank_routing_answered_total", "counter", "Chat messages answered from stored explanations by match method",
+         [({"method": method}, count) for method, count in bank_stats["routed"].items()]),
+        ("bank_routing_ambiguous_total", "counter", "Chat messages matching several bank questions, left to the LLM",
+         [({}, bank_stats["ambiguous"])]),
+    ]
+    if conversation_stats["sessions"] is not None:
+        families.append(("conversation_sessions", "gauge", "Conversations held in memory", [({}, conversation_stats["sessions"])]))
+    if admission_stats["in_flight"] is not None:
+        families.append(("admission_in_flight", "gauge", "Admitted chat requests still running", [({}, admission_stats["in_flight"])]))
+    return families
+
+register_collector(collect_component_metrics)
+
+@app.get("/api/metrics", dependencies=[Depends(require_admin)])
+async def metrics():
+    """Request pipeline metrics in the Prometheus text format"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.get("/api/admission/stats", dependencies=[Depends(require_admin)])
+async def admission_stats():
+    """Get admitted and rejected chat requests per tier"""
+    return admission.stats()
+
+async def get_user_context(current_user) -> str:
+    """Profile details passed to the model as context for authenticated users"""
+    if not current_user:
+        return ""
+    profile = await get_user_profile(current_user.id)
+    if not profile:
+        return ""
+    annotate(user_id=current_user.id, subscription=profile.get("subscription_status", "free"))
+    return f"User subscription: {profile.get('subscription_status', 'free')}"
+
+async def load_conversation(request: ChatRequest, current_user):
+    """The session to continue, or a new one"""
+    return await conversations.load(request.session_id, current_user.id if current_user else None)
+
+def chat_context(*parts: Optional[str]) -> str:
+    """Join the caller's context, conversation history and user context"""
+    return "\n".join(part for part in parts if part).strip()
+
+def route_to_bank(message: str, depth: str, conversation=None):
+    """(match, answer) if the message is about a bank question the conversation hasn't covered yet, else None"""
+    routed = bank_router.answer(message, depth, conversation.topics if conversation else ())
+    if routed:
+        match, _ = routed
+        annotate(source="bank", matched_id=match.question_id, match_confidence=match.confidence)
+    return routed
+
+def bank_fields(match) -> dict:
+    """The ChatResponse and BatchChatResult fields saying where the answer came from"""
+    if match is None:
+        return {"source": "llm"}
+    return {"source": "bank", "match_confidence": match.confidence, "matched_id": match.question_id}
+
+async def answer_chat(request: ChatRequest, current_user, name: str) -> ChatResponse:
+    """The body shared by the non-streaming chat endpoints; name labels its log lines"""
     try:
-        logger.info(f"Received chat request with message: {request.message}")
+        annotate(message_chars=len(request.message))
+        log_sampled(logger, "%s request: %s", name.capitalize(), redact(request.message))
         
         # Add user context if authenticated
-        user_context = ""
-        if current_user:
-            profile = get_user_profile(current_user.id)
-            if profile:
-                user_context = f"User subscription: {profile.get('subscription_status', 'free')}"
-                logger.info(f"Authenticated user: {current_user.email} (subscription: {profile.get('subscription_status', 'free')})")
+        user_context = await get_user_context(current_user)
+        conversation = await load_conversation(request, current_user)
         
         # Generate response using OpenAI
-        response = await openai_client.generate_response(
-            message=request.message,
-            context=f"{request.context or ''}\n{user_context}".strip()
-        )
+        client = get_openai_client()
+        routed = route_to_bank(request.message, request.depth, conversation)
+        if routed:
+            match, response = routed
+        else:
+            match = None
+            response = await client.generate_response(
+                message=request.message,
+                context=chat_context(request.context, conversation and conversation.render(), user_context)
+            )
+        if not isinstance(response, FallbackAnswer):
+            await conversations.record_turn(conversation, request.message, response, client, topics=bank_router.topics(request.message, match))
         
-        logger.info(f"Received response from OpenAI: {response}")
+        annotate(answer_chars=len(response))
         return ChatResponse(
             answer=response,
-            context=request.context
+            context=request.context,
+            session_id=conversation and conversation.session_id,
+            **bank_fields(match)
         )
     except Exception as e:
-        logger.error(f"Error processing chat request: {str(e)}", exc_info=True)
+        logger.error("Error processing %s request: %s", name, e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatRequest,
+    current_user = Depends(get_current_user_optional),
+    lease = Depends(admit_chat)
+):
+    return await answer_chat(request, current_user, "chat")
+
 @app.post("/api/chat/with-context")
-async def chat_with_context(request: ChatRequest, current_user = Depends(get_current_user_optional)):
-    try:
-        logger.info(f"Received chat with context request: {request.message}")
-        
-        # Add user context if authenticated
-        user_context = ""
-        if current_user:
-            profile = get_user_profile(current_user.id)
-            if profile:
-                user_context = f"User subscription: {profile.get('subscription_status', 'free')}"
-        
-        # This endpoint will be enhanced later with RAG capabilities
-        response = await openai_client.generate_response(
-            message=request.message,
-            context=f"{request.context or ''}\n{user_context}".strip()
-        )
-        return ChatResponse(
-            answer=response,
-            context=request.context
-        )
-    except Exception as e:
-        logger.error(f"Error processing chat with context request: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+async def chat_with_context(
+    request: ChatRequest,
+    current_user = Depends(get_current_user_optional),
+    lease = Depends(admit_chat)
+):
+    # This endpoint will be enhanced later with RAG capabilities
+    return await answer_chat(request, current_user, "chat with context")
+
+@app.post("/api/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    current_user = Depends(get_current_user_optional),
+    lease = Depends(admit_chat)
+):
+    """Stream the answer token by token as Server-Sent Events"""
+    user_context = await get_user_context(current_user)
+    conversation = await load_conversation(request, current_user)
+    routed = route_to_bank(request.message, request.depth, conversation)
+
+    async def event_stream():
+        client = get_openai_client()
+        metadata = {"sessionId": conversation and conversation.session_id, "source": "llm"}
+        parts = []
+        completed = False
+
+        async def answer_tokens():
+            nonlocal completed
+            if routed:
+                # Known bank question: the stored explanation goes out as one delta
+                match, answer = routed
+                metadata.update(source="bank", matchConfidence=match.confidence, matchedId=match.question_id)
+                parts.append(answer)
+                yield answer
+                completed = True
+                return
+            async for token in client.stream_response(
+                message=request.message,
+                context=chat_context(request.context, conversation and conversation.render(), user_context),
+                metadata=metadata
+            ):
+                parts.append(token)
+                yield token
+            completed = True
+
+        async for event in encode_frames(stream_frames(answer_tokens(), metadata), sse_event):
+            yield event
+        # Only complete answers become part of the conversation
+        if completed and parts and not getattr(client, "demo_mode", False):
+            await conversations.record_turn(
+                conversation, request.message, "".join(parts), client,
+                topics=bank_router.topics(request.message, routed and routed[0])
+            )
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # Stop proxies from buffering the stream
+    }
+    if conversation:
+        headers["X-Session-ID"] = conversation.session_id
+    # Holds the admission slot until the stream ends, not just until the
+    # response starts
+    return LeasedStreamingResponse(
+        event_stream(),
+        lease,
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+@app.post("/api/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(
+    request: BatchChatRequest,
+    current_user = Depends(get_current_user_optional),
+    lease = Depends(admit_chat_batch)
+):
+    """
+    Answer many messages in one request.
+
+    Auth and the profile lookup happen once; the items then run concurrently,
+    at most BATCH_CHAT_CONCURRENCY at a time. A failing item gets an error
+    in its result instead of failing the batch. With stream=true, results are
+    sent as NDJSON lines in the order they complete.
+    """
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items to answer")
+    if len(request.items) > BATCH_CHAT_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_CHAT_MAX_ITEMS} items per batch")
+
+    annotate(batch_items=len(request.items))
+    user_context = await get_user_context(current_user)
+    client = get_openai_client()
+    semaphore = asyncio.Semaphore(BATCH_CHAT_CONCURRENCY)
+
+    async def answer(index: int, item: BatchChatItem) -> BatchChatResult:
+        context = item.context if item.context is not None else request.context
+        routed = bank_router.answer(item.message, item.depth)
+        if routed:
+            match, response = routed
+            return BatchChatResult(index=index, answer=response, **bank_fields(match))
+        async with semaphore:
+            try:
+                response = await client.generate_response(
+                    message=item.message,
+                    context=chat_context(context, user_context)
+                )
+            except Exception as e:
+                logger.error("Error answering batch item %s: %s", index, e)
+                return BatchChatResult(index=index, error=str(e))
+        # The plain client answers upstream failures with text instead of raising
+        if isinstance(response, FallbackAnswer):
+            return BatchChatResult(index=index, error=str(response))
+        return BatchChatResult(index=index, answer=response)
+
+    if not request.stream:
+        results = await asyncio.gather(*(answer(i, item) for i, item in enumerate(request.items)))
+        return BatchChatResponse(results=results)
+
+    async def result_stream():
+        tasks = [asyncio.create_task(answer(i, item)) for i, item in enumerate(request.items)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                yield result.model_dump_json(exclude_none=True) + "\n"
+        finally:
+            # Client went away: stop the items that haven't finished
+            for task in tasks:
+                task.cancel()
+
+    return LeasedStreamingResponse(
+        result_stream(),
+        lease,
+        media_type="application/x-ndjson",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@app.get("/api/conversations/{session_id}", response_model=ConversationResponse)
+async def get_conversation(session_id: str, current_user = Depends(get_current_user_optional)):
+    """Get a conversation's summary and the turns not yet summarized"""
+    conversation = await conversations.get(session_id, current_user.id if current_user else None)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return ConversationResponse(
+        session_id=conversation.session_id,
+        summary=conversation.summary,
+        summarized_turns=conversation.folded,
+        turns=[ConversationTurn(message=message, answer=answer) for message, answer in conversation.turns]
+    )
+
+@app.delete("/api/conversations/{session_id}")
+async def delete_conversation(session_id: str, current_user = Depends(get_current_user_optional)):
+    """Forget a conversation"""
+    if not await conversations.delete(session_id, current_user.id if current_user else None):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {"status": "deleted"}
+
+@app.get("/api/questions")
+async def list_questions(
+    section: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    tag: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20
+):
+    """List practice questions filtered by facet, one page at a time"""
+    return question_bank.list_questions(section, category, difficulty, tag, page, page_size)
+
+@app.get("/api/questions/random")
+async def random_questions(
+    count: int = 10,
+    section: Optional[str] = None,
+    category: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    tag: Optional[str] = None
+):
+    """Sample a random practice set"""
+    return {"items": question_bank.sample_questions(count, section, category, difficulty, tag)}
+
+@app.get("/api/questions/facets")
+async def question_facets():
+    """Get the available sections, categories and difficulties with counts"""
+    return question_bank.facets()
+
+@app.get("/api/questions/{question_id}")
+async def get_question(question_id: str):
+    """Get a single question by ID"""
+    question = question_bank.get_question(question_id)
+    if not question:
+        raise HTTPException(status_code=404, detail="Question not found")
+    return question
+
+@app.get("/api/passages/{passage_id}")
+async def get_passage(passage_id: str):
+    """Get a verbal reasoning passage with its questions"""
+    passage = question_bank.get_passage(passage_id)
+    if not passage:
+        raise HTTPException(status_code=404, detail="Passage not found")
+    return passage
 
 @app.get("/api/profile", response_model=UserProfile)
 async def get_profile(current_user = Depends(get_current_user)):
     """Get current user's profile"""
     try:
-        profile = get_user_profile(current_user.id)
+        profile = await get_user_profile(current_user.id)
         if not profile:
             raise HTTPException(status_code=404, detail="Profile not found")
         
         return UserProfile(**profile)
     except Exception as e:
-        logger.error(f"Error fetching profile: {str(e)}")
+        logger.error("Error fetching profile: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/subscription-status")
 async def get_subscription_status(current_user = Depends(get_current_user)):
     """Get user's subscription status"""
     try:
-        profile = get_user_profile(current_user.id)
+        profile = await get_user_profile(current_user.id)
         if not profile:
             raise HTTPException(status_code=404, detail="Profile not found")
         
@@ -160,7 +580,7 @@ async def get_subscription_status(current_user = Depends(get_current_user)):
             "stripe_customer_id": profile.get("stripe_customer_id")
         }
     except Exception as e:
-        logger.error(f"Error fetching subscription status: {str(e)}")
+        logger.error("Error fetching subscription status: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/subscription-plans")
@@ -168,58 +588,76 @@ async def get_subscription_plans():
     """Get available subscription plans"""
     return {"plans": SUBSCRIPTION_PLANS}
 
+@app.post("/api/checkout/prepare")
+async def prepare_checkout(current_user = Depends(get_current_user)):
+    """
+    Signal checkout intent, e.g. when the pricing page or upgrade dialog
+    opens. The Stripe customer is created in the background, so the checkout
+    that follows only has to create the session.
+    """
+    profile = await get_user_profile(current_user.id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    customers.prefetch(current_user.id, current_user.email, profile)
+    return {"status": "ready" if profile.get("stripe_customer_id") else "preparing"}
+
 @app.post("/api/create-checkout-session", response_model=CheckoutResponse)
 async def create_checkout_session(
     request: CreateCheckoutRequest,
     current_user = Depends(get_current_user)
 ):
-    """Create a Stripe checkout session"""
+    """
+    Create a Stripe checkout session.
+
+    The profile and price are looked up concurrently; the Stripe customer is
+    normally pre-provisioned, so creating the session is the only Stripe
+    call left. Answers 504 if it all takes longer than CHECKOUT_DEADLINE_SECONDS.
+    """
+    # Validate plan
+    if request.plan not in SUBSCRIPTION_PLANS:
+        raise HTTPException(status_code=400, detail="Invalid plan")
+    
     try:
-        # Validate plan
-        if request.plan not in SUBSCRIPTION_PLANS:
-            raise HTTPException(status_code=400, detail="Invalid plan")
-        
-        plan = SUBSCRIPTION_PLANS[request.plan]
-        price_id = plan["price_id"]
-        
-        if not price_id:
-            raise HTTPException(status_code=500, detail="Price ID not configured for this plan")
-        
-        # Get user profile
-        profile = get_user_profile(current_user.id)
-        if not profile:
-            raise HTTPException(status_code=404, detail="Profile not found")
-        
-        # Create or get Stripe customer
-        stripe_customer_id = profile.get("stripe_customer_id")
-        if not stripe_customer_id:
-            customer = await stripe_client.create_customer(
-                email=current_user.email,
-                name=profile.get("full_name")
-            )
-            stripe_customer_id = customer.id
-            
-            # Update profile with Stripe customer ID
-            update_subscription_status(current_user.id, "free", stripe_customer_id)
-        
-        # Create checkout session
-        session = await stripe_client.create_checkout_session(
-            customer_id=stripe_customer_id,
-            price_id=price_id,
-            success_url=request.success_url,
-            cancel_url=request.cancel_url,
-            user_id=current_user.id
-        )
-        
-        return CheckoutResponse(
-            checkout_url=session.url,
-            session_id=session.id
-        )
-        
+        return await asyncio.wait_for(checkout(request, current_user), CHECKOUT_DEADLINE_SECONDS)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        annotate(checkout_timeout=True)
+        logger.error("Checkout for user %s timed out after %.1fs", current_user.id, CHECKOUT_DEADLINE_SECONDS)
+        raise HTTPException(status_code=504, detail="Checkout is taking longer than expected, please try again")
     except Exception as e:
-        logger.error(f"Error creating checkout session: {str(e)}")
+        logger.error("Error creating checkout session: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def checkout(request: CreateCheckoutRequest, current_user) -> CheckoutResponse:
+    profile, price_id = await asyncio.gather(
+        get_user_profile(current_user.id),
+        resolve_price_id(request.plan)
+    )
+    if not price_id:
+        raise HTTPException(status_code=500, detail="Price ID not configured for this plan")
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    # Saved to the profile in the background when it has to be created here
+    stripe_customer_id = profile.get("stripe_customer_id")
+    annotate(customer_preprovisioned=bool(stripe_customer_id))
+    if not stripe_customer_id:
+        stripe_customer_id = await customers.ensure(current_user.id, current_user.email, profile.get("full_name"))
+    
+    session = await get_stripe_client().create_checkout_session(
+        customer_id=stripe_customer_id,
+        price_id=price_id,
+        success_url=request.success_url,
+        cancel_url=request.cancel_url,
+        user_id=current_user.id
+    )
+    
+    return CheckoutResponse(
+        checkout_url=session.url,
+        session_id=session.id
+    )
+
 @app.post("/api/create-billing-portal-session")
 async def create_billing_portal_session(
     return_url: str,
@@ -227,7 +665,7 @@ async def create_billing_portal_session(
 ):
     """Create a Stripe billing portal session"""
     try:
-        profile = get_user_profile(current_user.id)
+        profile = await get_user_profile(current_user.id)
         if not profile:
             raise HTTPException(status_code=404, detail="Profile not found")
         
@@ -235,7 +673,7 @@ async def create_billing_portal_session(
         if not stripe_customer_id:
             raise HTTPException(status_code=400, detail="No Stripe customer found")
         
-        session = await stripe_client.create_billing_portal_session(
+        session = await get_stripe_client().create_billing_portal_session(
             customer_id=stripe_customer_id,
             return_url=return_url
         )
@@ -243,106 +681,40 @@ async def create_billing_portal_session(
         return {"portal_url": session.url}
         
     except Exception as e:
-        logger.error(f"Error creating billing portal session: {str(e)}")
+        logger.error("Error creating billing portal session: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/stripe-webhook")
 async def stripe_webhook(request: Request):
-    """Handle Stripe webhooks"""
+    """
+    Handle Stripe webhooks: verify the signature and acknowledge. The
+    resulting profile writes are deduplicated, coalesced per customer and
+    applied by the webhook queue in the background.
+    """
+    payload = await request.body()
+    signature = request.headers.get("stripe-signature")
+    
+    if not signature:
+        raise HTTPException(status_code=400, detail="Missing signature")
+    
     try:
-        payload = await request.body()
-        signature = request.headers.get("stripe-signature")
-        
-        if not signature:
-            raise HTTPException(status_code=400, detail="Missing signature")
-        
         # Verify webhook signature
-        event = stripe_client.verify_webhook_signature(payload, signature)
-        
-        # Handle different event types
-        if event.type == "customer.subscription.created":
-            subscription = event.data.object
-            await handle_subscription_created(subscription)
-        elif event.type == "customer.subscription.updated":
-            subscription = event.data.object
-            await handle_subscription_updated(subscription)
-        elif event.type == "customer.subscription.deleted":
-            subscription = event.data.object
-            await handle_subscription_deleted(subscription)
-        elif event.type == "invoice.payment_succeeded":
-            invoice = event.data.object
-            await handle_payment_succeeded(invoice)
-        elif event.type == "invoice.payment_failed":
-            invoice = event.data.object
-            await handle_payment_failed(invoice)
-        
-        return {"status": "success"}
-        
+        event = get_stripe_client().verify_webhook_signature(payload, signature)
     except Exception as e:
-        logger.error(f"Webhook error: {str(e)}")
+        logger.error("Webhook error: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
-
-async def handle_subscription_created(subscription):
-    """Handle subscription created event"""
-    try:
-        customer_id = subscription.customer
-        user_id = subscription.metadata.get("user_id")
-        
-        if user_id:
-            status = "active" if subscription.status == "active" else "inactive"
-            update_subscription_status(user_id, status, customer_id)
-            logger.info(f"Updated subscription status for user {user_id}: {status}")
-    except Exception as e:
-        logger.error(f"Error handling subscription created: {str(e)}")
-
-async def handle_subscription_updated(subscription):
-    """Handle subscription updated event"""
-    try:
-        customer_id = subscription.customer
-        user_id = subscription.metadata.get("user_id")
-        
-        if user_id:
-            status = "active" if subscription.status == "active" else "inactive"
-            update_subscription_status(user_id, status, customer_id)
-            logger.info(f"Updated subscription status for user {user_id}: {status}")
-    except Exception as e:
-        logger.error(f"Error handling subscription updated: {str(e)}")
-
-async def handle_subscription_deleted(subscription):
-    """Handle subscription deleted event"""
-    try:
-        user_id = subscription.metadata.get("user_id")
-        
-        if user_id:
-            update_subscription_status(user_id, "free")
-            logger.info(f"Subscription cancelled for user {user_id}")
-    except Exception as e:
-        logger.error(f"Error handling subscription deleted: {str(e)}")
-
-async def handle_payment_succeeded(invoice):
-    """Handle successful payment"""
+    
+    annotate(webhook_event=event.type)
     try:
-        customer_id = invoice.customer
-        subscription_id = invoice.subscription
-        
-        if subscription_id:
-            subscription = stripe_client.get_subscription_status(subscription_id)
-            # Additional handling if needed
-            logger.info(f"Payment succeeded for subscription {subscription_id}")
-    except Exception as e:
-        logger.error(f"Error handling payment succeeded: {str(e)}")
-
-async def handle_payment_failed(invoice):
-    """Handle failed payment"""
-    try:
-        customer_id = invoice.customer
-        subscription_id = invoice.subscription
-        
-        if subscription_id:
-            # Additional handling for failed payments
-            logger.warning(f"Payment failed for subscription {subscription_id}")
+        accepted = await webhook_queue.submit(event)
     except Exception as e:
-        logger.error(f"Error handling payment failed: {str(e)}")
+        # Only when processing inline (queue disabled or unhealthy): a non-2xx makes Stripe retry
+        logger.error("Error processing webhook event %s: %s", event.id, e)
+        raise HTTPException(status_code=500, detail="Webhook processing failed")
+    
+    if not accepted:
+        annotate(webhook_duplicate=True)
+    return {"status": "success"}
 
 # WebSocket support is disabled for Vercel serverless compatibility
 # Uncomment for local development if needed
@@ -359,7 +731,7 @@ async def websocket_endpoint(websocket: WebSocket):
             logger.info(f"Received WebSocket message: {request}")
             
             # Generate streaming response using OpenAI
-            await openai_client.generate_stream(
+            await get_openai_client().generate_stream(
                 websocket=websocket,
                 message=request.get("message", ""),
                 context=request.get("context")
@@ -0,0 +1,214 @@
+"""
+Build the versioned UKCAT retrieval index from data/*.json.
+
+Every passage, question and explanation becomes one document whose content
+is hashed together with the embedding model name. On rebuild, documents
+whose hash matches the previous version reuse its vectors. Only new or
+changed documents are embedded, in parallel batches, so adding a question
+costs a handful of forward passes rather than a full re-embed.
+
+Each build is written to a new directory <output>/vN containing:
+    index.faiss    flat L2 index, memory-mapped by the server
+    vectors.npy    raw vectors, reused by the next incremental build
+    docs.json      document ids, contents and metadata, in index order
+    manifest.json  format version, model, dimension, counts and per-document hashes
+and LATEST is then switched to point at it.
+
+Usage (from the server directory):
+    python scripts/build_index.py
+    python scripts/build_index.py --force --workers 4 --keep 3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.embeddings import EMBEDDING_BACKEND, EMBEDDING_MODEL, create_embeddings
+from utils.question_bank import QUESTION_BANK_DIR, QuestionBank
+from utils.index_store import (
+    DOCS_FILE, INDEX_FILE, INDEX_FORMAT_VERSION, LATEST_FILE, MANIFEST_FILE, UKCAT_INDEX_DIR, VECTORS_FILE,
+    read_manifest, resolve_version_dir,
+)
+
+def collect_documents(data_dir: str):
+    """One document per passage, question and explanation in the question files"""
+    snapshot = QuestionBank(data_dir, reload_interval=0).snapshot
+    documents = []
+
+    for passage in snapshot.passages.values():
+        documents.append({
+            "id": f"passage:{passage['id']}",
+            "content": f"Passage {passage['id']} ({passage['category']}):\n{passage['passage_text']}",
+            "metadata": {"kind": "passage", "passage_id": passage["id"], "section": passage["section"]},
+        })
+
+    for question in snapshot.questions.values():
+        options = "; ".join(question["options"])
+        documents.append({
+            "id": f"question:{question['id']}",
+            "content": (
+                f"Question {question['id']} ({question['category']}, {question['difficulty']}):\n"
+                f"{question['question_text']}\nOptions: {options}\nAnswer: {question['correct_answer']}"
+            ),
+            "metadata": {
+                "kind": "question",
+                "question_id": question["id"],
+                "passage_id": question["passage_id"],
+                "section": question["section"],
+            },
+        })
+        for level, explanation in (question["explanations"] or {}).items():
+            if not explanation:
+                continue
+            documents.append({
+                "id": f"explanation:{question['id']}:{level}",
+                "content": f"Explanation for {question['id']} ({level}):\n{explanation}",
+                "metadata": {
+                    "kind": "explanation",
+                    "question_id": question["id"],
+                    "level": level,
+                    "section": question["section"],
+                },
+            })
+
+    for document in documents:
+        raw = f"{EMBEDDING_MODEL}\x1f{document['content']}"
+        document["hash"] = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    return documents
+
+def load_previous(root: str):
+    """Vectors of the current version by document hash, if it used the same model"""
+    import numpy as np
+
+    path = resolve_version_dir(root, version=None)
+    if path is None:
+        return None, {}
+
+    manifest = read_manifest(path)
+    if manifest.get("model") != EMBEDDING_MODEL or manifest.get("format_version") != INDEX_FORMAT_VERSION:
+        print(f"Previous index {manifest.get('version')} is incompatible, re-embedding everything")
+        return manifest, {}
+
+    with open(os.path.join(path, DOCS_FILE), encoding="utf-8") as f:
+        docs = json.load(f)
+    vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+    return manifest, {doc["hash"]: vectors[row] for row, doc in enumerate(docs)}
+
+def embed_in_batches(texts, batch_size: int, workers: int):
+    embeddings = create_embeddings(cache=False)
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(embeddings.embed_documents, batches)
+        return [vector for batch in results for vector in batch]
+
+def next_version(root: str) -> str:
+    versions = [
+        int(name[1:]) for name in os.listdir(root)
+        if name.startswith("v") and name[1:].isdigit()
+    ] if os.path.isdir(root) else []
+    return f"v{max(versions, default=0) + 1}"
+
+def write_version(root: str, version: str, documents, vectors, dimension: int):
+    import faiss
+    import numpy as np
+
+    path = os.path.join(root, version)
+    staging = f"{path}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(documents), dimension)
+    index = faiss.IndexFlatL2(dimension)
+    index.add(matrix)
+    faiss.write_index(index, os.path.join(staging, INDEX_FILE))
+    np.save(os.path.join(staging, VECTORS_FILE), matrix)
+
+    with open(os.path.join(staging, DOCS_FILE), "w", encoding="utf-8") as f:
+        json.dump(documents, f, ensure_ascii=False)
+    with open(os.path.join(staging, MANIFEST_FILE), "w") as f:
+        json.dump({
+            "format_version": INDEX_FORMAT_VERSION,
+            "version": version,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "model": EMBEDDING_MODEL,
+            "backend": EMBEDDING_BACKEND,
+            "dimension": dimension,
+            "metric": "l2",
+            "count": len(documents),
+            "faiss_version": faiss.__version__,
+            "documents": {doc["id"]: doc["hash"] for doc in documents},
+        }, f, indent=2)
+
+    os.rename(staging, path)
+
+    # Switch readers over atomically
+    latest = os.path.join(root, LATEST_FILE)
+    with open(f"{latest}.tmp", "w") as f:
+        f.write(version)
+    os.replace(f"{latest}.tmp", latest)
+
+def prune(root: str, keep: int):
+    versions = sorted(
+        (int(name[1:]) for name in os.listdir(root) if name.startswith("v") and name[1:].isdigit()),
+        reverse=True,
+    )
+    for number in versions[keep:]:
+        shutil.rmtree(os.path.join(root, f"v{number}"))
+        print(f"Removed old index v{number}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=QUESTION_BANK_DIR, help="directory with the question JSON files")
+    parser.add_argument("--output", default=UKCAT_INDEX_DIR, help="root directory for index versions")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2, help="batches embedded in parallel")
+    parser.add_argument("--keep", type=int, default=3, help="versions to keep, 0 keeps all")
+    parser.add_argument("--force", action="store_true", help="write a new version even if nothing changed")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    root = os.path.abspath(args.output)
+    documents = collect_documents(args.data)
+    if not documents:
+        print(f"No documents found in {args.data}")
+        return
+    previous_manifest, previous_vectors = load_previous(root)
+
+    changed = [doc for doc in documents if doc["hash"] not in previous_vectors]
+    unchanged = len(documents) - len(changed)
+    removed = len(set((previous_manifest or {}).get("documents", {})) - {doc["id"] for doc in documents})
+    print(f"{len(documents)} documents: {unchanged} unchanged, {len(changed)} to embed, {removed} removed")
+
+    if not changed and not removed and previous_manifest and not args.force:
+        print(f"Index {previous_manifest['version']} is up to date")
+        return
+
+    fresh = {}
+    if changed:
+        embed_started = time.perf_counter()
+        fresh = dict(zip(
+            (doc["hash"] for doc in changed),
+            embed_in_batches([doc["content"] for doc in changed], args.batch_size, args.workers),
+        ))
+        print(f"Embedded {len(changed)} documents in {time.perf_counter() - embed_started:.1f}s")
+
+    vectors = [fresh[doc["hash"]] if doc["hash"] in fresh else previous_vectors[doc["hash"]] for doc in documents]
+    dimension = len(vectors[0])
+
+    version = next_version(root)
+    os.makedirs(root, exist_ok=True)
+    write_version(root, version, documents, vectors, dimension)
+    if args.keep > 0:
+        prune(root, args.keep)
+
+    print(f"Wrote index {version} to {root} in {time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
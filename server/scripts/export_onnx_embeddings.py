@@ -0,0 +1,100 @@
+"""
+Export the sentence-transformers embedding model to ONNX and quantize it to int8.
+
+Writes model.onnx (fp32), model_int8.onnx and tokenizer.json to the output
+directory (EMBEDDING_ONNX_DIR by default), then checks that the quantized
+model reproduces the PyTorch vectors within --tolerance cosine distance.
+
+Requires torch, transformers, sentence-transformers, onnx and onnxruntime;
+only onnxruntime and tokenizers are needed to serve the exported model.
+
+Usage (from the server directory):
+    python scripts/export_onnx_embeddings.py
+    EMBEDDING_BACKEND=onnx uvicorn main:app
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.embeddings import EMBEDDING_MODEL, EMBEDDING_ONNX_DIR, OnnxEmbeddings
+
+SAMPLE_TEXTS = [
+    "How do I calculate percentage change?",
+    "What is the difference between 'Can't tell' and 'False' in verbal reasoning?",
+    "A train travels 120 km in 1.5 hours. What is its average speed?",
+    "Tips for managing time in the UKCAT quantitative reasoning section",
+    "qr_1",
+]
+
+def export(model_name: str, output_dir: str, opset: int):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    hub_name = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(hub_name)
+    model = AutoModel.from_pretrained(hub_name).eval()
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)  # Writes tokenizer.json for the fast tokenizer
+
+    sample = tokenizer(SAMPLE_TEXTS[:2], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, "model.onnx")
+    axes = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        model,
+        (sample["input_ids"], sample["attention_mask"], sample["token_type_ids"]),
+        fp32_path,
+        input_names=["input_ids", "attention_mask", "token_type_ids"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": axes,
+            "attention_mask": axes,
+            "token_type_ids": axes,
+            "last_hidden_state": axes,
+        },
+        opset_version=opset,
+    )
+    print(f"Exported {hub_name} to {fp32_path}")
+    return fp32_path
+
+def quantize(fp32_path: str, output_dir: str) -> str:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = os.path.join(output_dir, "model_int8.onnx")
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    print(f"Quantized model written to {int8_path}")
+    return int8_path
+
+def verify(model_name: str, output_dir: str, tolerance: float) -> bool:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+
+    reference = SentenceTransformer(model_name).encode(SAMPLE_TEXTS, normalize_embeddings=True)
+    ok = True
+    for model_file in ("model.onnx", "model_int8.onnx"):
+        vectors = np.asarray(OnnxEmbeddings(output_dir, model_file).embed_documents(SAMPLE_TEXTS))
+        distances = 1.0 - (reference * vectors).sum(axis=1)
+        worst = float(distances.max())
+        status = "ok" if worst <= tolerance else "FAILED"
+        print(f"{model_file}: max cosine distance to PyTorch {worst:.5f} ({status})")
+        ok = ok and worst <= tolerance
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--output", default=EMBEDDING_ONNX_DIR)
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="max cosine distance from the PyTorch vectors")
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(args.output)
+    fp32_path = export(args.model, output_dir, args.opset)
+    quantize(fp32_path, output_dir)
+    if not verify(args.model, output_dir, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from utils import admission as module
+from utils.admission import AdmissionController, InMemoryAdmissionBackend, TierPolicy, client_ip
+
+# One token a second, up to two, and no concurrency limits in the way
+POLICY = TierPolicy(rate_per_minute=60, burst=2, user_concurrency=100, global_share=1.0)
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(module, "time", SimpleNamespace(monotonic=fake.monotonic, time=time.time))
+    return fake
+
+def admit(backend, identity="ip:1", policy=POLICY, cost=1.0):
+    return asyncio.run(backend.admit(identity, policy, cost))
+
+def test_bucket_allows_a_burst_then_limits_to_the_rate(clock):
+    backend = InMemoryAdmissionBackend()
+    assert admit(backend).admitted
+    assert admit(backend).admitted
+    rejected = admit(backend)
+    assert (rejected.admitted, rejected.reason) == (False, "rate")
+    assert rejected.retry_after == pytest.approx(1.0)
+
+    clock.now += 0.5
+    assert admit(backend).retry_after == pytest.approx(0.5)
+    clock.now += 0.5
+    assert admit(backend).admitted
+
+def test_bucket_refills_no_higher_than_the_burst(clock):
+    backend = InMemoryAdmissionBackend()
+    admit(backend)
+    clock.now += 3600
+    assert [admit(backend).admitted for _ in range(3)] == [True, True, False]
+
+def test_buckets_are_per_identity(clock):
+    backend = InMemoryAdmissionBackend()
+    admit(backend, "ip:1")
+    admit(backend, "ip:1")
+    assert not admit(backend, "ip:1").admitted
+    assert admit(backend, "ip:2").admitted
+
+def test_batch_cost_drains_the_bucket_instead_of_never_fitting(clock):
+    backend = InMemoryAdmissionBackend()
+    assert admit(backend, cost=50).admitted
+    assert not admit(backend).admitted
+
+def test_refilled_buckets_are_swept(clock, monkeypatch):
+    monkeypatch.setattr(module, "ADMISSION_BUCKET_SWEEP_SECONDS", 10)
+    backend = InMemoryAdmissionBackend()
+    for identity in ("ip:1", "ip:2"):
+        admit(backend, identity)
+    clock.now += 5
+    admit(backend, "ip:3")
+    assert len(backend._buckets) == 3
+
+    # Every bucket has refilled by the next sweep; only the one used after it is left
+    clock.now += 6
+    admit(backend, "ip:3")
+    assert set(backend._buckets) == {"ip:3"}
+
+def test_concurrency_limit_holds_until_release(clock):
+    backend = InMemoryAdmissionBackend()
+    policy = TierPolicy(rate_per_minute=0, burst=0, user_concurrency=1, global_share=1.0)
+    assert admit(backend, policy=policy).admitted
+    assert admit(backend, policy=policy).reason == "concurrency"
+    asyncio.run(backend.release("ip:1"))
+    assert admit(backend, policy=policy).admitted
+
+def test_rejection_is_a_429_with_retry_after(clock, monkeypatch):
+    monkeypatch.setitem(module.TIER_POLICIES, "anonymous", TierPolicy(6, 1, 100, 1.0))
+    controller = AdmissionController(InMemoryAdmissionBackend(), enabled=True)
+    asyncio.run(controller.admit("ip:1", "anonymous"))
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(controller.admit("ip:1", "anonymous"))
+    assert rejected.value.status_code == 429
+    assert rejected.value.headers["Retry-After"] == "10"
+    assert controller.stats()["rejected"]["anonymous"]["rate"] == 1
+
+def test_lease_release_is_idempotent(clock):
+    controller = AdmissionController(InMemoryAdmissionBackend(), enabled=True)
+
+    async def scenario():
+        lease = await controller.admit("ip:1", "free")
+        await lease.release()
+        await lease.release()
+        return controller.backend.in_flight()
+
+    assert asyncio.run(scenario()) == 0
+
+def request_from(peer, headers):
+    return Request({
+        "type": "http",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": (peer, 1234),
+    })
+
+def test_client_ip_ignores_forwarded_for_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(module, "ADMISSION_CLIENT_IP_HEADER", "")
+    monkeypatch.setattr(module, "ADMISSION_TRUSTED_PROXIES", 0)
+    assert client_ip(request_from("10.0.0.1", {"X-Forwarded-For": "1.2.3.4"})) == "10.0.0.1"
+
+def test_client_ip_takes_the_entry_added_by_the_outermost_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(module, "ADMISSION_CLIENT_IP_HEADER", "")
+    monkeypatch.setattr(module, "ADMISSION_TRUSTED_PROXIES", 1)
+    # The client sent a spoofed first entry; the proxy appended the real address
+    request = request_from("10.0.0.1", {"X-Forwarded-For": "1.2.3.4, 203.0.113.7"})
+    assert client_ip(request) == "203.0.113.7"
+
+def test_client_ip_prefers_the_configured_header(monkeypatch):
+    monkeypatch.setattr(module, "ADMISSION_CLIENT_IP_HEADER", "x-real-ip")
+    request = request_from("10.0.0.1", {"X-Real-IP": "203.0.113.7", "X-Forwarded-For": "1.2.3.4"})
+    assert client_ip(request) == "203.0.113.7"
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils.bank_router import BankRouter
+
+CINEMA = (
+    "Deraine is taking her family to the cinema on a Friday. She has a son, a granddaughter "
+    "and her daughter's friend. How much extra would it cost if her brother Erald came?"
+)
+TRAIN = (
+    "A train leaves the station at nine and travels at sixty miles per hour for two and a half "
+    "hours before stopping. How far has the train travelled when it stops?"
+)
+
+def question(question_id, text, answer, passage_id=None):
+    return {
+        "id": question_id,
+        "question_text": text,
+        "options": ["£6", "£8", "£10"],
+        "correct_answer": answer,
+        "passage_id": passage_id,
+        "explanations": {"basic": f"Basic explanation of {question_id}", "detailed": f"Detailed explanation of {question_id}"},
+    }
+
+class FakeBank:
+    def __init__(self, questions, passages=None):
+        self.snapshot = SimpleNamespace(
+            questions={item["id"]: item for item in questions},
+            passages={item["id"]: item for item in passages or []},
+        )
+
+    def get_question(self, question_id):
+        return self.snapshot.questions.get(question_id)
+
+@pytest.fixture
+def router():
+    return BankRouter(bank=FakeBank([
+        question("qr_1", CINEMA, "£8"),
+        question("qr_2", TRAIN, "150 miles"),
+        {"id": "qr_3", "question_text": "A question without explanations", "options": []},
+    ]), enabled=True)
+
+@pytest.mark.parametrize("message", [
+    "qr_1",
+    "explain qr_1",
+    "Can you explain question qr-1 please?",
+    "help me solve QR_1 step by step",
+    "I'm stuck on qr_1, how do I get the answer?",
+])
+def test_explain_requests_by_id_are_routed(router, message):
+    match = router.match(message)
+    assert (match.question_id, match.method, match.confidence) == ("qr_1", "id", 1.0)
+
+@pytest.mark.parametrize("message", [
+    "is the answer to qr_1 wrong? I think it's B",
+    "why is qr_1 not £10",
+    "explain qr_1 using algebra instead",
+    "compare qr_1 and qr_2",
+    "explain qr_99",
+    "explain qr_3",
+    "explain the cinema question",
+])
+def test_anything_else_about_an_id_goes_to_the_llm(router, message):
+    assert router.match(message) is None
+
+def test_pasted_question_is_routed_by_text(router):
+    match = router.match(CINEMA)
+    assert (match.question_id, match.method) == ("qr_1", "text")
+    assert match.confidence >= 0.85
+
+def test_pasted_question_with_a_different_request_goes_to_the_llm(router):
+    message = f"{CINEMA} Now write me a similar question about a theme park with student tickets and prices instead"
+    assert router.match(message) is None
+
+def test_near_identical_questions_are_ambiguous():
+    router = BankRouter(bank=FakeBank([question("qr_1", CINEMA, "£8"), question("qr_9", CINEMA, "£8")]), enabled=True)
+    assert router.match(CINEMA) is None
+    assert router.stats()["ambiguous"] == 1
+
+def test_questions_already_covered_go_to_the_llm(router):
+    assert router.answer("explain qr_1", "basic", covered=["qr_2"]) == (router.match("explain qr_1"), "**Answer: £8**\n\nBasic explanation of qr_1")
+    assert router.answer("explain qr_1", covered=["qr_1"]) is None
+    assert router.stats()["follow_ups"] == 1
+
+def test_topics_are_the_known_ids_named_and_the_match(router):
+    assert router.topics("is qr_1 or qr_2 harder than qr_99?") == ["qr_1", "qr_2"]
+    assert router.topics(CINEMA, router.match(CINEMA)) == ["qr_1"]
+
+def test_disabled_router_matches_nothing():
+    router = BankRouter(bank=FakeBank([question("qr_1", CINEMA, "£8")]), enabled=False)
+    assert router.match("explain qr_1") is None
+    assert router.topics("explain qr_1") == []
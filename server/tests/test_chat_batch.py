@@ -0,0 +1,47 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from utils.admission import admission
+from utils.openai_client_simple import OpenAIClient
+
+@pytest.fixture
+def client(monkeypatch):
+    # Nothing listens on port 9, so every completion fails
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("OPENAI_API_BASE", "http://127.0.0.1:9/v1")
+    openai_client = OpenAIClient()
+    monkeypatch.setattr(main, "get_openai_client", lambda: openai_client)
+    monkeypatch.setattr(admission, "enabled", False)
+    monkeypatch.setattr(main, "WARMUP_ON_STARTUP", False)
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+def test_upstream_failures_are_per_item_errors(client):
+    response = client.post("/api/chat/batch", json={"items": [{"message": "What is 2 + 2?"}, {"message": "Name a prime"}]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == [0, 1]
+    for result in results:
+        assert result["answer"] is None
+        assert "trouble connecting" in result["error"]
+
+def test_streamed_batch_reports_failures_per_item(client):
+    response = client.post("/api/chat/batch", json={"items": [{"message": "What is 2 + 2?"}], "stream": True})
+    assert response.status_code == 200
+    lines = [line for line in response.text.splitlines() if line]
+    assert len(lines) == 1
+    assert '"error"' in lines[0] and '"answer"' not in lines[0]
+
+def test_bank_items_carry_the_match(client):
+    response = client.post("/api/chat/batch", json={"items": [{"message": "explain qr_1", "depth": "basic"}]})
+    result = response.json()["results"][0]
+    assert (result["source"], result["matched_id"], result["match_confidence"]) == ("bank", "qr_1", 1.0)
+    assert result["error"] is None
+
+@pytest.mark.parametrize("path", ["/api/chat", "/api/chat/with-context"])
+def test_chat_endpoints_answer_alike(client, path):
+    bank = client.post(path, json={"message": "explain qr_1"}).json()
+    assert (bank["source"], bank["matched_id"], bank["match_confidence"]) == ("bank", "qr_1", 1.0)
+    failed = client.post(path, json={"message": "What is 2 + 2?"}).json()
+    assert failed["source"] == "llm" and "trouble connecting" in failed["answer"]
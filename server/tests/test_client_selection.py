@@ -0,0 +1,19 @@
+import utils
+from utils import openai_client, openai_client_simple
+
+def test_rag_init_failure_falls_back_once(monkeypatch):
+    calls = 0
+
+    def broken():
+        nonlocal calls
+        calls += 1
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+
+    monkeypatch.setattr(utils, "RAG_ENABLED", True)
+    monkeypatch.setattr(utils, "_rag_client", None)
+    monkeypatch.setattr(utils, "_rag_unavailable", False)
+    monkeypatch.setattr(openai_client, "get_openai_client", broken)
+
+    clients = [utils.get_openai_client() for _ in range(3)]
+    assert all(client is openai_client_simple.get_openai_client() for client in clients)
+    assert calls == 1
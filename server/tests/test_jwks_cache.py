@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+from utils.auth import JWKSCache
+
+def test_stale_keys_are_fetched_once_for_concurrent_requests():
+    cache = JWKSCache("http://127.0.0.1:9/jwks", refresh_seconds=3600)
+    fetches = 0
+
+    def refresh():
+        nonlocal fetches
+        fetches += 1
+        time.sleep(0.05)
+        cache._keys = {"kid-1": {"kid": "kid-1"}}
+        cache._fetched_at = time.monotonic()
+    cache._refresh = refresh
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_key("kid-1") for _ in range(10)))
+
+    keys = asyncio.run(scenario())
+    assert fetches == 1
+    assert keys == [{"kid": "kid-1"}] * 10
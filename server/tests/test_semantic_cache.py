@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from utils import response_cache
+from utils.openai_client_simple import OpenAIClient
+
+QUESTION = "How do I work out percentage change?"
+PARAPHRASE = "How do I calculate a percentage change?"
+
+class FakeUpstream:
+    """Completion and embedding calls with set latencies"""
+
+    def __init__(self, completion_delay, embedding_delay):
+        self.completion_delay = completion_delay
+        self.embedding_delay = embedding_delay
+        self.completions = 0
+        self.cancelled = 0
+
+    async def complete(self, headers, payload):
+        self.completions += 1
+        try:
+            await asyncio.sleep(self.completion_delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return {"choices": [{"message": {"content": f"answer {self.completions}"}}], "usage": {"completion_tokens": 2}}
+
+    async def tokens(self, headers, payload):
+        self.completions += 1
+        try:
+            await asyncio.sleep(self.completion_delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        for token in ["streamed ", f"answer {self.completions}"]:
+            yield token
+
+    async def embed(self, text):
+        await asyncio.sleep(self.embedding_delay)
+        return [1.0, 0.0, 0.0]  # Every question looks the same
+
+@pytest.fixture
+def make_client(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(response_cache, "SEMANTIC_CACHE_EMBEDDINGS", "api")
+
+    def make(completion_delay, embedding_delay):
+        client = OpenAIClient()
+        upstream = FakeUpstream(completion_delay, embedding_delay)
+        client._complete = upstream.complete
+        client._upstream_tokens = upstream.tokens
+        client.embedder.embed = upstream.embed
+        return client, upstream
+    return make
+
+def test_api_embeddings_use_their_own_threshold(make_client):
+    client, _ = make_client(0, 0)
+    assert client.response_cache.max_distance == response_cache.SEMANTIC_CACHE_API_MAX_DISTANCE
+
+def test_semantic_hit_cancels_the_completion(make_client):
+    client, upstream = make_client(completion_delay=0.2, embedding_delay=0.01)
+
+    async def scenario():
+        first = await client.generate_response(QUESTION)
+        await asyncio.sleep(0)
+        return first, await client.generate_response(PARAPHRASE)
+
+    first, second = asyncio.run(scenario())
+    assert first == second == "answer 1"
+    assert upstream.completions == 2
+    assert upstream.cancelled == 1
+
+def test_miss_does_not_wait_for_a_slow_embedding(make_client):
+    client, upstream = make_client(completion_delay=0.01, embedding_delay=0.3)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        answer = await client.generate_response(QUESTION)
+        elapsed = loop.time() - started
+        # The embedding still lands in the semantic tier once it arrives
+        await asyncio.sleep(0.4)
+        return answer, elapsed, len(client.response_cache.semantic)
+
+    answer, elapsed, semantic_size = asyncio.run(scenario())
+    assert answer == "answer 1"
+    assert elapsed < 0.2
+    assert semantic_size == 1
+
+def test_stream_hit_before_the_first_token_cancels_the_stream(make_client):
+    client, upstream = make_client(completion_delay=0.2, embedding_delay=0.01)
+
+    async def consume(message):
+        return "".join([token async for token in client.stream_response(message)])
+
+    async def scenario():
+        first = await consume(QUESTION)
+        await asyncio.sleep(0)
+        return first, await consume(PARAPHRASE)
+
+    first, second = asyncio.run(scenario())
+    assert first == second == "streamed answer 1"
+    assert upstream.cancelled == 1
+
+def test_numbers_still_block_semantic_hits(make_client):
+    client, upstream = make_client(completion_delay=0.05, embedding_delay=0.01)
+
+    async def scenario():
+        await client.generate_response("What is 15% of 240 tickets?")
+        await asyncio.sleep(0)
+        return await client.generate_response("What is 15% of 250 tickets?")
+
+    assert asyncio.run(scenario()) == "answer 2"
+    assert upstream.cancelled == 0
+
+def test_rag_stream_uses_the_retrieval_embedding():
+    from utils import openai_client
+    from utils.retrieval import RetrievalResult
+    from utils.single_flight import SingleFlight
+
+    class FakeRetriever:
+        async def retrieve(self, query, k=3):
+            return RetrievalResult(documents=[], embedding=[1.0, 0.0, 0.0], timings={})
+
+    client = openai_client.OpenAIClient.__new__(openai_client.OpenAIClient)
+    client.api_key, client.model, client.max_tokens = "sk-test", "m", 100
+    client.api_base = "http://127.0.0.1:9/v1/chat/completions"  # Never reached on a hit
+    client.retriever = FakeRetriever()
+    client.response_cache = response_cache.ResponseCache(semantic=True)
+    client.flights = SingleFlight()
+    client.response_cache.store(client.response_cache.make_key(QUESTION, None, "m"), QUESTION, None, "m", "cached answer", [1.0, 0.0, 0.0])
+
+    async def consume():
+        return "".join([token async for token in client.stream_response(PARAPHRASE)])
+
+    assert asyncio.run(consume()) == "cached answer"
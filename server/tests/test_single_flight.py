@@ -0,0 +1,142 @@
+import asyncio
+
+from utils.single_flight import SingleFlight
+
+def test_identical_calls_share_one_upstream_call():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(flights.do("key", upstream) for _ in range(5)))
+        return calls, results, flights.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+    assert calls == 1
+    assert results == ["answer"] * 5
+    assert stats["coalesced"] == 4
+    assert stats["in_flight"] == 0
+
+def test_cancelled_waiter_does_not_cancel_the_others():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+        release = asyncio.Event()
+
+        async def upstream():
+            await release.wait()
+            return "answer"
+
+        leader = asyncio.create_task(flights.do("key", upstream))
+        follower = asyncio.create_task(flights.do("key", upstream))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return leader, await follower, flights.stats()
+
+    leader, answer, stats = asyncio.run(scenario())
+    assert leader.cancelled()
+    assert answer == "answer"
+    assert stats["cancelled"] == 0
+
+def test_upstream_call_is_cancelled_when_every_waiter_leaves():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+        started = asyncio.Event()
+        upstream_cancelled = asyncio.Event()
+
+        async def upstream():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                upstream_cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flights.do("key", upstream)) for _ in range(2)]
+        await started.wait()
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.wait_for(upstream_cancelled.wait(), 1)
+
+        # A new caller starts a fresh flight instead of joining the cancelled one
+        async def again():
+            return "fresh"
+        return await flights.do("key", again), flights.stats()
+
+    answer, stats = asyncio.run(scenario())
+    assert answer == "fresh"
+    assert stats["cancelled"] == 1
+    assert stats["upstream_calls"] == 2
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+
+        async def upstream():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream failed")
+
+        return await asyncio.gather(*(flights.do("key", upstream) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_stream_followers_replay_and_tail_the_leader():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+        calls = 0
+
+        async def upstream(metadata):
+            nonlocal calls
+            calls += 1
+            metadata["context"] = "ctx"
+            for token in ["a", "b", "c"]:
+                await asyncio.sleep(0.005)
+                yield token
+
+        async def consume(metadata):
+            return [token async for token in flights.stream("key", upstream, metadata)]
+
+        leader_meta, follower_meta = {}, {}
+        leader = asyncio.create_task(consume(leader_meta))
+        await asyncio.sleep(0.007)  # Join after the first token
+        follower = await consume(follower_meta)
+        return calls, await leader, follower, follower_meta
+
+    calls, leader, follower, follower_meta = asyncio.run(scenario())
+    assert calls == 1
+    assert leader == follower == ["a", "b", "c"]
+    assert follower_meta == {"context": "ctx"}
+
+def test_stream_survives_a_cancelled_leader():
+    async def scenario():
+        flights = SingleFlight(enabled=True)
+        release = asyncio.Event()
+
+        async def upstream(metadata):
+            yield "a"
+            await release.wait()
+            yield "b"
+
+        async def consume():
+            return [token async for token in flights.stream("key", upstream)]
+
+        leader = asyncio.create_task(consume())
+        follower = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await follower
+
+    assert asyncio.run(scenario()) == ["a", "b"]
+
+def test_fingerprint_ignores_whitespace_and_case():
+    assert SingleFlight.fingerprint("Explain  qr_1", None, "m", 10) == SingleFlight.fingerprint("explain qr_1 ", None, "m", 10)
+    assert SingleFlight.fingerprint("explain qr_1", None, "m", 10) != SingleFlight.fingerprint("explain qr_1", None, "m", 20)
@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import json
+
+from utils import streaming
+from utils.streaming import STREAM_PROTOCOL_VERSION, encode_frames, sse_event, stream_frames
+
+async def tokens_from(items, delay=0.0, error=None):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+    if error is not None:
+        raise error
+
+def frames_for(tokens, metadata=None):
+    async def collect():
+        return [frame async for frame in stream_frames(tokens, metadata)]
+    return asyncio.run(collect())
+
+def check_integrity(frames):
+    """The reassembled answer, after checking the frames follow the v1 protocol"""
+    assert frames[0] == {"type": "start", "v": STREAM_PROTOCOL_VERSION, "metadata": frames[0]["metadata"]}
+    deltas, end = frames[1:-1], frames[-1]
+    assert [frame["type"] for frame in deltas] == ["delta"] * len(deltas)
+    assert [frame["seq"] for frame in deltas] == list(range(len(deltas)))
+    answer = "".join(frame["content"] for frame in deltas).encode("utf-8")
+    assert end == {"type": "end", "frames": len(deltas), "length": len(answer), "sha256": hashlib.sha256(answer).hexdigest()}
+    return answer.decode("utf-8")
+
+def test_frames_reassemble_to_the_answer():
+    tokens = ["The", " answer", " is", " **B**", " — ", "naïve", " 🙂", "\n\n", "done"]
+    frames = frames_for(tokens_from(tokens, delay=0.001))
+    assert check_integrity(frames) == "".join(tokens)
+
+def test_small_tokens_are_coalesced_into_fewer_deltas():
+    tokens = ["x"] * 500
+    frames = frames_for(tokens_from(tokens))
+    assert check_integrity(frames) == "x" * 500
+    assert len(frames) - 2 < len(tokens)
+
+def test_start_frame_carries_metadata_filled_in_before_the_first_token():
+    metadata = {"source": "llm"}
+
+    async def tokens():
+        metadata["context"] = "passage"
+        yield "hi"
+
+    frames = frames_for(tokens(), metadata)
+    assert frames[0]["metadata"] == {"source": "llm", "context": "passage"}
+    assert check_integrity(frames) == "hi"
+
+def test_empty_answer_still_gets_start_and_end():
+    frames = frames_for(tokens_from([]))
+    assert [frame["type"] for frame in frames] == ["start", "end"]
+    assert check_integrity(frames) == ""
+
+def test_failure_replaces_the_end_frame():
+    frames = frames_for(tokens_from(["partial"], error=RuntimeError("upstream went away")))
+    assert frames[0]["type"] == "start"
+    assert frames[-1] == {"type": "error", "content": "upstream went away"}
+    assert all(frame["type"] != "end" for frame in frames)
+
+def test_sse_event_is_one_data_line():
+    event = sse_event({"type": "delta", "seq": 0, "content": "a\nb"})
+    assert event.startswith("data: ") and event.endswith("\n\n")
+    assert "\n" not in event[:-2]
+    assert json.loads(event[6:]) == {"type": "delta", "seq": 0, "content": "a\nb"}
+
+def test_serialization_is_timed_once_per_stream(monkeypatch):
+    observed = []
+    monkeypatch.setattr(streaming, "observe_stage", lambda stage, seconds: observed.append(stage))
+
+    async def collect():
+        return [event async for event in encode_frames(stream_frames(tokens_from(["a", "b", "c"], delay=0.06)), sse_event)]
+
+    events = asyncio.run(collect())
+    assert len(events) >= 4
+    assert all(event.startswith("data: ") for event in events)
+    assert observed == ["frame_serialization"]
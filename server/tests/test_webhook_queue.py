@@ -0,0 +1,178 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from utils import webhook_queue as module
+from utils.webhook_queue import WebhookQueue
+
+class FakeProfiles:
+    """Stands in for update_subscription_status, recording the writes made"""
+
+    def __init__(self):
+        self.writes = []
+        self.failing = False
+
+    async def update_subscription_status(self, user_id, status, customer_id, raise_errors=False):
+        if self.failing:
+            raise RuntimeError("database down")
+        self.writes.append((user_id, status, customer_id))
+
+@pytest.fixture
+def profiles(monkeypatch):
+    fake = FakeProfiles()
+    monkeypatch.setattr(module, "update_subscription_status", fake.update_subscription_status)
+    monkeypatch.setattr(module, "WEBHOOK_COALESCE_MS", 20)
+    monkeypatch.setattr(module, "WEBHOOK_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(module, "WEBHOOK_RETRY_BASE_SECONDS", 0.01)
+    return fake
+
+def subscription_event(event_id, created, status, event_type="customer.subscription.updated"):
+    return SimpleNamespace(
+        id=event_id,
+        type=event_type,
+        created=created,
+        data=SimpleNamespace(object={"customer": "cus_1", "status": status, "metadata": {"user_id": "user-1"}}),
+    )
+
+async def wait_for(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.005)
+
+def test_burst_for_one_customer_ends_in_one_write_of_the_newest_state(profiles):
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        # Delivered out of order: the newest event wins, not the last one
+        await queue.submit(subscription_event("evt_1", 100, "incomplete", "customer.subscription.created"))
+        await queue.submit(subscription_event("evt_3", 300, "active"))
+        await queue.submit(subscription_event("evt_2", 200, "past_due"))
+        await wait_for(lambda: queue.written)
+        await queue.stop()
+        return queue.stats()
+
+    stats = asyncio.run(scenario())
+    assert profiles.writes == [("user-1", "active", "cus_1")]
+    assert stats["coalesced"] == 2
+    assert stats["pending"] == 0
+
+def test_redelivered_events_are_acknowledged_without_a_write(profiles):
+    async def scenario():
+        queue = WebhookQueue(enabled=False)
+        first = await queue.submit(subscription_event("evt_1", 100, "active"))
+        again = await queue.submit(subscription_event("evt_1", 100, "active"))
+        return first, again, queue.stats()
+
+    first, again, stats = asyncio.run(scenario())
+    assert (first, again) == (True, False)
+    assert stats["duplicates"] == 1
+    assert len(profiles.writes) == 1
+
+def test_stop_flushes_writes_still_waiting_to_coalesce(profiles, monkeypatch):
+    monkeypatch.setattr(module, "WEBHOOK_COALESCE_MS", 60_000)
+
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        await queue.submit(subscription_event("evt_1", 100, "active"))
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert profiles.writes == [("user-1", "active", "cus_1")]
+
+def test_write_that_gives_up_forgets_its_events(profiles):
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        profiles.failing = True
+        await queue.submit(subscription_event("evt_1", 100, "active"))
+        await wait_for(lambda: queue.failed)
+        stats = queue.stats()
+        # Stripe's retry of the same event is processed, not dropped as a duplicate
+        resent = await queue.dedupe.first_seen("evt_1")
+        await queue.stop()
+        return stats, resent
+
+    stats, resent = asyncio.run(scenario())
+    assert stats["retries"] == module.WEBHOOK_MAX_ATTEMPTS - 1
+    assert stats["failed"] == 1
+    assert not stats["healthy"]
+    assert resent
+    assert profiles.writes == []
+
+def test_unhealthy_queue_writes_inline_and_lets_failures_reach_stripe(profiles):
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        queue.healthy = False
+        profiles.failing = True
+        with pytest.raises(RuntimeError):
+            await queue.submit(subscription_event("evt_1", 100, "active"))
+        # The failed event can be delivered again
+        profiles.failing = False
+        accepted = await queue.submit(subscription_event("evt_1", 100, "active"))
+        await queue.stop()
+        return accepted, queue.stats()
+
+    accepted, stats = asyncio.run(scenario())
+    assert accepted
+    assert stats["healthy"]
+    assert profiles.writes == [("user-1", "active", "cus_1")]
+
+def test_inline_write_takes_over_a_pending_one(profiles, monkeypatch):
+    monkeypatch.setattr(module, "WEBHOOK_COALESCE_MS", 60_000)
+
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        await queue.submit(subscription_event("evt_2", 200, "active"))
+        queue.healthy = False
+        await queue.submit(subscription_event("evt_1", 100, "past_due"))
+        stats = queue.stats()
+        await queue.stop()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats["pending"] == 0
+    assert profiles.writes == [("user-1", "active", "cus_1")]
+
+def test_stop_applies_retries_armed_during_the_drain(profiles, monkeypatch):
+    monkeypatch.setattr(module, "WEBHOOK_COALESCE_MS", 60_000)
+    monkeypatch.setattr(module, "WEBHOOK_RETRY_BASE_SECONDS", 60)
+    failures = iter([True])
+
+    async def flaky_update(user_id, status, customer_id, raise_errors=False):
+        if next(failures, False):
+            raise RuntimeError("database blip")
+        profiles.writes.append((user_id, status, customer_id))
+    monkeypatch.setattr(module, "update_subscription_status", flaky_update)
+
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        await queue.submit(subscription_event("evt_1", 100, "active"))
+        await queue.stop()
+        return queue.stats(), queue._timers
+
+    stats, timers = asyncio.run(scenario())
+    assert profiles.writes == [("user-1", "active", "cus_1")]
+    assert (stats["retries"], stats["pending"], timers) == (1, 0, {})
+
+def test_stop_logs_writes_it_could_not_apply(profiles, monkeypatch, caplog):
+    monkeypatch.setattr(module, "WEBHOOK_RETRY_BASE_SECONDS", 60)
+
+    async def scenario():
+        queue = WebhookQueue(enabled=True)
+        await queue.start()
+        profiles.failing = True
+        await queue.submit(subscription_event("evt_1", 100, "active"))
+        await queue.stop()
+        return queue.stats(), await queue.dedupe.first_seen("evt_1")
+
+    stats, resent = asyncio.run(scenario())
+    assert stats["failed"] == 1
+    assert resent
+    assert "resend events evt_1 from Stripe" in caplog.text
@@ -1,10 +1,45 @@
 # This file makes the utils directory a Python package
 # Import and expose modules for easy access
 
-from .openai_client_simple import openai_client
+import os
+import threading
+import logging
+
+from . import openai_client_simple
+
+logger = logging.getLogger(__name__)
+
+# The RAG client (hybrid BM25 + FAISS retrieval with micro-batching, ONNX or
+# torch embeddings, the versioned index from scripts/build_index.py) needs
+# the packages in requirements-minimal.txt and a built index, which the
+# Vercel build doesn't have, so the app uses the plain client unless enabled
+RAG_ENABLED = os.getenv("RAG_ENABLED", "false").lower() == "true"
+
+_rag_client = None
+_rag_unavailable = False
+_rag_lock = threading.Lock()
+
+def get_openai_client():
+    """The shared chat client: the RAG client when RAG_ENABLED, else the plain one"""
+    global _rag_client, _rag_unavailable
+    if RAG_ENABLED and _rag_client is None and not _rag_unavailable:
+        with _rag_lock:
+            if _rag_client is None and not _rag_unavailable:
+                try:
+                    from . import openai_client
+
+                    _rag_client = openai_client.get_openai_client()
+                except Exception as e:
+                    # Missing packages, a missing index or a bad key won't fix
+                    # themselves, so give up on RAG once instead of per request
+                    _rag_unavailable = True
+                    logger.error("RAG_ENABLED is set but the RAG client can't load, answering without retrieval: %s", e)
+    if _rag_client is not None:
+        return _rag_client
+    return openai_client_simple.get_openai_client()
 
 # You can add more imports here as you expand
 # from .database import db_client
 # from .helpers import utility_functions
 
-__all__ = ["openai_client"] 
\ No newline at end of file
+__all__ = ["get_openai_client", "RAG_ENABLED"]
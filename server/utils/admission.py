@@ -0,0 +1,353 @@
+import os
+import math
+import time
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from dotenv import load_dotenv
+import logging
+
+from .auth import get_current_user_optional, get_user_profile
+from .request_log import annotate
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Admission control configuration
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_REDIS_URL = os.getenv("ADMISSION_REDIS_URL")  # Share limits between workers
+ADMISSION_GLOBAL_CONCURRENCY = int(os.getenv("ADMISSION_GLOBAL_CONCURRENCY", "64"))
+ADMISSION_LEASE_SECONDS = int(os.getenv("ADMISSION_LEASE_SECONDS", "300"))  # Redis counters expire if a worker dies
+ADMISSION_BUCKET_SWEEP_SECONDS = float(os.getenv("ADMISSION_BUCKET_SWEEP_SECONDS", "60"))  # Drop refilled in-memory buckets this often
+# Anonymous requests are limited per client IP. X-Forwarded-For is only read
+# behind trusted proxies, since its left-most entries are whatever the client
+# sent; Vercel's edge sets x-real-ip itself, overwriting any client value
+ADMISSION_CLIENT_IP_HEADER = os.getenv("ADMISSION_CLIENT_IP_HEADER", "x-real-ip" if os.getenv("VERCEL") else "").lower()
+ADMISSION_TRUSTED_PROXIES = int(os.getenv("ADMISSION_TRUSTED_PROXIES", "0"))  # Proxies in front of the app that append to X-Forwarded-For
+
+PREMIUM_STATUSES = {"active", "trialing"}
+TIERS = ("anonymous", "free", "premium")
+
+@dataclass(frozen=True)
+class TierPolicy:
+    rate_per_minute: float  # Token bucket refill; 0 means no rate limit
+    burst: int  # Bucket size
+    user_concurrency: int  # In-flight requests per user (or per IP for anonymous)
+    global_share: float  # Share of ADMISSION_GLOBAL_CONCURRENCY this tier may use before it is shed
+
+def _policy(tier: str, rate: str, burst: str, concurrency: str, share: str) -> TierPolicy:
+    prefix = f"ADMISSION_{tier.upper()}"
+    return TierPolicy(
+        rate_per_minute=float(os.getenv(f"{prefix}_RATE_PER_MINUTE", rate)),
+        burst=int(os.getenv(f"{prefix}_BURST", burst)),
+        user_concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+        global_share=float(os.getenv(f"{prefix}_GLOBAL_SHARE", share)),
+    )
+
+# Lower tiers lose access to the shared capacity first, so premium requests
+# keep headroom during spikes. Premium chat is unlimited, but still capped
+# per user to stop a single client from taking every slot.
+TIER_POLICIES: Dict[str, TierPolicy] = {
+    "anonymous": _policy("anonymous", "10", "5", "2", "0.5"),
+    "free": _policy("free", "30", "10", "3", "0.8"),
+    "premium": _policy("premium", "0", "0", "10", "1.0"),
+}
+
+@dataclass
+class Decision:
+    admitted: bool
+    reason: Optional[str] = None  # "shed", "concurrency" or "rate"
+    retry_after: float = 0.0
+
+class InMemoryAdmissionBackend:
+    """
+    Token buckets and in-flight counters for a single worker process.
+
+    A missing bucket is a full one, so buckets that have refilled are
+    dropped every ADMISSION_BUCKET_SWEEP_SECONDS: memory follows the
+    identities seen within one refill period, not every identity ever seen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}  # identity -> (tokens, updated_at, full_at)
+        self._user_inflight: Dict[str, int] = {}
+        self._global_inflight = 0
+        self._swept_at = time.monotonic()
+
+    def _sweep(self, now: float):
+        if now - self._swept_at < ADMISSION_BUCKET_SWEEP_SECONDS:
+            return
+        self._swept_at = now
+        for identity in [identity for identity, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[identity]
+
+    async def admit(self, identity: str, policy: TierPolicy, cost: float) -> Decision:
+        with self._lock:
+            if self._global_inflight >= int(ADMISSION_GLOBAL_CONCURRENCY * policy.global_share):
+                return Decision(False, "shed", 1.0)
+            if self._user_inflight.get(identity, 0) >= policy.user_concurrency:
+                return Decision(False, "concurrency", 1.0)
+
+            if policy.rate_per_minute > 0:
+                rate = policy.rate_per_minute / 60
+                now = time.monotonic()
+                self._sweep(now)
+                tokens, updated_at, _ = self._buckets.get(identity, (float(policy.burst), now, now))
+                tokens = min(float(policy.burst), tokens + (now - updated_at) * rate)
+                cost = min(cost, policy.burst)  # A large batch drains the bucket rather than never fitting
+                if tokens < cost:
+                    self._buckets[identity] = (tokens, now, now + (policy.burst - tokens) / rate)
+                    return Decision(False, "rate", (cost - tokens) / rate)
+                tokens -= cost
+                self._buckets[identity] = (tokens, now, now + (policy.burst - tokens) / rate)
+
+            self._user_inflight[identity] = self._user_inflight.get(identity, 0) + 1
+            self._global_inflight += 1
+            return Decision(True)
+
+    async def release(self, identity: str):
+        with self._lock:
+            remaining = self._user_inflight.get(identity, 0) - 1
+            if remaining > 0:
+                self._user_inflight[identity] = remaining
+            else:
+                self._user_inflight.pop(identity, None)
+            self._global_inflight = max(0, self._global_inflight - 1)
+
+    def in_flight(self) -> int:
+        return self._global_inflight
+
+# KEYS: global in-flight, user in-flight, user bucket
+# ARGV: global limit, user limit, rate per second, burst, cost, now, lease seconds
+_ADMIT_SCRIPT = """
+local global = tonumber(redis.call('GET', KEYS[1]) or '0')
+if global >= tonumber(ARGV[1]) then return {0, 'shed', '1'} end
+local user = tonumber(redis.call('GET', KEYS[2]) or '0')
+if user >= tonumber(ARGV[2]) then return {0, 'concurrency', '1'} end
+
+local rate = tonumber(ARGV[3])
+if rate > 0 then
+    local burst = tonumber(ARGV[4])
+    local cost = math.min(tonumber(ARGV[5]), burst)
+    local now = tonumber(ARGV[6])
+    local bucket = redis.call('HMGET', KEYS[3], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < cost then
+        redis.call('HSET', KEYS[3], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[3], math.ceil(burst / rate) + 1)
+        return {0, 'rate', tostring((cost - tokens) / rate)}
+    end
+    redis.call('HSET', KEYS[3], 'tokens', tokens - cost, 'updated', now)
+    redis.call('EXPIRE', KEYS[3], math.ceil(burst / rate) + 1)
+end
+
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+return {1, '', '0'}
+"""
+
+_RELEASE_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if tonumber(redis.call('GET', key) or '0') > 0 then redis.call('DECR', key) end
+end
+return 1
+"""
+
+class RedisAdmissionBackend:
+    """
+    Limits shared by all workers through Redis.
+
+    Each admission is one atomic Lua script. If Redis is unreachable requests
+    are admitted (fail open) and the error is logged, so a Redis outage
+    never takes chat down.
+    """
+
+    def __init__(self, url: str, prefix: str = "admission"):
+        import redis.asyncio as redis  # Optional dependency, only needed when a shared backend is configured
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self._admit = self.client.register_script(_ADMIT_SCRIPT)
+        self._release = self.client.register_script(_RELEASE_SCRIPT)
+
+    async def admit(self, identity: str, policy: TierPolicy, cost: float) -> Decision:
+        try:
+            admitted, reason, retry_after = await self._admit(
+                keys=[f"{self.prefix}:global", f"{self.prefix}:user:{identity}", f"{self.prefix}:bucket:{identity}"],
+                args=[
+                    int(ADMISSION_GLOBAL_CONCURRENCY * policy.global_share),
+                    policy.user_concurrency,
+                    policy.rate_per_minute / 60,
+                    policy.burst,
+                    cost,
+                    time.time(),
+                    ADMISSION_LEASE_SECONDS,
+                ],
+            )
+        except Exception as e:
+            logger.warning("Redis admission check failed, admitting: %s", e)
+            return Decision(True)
+        reason = reason.decode() if isinstance(reason, bytes) else reason
+        return Decision(bool(admitted), reason or None, float(retry_after))
+
+    async def release(self, identity: str):
+        try:
+            await self._release(keys=[f"{self.prefix}:global", f"{self.prefix}:user:{identity}"])
+        except Exception as e:
+            logger.warning("Redis admission release failed: %s", e)
+
+    def in_flight(self) -> Optional[int]:
+        return None  # Only known to Redis
+
+class Lease:
+    """
+    An admitted request's slot. Released when the request finishes; streaming
+    endpoints hand it to a LeasedStreamingResponse, which releases it when
+    the stream ends instead.
+    """
+
+    def __init__(self, controller: "AdmissionController", identity: str, tier: str):
+        self.controller = controller
+        self.identity = identity
+        self.tier = tier
+        self.detached = False
+        self._released = False
+
+    def detach(self) -> "Lease":
+        self.detached = True
+        return self
+
+    async def release(self):
+        if not self._released:
+            self._released = True
+            await self.controller.backend.release(self.identity)
+
+class LeasedStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that holds an admission lease until it is done.
+
+    The lease is detached from the request only once the response exists,
+    and released however the response ends: completed, failed, cancelled,
+    or abandoned by a client that left before the first byte, in which case
+    the body generator never starts and its own cleanup never runs.
+    """
+
+    def __init__(self, content, lease: Lease, **kwargs):
+        super().__init__(content, **kwargs)
+        self.lease = lease.detach()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.lease.release()
+
+class AdmissionController:
+    """
+    Per-user rate limits and concurrency caps by subscription tier, plus a
+    global concurrency limit that sheds anonymous, then free, requests first.
+    Rejections raise 429 with Retry-After.
+    """
+
+    def __init__(self, backend=None, enabled: bool = ADMISSION_ENABLED):
+        self.enabled = enabled
+        self.backend = backend or InMemoryAdmissionBackend()
+        self.admitted = {tier: 0 for tier in TIERS}
+        self.rejected = {tier: {"shed": 0, "concurrency": 0, "rate": 0} for tier in TIERS}
+
+    async def admit(self, identity: str, tier: str, cost: float = 1.0) -> Lease:
+        lease = Lease(self, identity, tier)
+        if not self.enabled:
+            lease._released = True  # Nothing to release
+            return lease
+
+        decision = await self.backend.admit(identity, TIER_POLICIES[tier], cost)
+        if not decision.admitted:
+            self.rejected[tier][decision.reason] += 1
+            logger.info("Rejected %s request (%s), retry after %.1fs", tier, decision.reason, decision.retry_after)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, please try again shortly" if decision.reason != "rate"
+                else "Rate limit reached for your plan, please try again shortly",
+                headers={"Retry-After": str(max(1, math.ceil(decision.retry_after)))},
+            )
+
+        self.admitted[tier] += 1
+        return lease
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "global_concurrency": ADMISSION_GLOBAL_CONCURRENCY,
+            "in_flight": self.backend.in_flight(),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+def _create_backend():
+    if ADMISSION_REDIS_URL:
+        try:
+            return RedisAdmissionBackend(ADMISSION_REDIS_URL)
+        except Exception as e:
+            logger.error("Could not connect admission backend to Redis, using in-memory limits: %s", e)
+    return InMemoryAdmissionBackend()
+
+# Global instance
+admission = AdmissionController(_create_backend())
+
+def client_ip(request: Request) -> str:
+    """The client address as seen by the first trusted hop"""
+    if ADMISSION_CLIENT_IP_HEADER:
+        value = request.headers.get(ADMISSION_CLIENT_IP_HEADER)
+        if value:
+            return value.split(",")[0].strip()
+    if ADMISSION_TRUSTED_PROXIES > 0:
+        forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if forwarded:
+            # Each trusted proxy appends the address it received from, so
+            # the entry our outermost proxy added is the client
+            return forwarded[-min(ADMISSION_TRUSTED_PROXIES, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+async def resolve_tier(current_user) -> str:
+    if not current_user:
+        return "anonymous"
+    profile = await get_user_profile(current_user.id)
+    if profile and profile.get("subscription_status") in PREMIUM_STATUSES:
+        return "premium"
+    return "free"
+
+async def _admit_request(request: Request, current_user, cost: float):
+    tier = await resolve_tier(current_user)
+    annotate(tier=tier)
+    identity = f"user:{current_user.id}" if current_user else f"ip:{client_ip(request)}"
+    lease = await admission.admit(identity, tier, cost)
+    try:
+        yield lease
+    finally:
+        if not lease.detached:
+            await lease.release()
+
+async def admit_chat(request: Request, current_user = Depends(get_current_user_optional)):
+    """Dependency for chat endpoints: one request, one slot, one token"""
+    async for lease in _admit_request(request, current_user, 1.0):
+        yield lease
+
+async def admit_chat_batch(request: Request, current_user = Depends(get_current_user_optional)):
+    """Dependency for batch chat: one slot, one token per item"""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None  # Left for request validation to reject
+    items = body.get("items") if isinstance(body, dict) else None
+    async for lease in _admit_request(request, current_user, float(len(items) if isinstance(items, list) else 1)):
+        yield lease
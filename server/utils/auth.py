@@ -1,45 +1,237 @@
 import os
-from typing import Optional
+import time
+import json
+import hmac
+import hashlib
+import threading
+import urllib.request
+from typing import TYPE_CHECKING, Optional
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from supabase import create_client, Client
+from pydantic import BaseModel
+from jose import jwt, JWTError
 from dotenv import load_dotenv
 import logging
 
+from .cache import TTLCache, RedisCache
+from .executor import run_blocking, SUPABASE_TIMEOUT
+from .metrics import timed, timed_call
+from .single_flight import SingleFlight
+
+if TYPE_CHECKING:
+    from supabase import Client
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-# Initialize Supabase client
+# Supabase configuration
 supabase_url = os.getenv("SUPABASE_URL")
 supabase_service_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-if not supabase_url or not supabase_service_key:
-    raise ValueError("Missing Supabase environment variables")
+_supabase: Optional["Client"] = None
+_supabase_lock = threading.Lock()
+
+def get_supabase() -> "Client":
+    """
+    Return the shared Supabase client, creating it on first use.
+
+    The SDK is imported here so that importing this module (and the app) does
+    not pay for it until a request actually needs the database.
+    """
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                if not supabase_url or not supabase_service_key:
+                    raise ValueError("Missing Supabase environment variables")
+
+                from supabase import create_client
+                _supabase = create_client(supabase_url, supabase_service_key)
+    return _supabase
+
+# Token verification configuration
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+AUTH_JWKS_URL = os.getenv("AUTH_JWKS_URL", f"{(supabase_url or '').rstrip('/')}/auth/v1/.well-known/jwks.json")
+AUTH_VERIFY_MODE = os.getenv("AUTH_VERIFY_MODE", "local").lower()  # "local" or "remote"
+AUTH_JWT_AUDIENCE = os.getenv("AUTH_JWT_AUDIENCE", "authenticated")
+AUTH_JWKS_REFRESH_SECONDS = int(os.getenv("AUTH_JWKS_REFRESH_SECONDS", "600"))
+AUTH_TOKEN_CACHE_TTL = int(os.getenv("AUTH_TOKEN_CACHE_TTL", "60"))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+# Tokens older than this are re-checked with Supabase, because a logout or ban
+# only takes effect remotely until the token expires. 0 disables the re-check.
+AUTH_REVOCATION_WINDOW = int(os.getenv("AUTH_REVOCATION_WINDOW", "3300"))
 
-supabase: Client = create_client(supabase_url, supabase_service_key)
+# Profile cache configuration
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_REDIS_URL = os.getenv("PROFILE_CACHE_REDIS_URL")
+
+# Operations endpoints (stats, metrics) configuration
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Bearer token for them; they're hidden when unset
 
 # Security scheme
 security = HTTPBearer()
 
+class AuthenticatedUser(BaseModel):
+    id: str
+    email: Optional[str] = None
+    role: Optional[str] = None
+
+class SigningKeyUnavailable(Exception):
+    """Raised when no local key can verify a token"""
+
+class JWKSCache:
+    """
+    Cached Supabase JSON Web Key Set, refreshed periodically and on unknown key IDs
+    """
+
+    MIN_FORCED_REFRESH_INTERVAL = 30
+
+    def __init__(self, url: str, refresh_seconds: int):
+        self.url = url
+        self.refresh_seconds = refresh_seconds
+        self._keys = {}
+        self._fetched_at = 0.0
+        # Requests that find the keys stale together share one fetch
+        self._flights = SingleFlight(enabled=True)
+
+    def _refresh(self):
+        with timed_call("supabase", "jwks"), urllib.request.urlopen(self.url, timeout=5) as response:
+            jwks = json.loads(response.read())
+        self._keys = {key.get("kid"): key for key in jwks.get("keys", [])}
+        self._fetched_at = time.monotonic()
+        logger.info("Loaded %s signing keys from JWKS", len(self._keys))
+
+    async def _refresh_safely(self):
+        try:
+            await run_blocking(self._refresh, timeout=SUPABASE_TIMEOUT)
+        except Exception as e:
+            logger.warning("Could not refresh JWKS: %s", e)
+
+    async def get_key(self, kid: Optional[str]) -> dict:
+        age = time.monotonic() - self._fetched_at
+        if age > self.refresh_seconds:
+            await self._flights.do("jwks", self._refresh_safely)
+        elif kid not in self._keys and age > self.MIN_FORCED_REFRESH_INTERVAL:
+            # The signing key may have been rotated since the last fetch
+            await self._flights.do("jwks", self._refresh_safely)
+
+        key = self._keys.get(kid)
+        if key is None:
+            raise SigningKeyUnavailable(f"No signing key found for kid {kid}")
+        return key
+
+jwks_cache = JWKSCache(AUTH_JWKS_URL, AUTH_JWKS_REFRESH_SECONDS)
+token_cache = TTLCache(maxsize=AUTH_TOKEN_CACHE_SIZE, ttl=AUTH_TOKEN_CACHE_TTL)
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+profile_cache_backend = None
+
+def set_profile_cache_backend(backend):
+    """
+    Plug in a shared cache (get/set/delete) consulted after the in-process profile cache
+    """
+    global profile_cache_backend
+    profile_cache_backend = backend
+
+if PROFILE_CACHE_REDIS_URL:
+    try:
+        set_profile_cache_backend(RedisCache(PROFILE_CACHE_REDIS_URL, prefix="profile", ttl=PROFILE_CACHE_TTL))
+    except Exception as e:
+        logger.warning("Shared profile cache disabled: %s", e)
+
+async def invalidate_user_profile(user_id: str):
+    """
+    Drop a cached profile so the next read goes to Supabase
+    """
+    profile_cache.delete(user_id)
+    if profile_cache_backend is not None:
+        try:
+            await run_blocking(profile_cache_backend.delete, user_id, timeout=SUPABASE_TIMEOUT)
+        except Exception as e:
+            logger.error("Error invalidating shared profile cache: %s", e)
+
+def get_profile_cache_stats() -> dict:
+    stats = {"local": profile_cache.stats()}
+    if profile_cache_backend is not None and hasattr(profile_cache_backend, "stats"):
+        stats["shared"] = profile_cache_backend.stats()
+    return stats
+
+async def _verify_token_locally(token: str) -> dict:
+    """
+    Verify a Supabase-issued JWT's signature, expiry and audience without a network call
+    """
+    header = jwt.get_unverified_header(token)
+    algorithm = header.get("alg")
+
+    if algorithm == "HS256":
+        if not SUPABASE_JWT_SECRET:
+            raise SigningKeyUnavailable("SUPABASE_JWT_SECRET is not set")
+        key = SUPABASE_JWT_SECRET
+    elif algorithm in ("RS256", "ES256"):
+        key = await jwks_cache.get_key(header.get("kid"))
+    else:
+        raise JWTError(f"Unsupported token algorithm: {algorithm}")
+
+    return jwt.decode(token, key, algorithms=[algorithm], audience=AUTH_JWT_AUDIENCE)
+
+def _verify_token_remotely(token: str) -> AuthenticatedUser:
+    """
+    Verify the token with Supabase
+    """
+    with timed_call("supabase", "auth.get_user"):
+        user = get_supabase().auth.get_user(token)
+    if not user.user:
+        raise JWTError("Supabase rejected the token")
+
+    return AuthenticatedUser(id=user.user.id, email=user.user.email, role=user.user.role)
+
+def _in_revocation_window(claims: dict) -> bool:
+    if not AUTH_REVOCATION_WINDOW or "iat" not in claims:
+        return False
+    return time.time() - claims["iat"] > AUTH_REVOCATION_WINDOW
+
+async def verify_token(token: str) -> AuthenticatedUser:
+    """
+    Resolve a bearer token to a user, using the verified-token cache when possible
+    """
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    user = token_cache.get(cache_key)
+    if user is not None:
+        return user
+
+    ttl = AUTH_TOKEN_CACHE_TTL
+    if AUTH_VERIFY_MODE == "local":
+        try:
+            claims = await _verify_token_locally(token)
+        except SigningKeyUnavailable as e:
+            logger.warning("Local token verification unavailable, using Supabase: %s", e)
+            claims = None
+
+        if claims is None or _in_revocation_window(claims):
+            user = await run_blocking(_verify_token_remotely, token, timeout=SUPABASE_TIMEOUT)
+        else:
+            user = AuthenticatedUser(id=claims["sub"], email=claims.get("email"), role=claims.get("role"))
+
+        if claims is not None and "exp" in claims:
+            # Never cache a user past the token's own expiry
+            ttl = min(ttl, max(0, claims["exp"] - time.time()))
+    else:
+        user = await run_blocking(_verify_token_remotely, token, timeout=SUPABASE_TIMEOUT)
+
+    if ttl > 0:
+        token_cache.set(cache_key, user, ttl=ttl)
+    return user
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """
     Validate JWT token and return user information
     """
     try:
-        # Verify the token with Supabase
-        user = supabase.auth.get_user(credentials.credentials)
-        
-        if not user.user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        return user.user
+        with timed(stage="auth"):
+            return await verify_token(credentials.credentials)
     except Exception as e:
-        logger.error(f"Authentication error: {str(e)}")
+        logger.error("Authentication error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
@@ -60,7 +252,23 @@ async def get_current_user_optional(
     except HTTPException:
         return None
 
-def create_user_profile(user_id: str, email: str, full_name: Optional[str] = None):
+async def require_admin(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))
+):
+    """
+    Allow only callers presenting ADMIN_TOKEN, for endpoints exposing
+    internal counters
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not credentials or not hmac.compare_digest(credentials.credentials.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+async def create_user_profile(user_id: str, email: str, full_name: Optional[str] = None):
     """
     Create a user profile in the profiles table
     """
@@ -73,34 +281,94 @@ def create_user_profile(user_id: str, email: str, full_name: Optional[str] = Non
             "created_at": "now()"
         }
         
-        result = supabase.table("profiles").insert(profile_data).execute()
+        with timed_call("supabase", "profiles.insert"):
+            result = await run_blocking(
+                get_supabase().table("profiles").insert(profile_data).execute,
+                timeout=SUPABASE_TIMEOUT
+            )
+        await invalidate_user_profile(user_id)
         return result.data[0] if result.data else None
     except Exception as e:
-        logger.error(f"Error creating user profile: {str(e)}")
+        logger.error("Error creating user profile: %s", e)
+        return None
+
+async def get_user_profile(user_id: str):
+    """
+    Get user profile by ID, served from the profile cache when possible
+    """
+    with timed(stage="profile"):
+        return await _get_user_profile(user_id)
+
+async def _get_user_profile(user_id: str):
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+
+    try:
+        if profile_cache_backend is not None:
+            profile = await run_blocking(profile_cache_backend.get, user_id, timeout=SUPABASE_TIMEOUT)
+            if profile is not None:
+                profile_cache.set(user_id, profile)
+                return profile
+
+        with timed_call("supabase", "profiles.select"):
+            result = await run_blocking(
+                get_supabase().table("profiles").select("*").eq("id", user_id).execute,
+                timeout=SUPABASE_TIMEOUT
+            )
+        profile = result.data[0] if result.data else None
+        if profile is not None:
+            profile_cache.set(user_id, profile)
+            if profile_cache_backend is not None:
+                await run_blocking(profile_cache_backend.set, user_id, profile, timeout=SUPABASE_TIMEOUT)
+        return profile
+    except Exception as e:
+        logger.error("Error fetching user profile: %s", e)
         return None
 
-def get_user_profile(user_id: str):
+async def set_stripe_customer_id(user_id: str, stripe_customer_id: str):
     """
-    Get user profile by ID
+    Record a user's Stripe customer, leaving their subscription status alone
     """
     try:
-        result = supabase.table("profiles").select("*").eq("id", user_id).execute()
+        with timed_call("supabase", "profiles.update"):
+            result = await run_blocking(
+                get_supabase().table("profiles").update({"stripe_customer_id": stripe_customer_id}).eq("id", user_id).execute,
+                timeout=SUPABASE_TIMEOUT
+            )
         return result.data[0] if result.data else None
     except Exception as e:
-        logger.error(f"Error fetching user profile: {str(e)}")
+        logger.error("Error saving Stripe customer ID: %s", e)
         return None
+    finally:
+        await invalidate_user_profile(user_id)
 
-def update_subscription_status(user_id: str, subscription_status: str, stripe_customer_id: Optional[str] = None):
+async def update_subscription_status(
+    user_id: str,
+    subscription_status: str,
+    stripe_customer_id: Optional[str] = None,
+    raise_errors: bool = False
+):
     """
-    Update user's subscription status
+    Update user's subscription status. Errors are logged and None returned,
+    unless raise_errors is set (the webhook queue retries them).
     """
     try:
         update_data = {"subscription_status": subscription_status}
         if stripe_customer_id:
             update_data["stripe_customer_id"] = stripe_customer_id
             
-        result = supabase.table("profiles").update(update_data).eq("id", user_id).execute()
+        with timed_call("supabase", "profiles.update"):
+            result = await run_blocking(
+                get_supabase().table("profiles").update(update_data).eq("id", user_id).execute,
+                timeout=SUPABASE_TIMEOUT
+            )
         return result.data[0] if result.data else None
     except Exception as e:
-        logger.error(f"Error updating subscription status: {str(e)}")
-        return None 
\ No newline at end of file
+        logger.error("Error updating subscription status: %s", e)
+        if raise_errors:
+            raise
+        return None
+    finally:
+        # Webhooks and checkout rely on this to make subscription changes visible immediately
+        await invalidate_user_profile(user_id) 
\ No newline at end of file
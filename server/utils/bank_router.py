@@ -0,0 +1,243 @@
+import os
+import re
+import zlib
+import random
+from dataclasses import dataclass
+from typing import Any, Collection, Dict, FrozenSet, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+import logging
+
+from .lexical import tokenize
+from .metrics import timed
+from .question_bank import question_bank
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Bank routing configuration
+BANK_ROUTING_ENABLED = os.getenv("BANK_ROUTING_ENABLED", "true").lower() == "true"
+BANK_MATCH_THRESHOLD = float(os.getenv("BANK_MATCH_THRESHOLD", "0.85"))  # Lowest confidence answered from the bank
+BANK_AMBIGUITY_MARGIN = float(os.getenv("BANK_AMBIGUITY_MARGIN", "0.05"))  # Two items this close go to the LLM
+BANK_ID_MAX_EXTRA_TOKENS = int(os.getenv("BANK_ID_MAX_EXTRA_TOKENS", "8"))  # Longer messages are asking more than "explain qr_1"
+BANK_SHINGLE_SIZE = int(os.getenv("BANK_SHINGLE_SIZE", "3"))
+BANK_MINHASH_PERMUTATIONS = int(os.getenv("BANK_MINHASH_PERMUTATIONS", "64"))
+BANK_LSH_BANDS = int(os.getenv("BANK_LSH_BANDS", "32"))  # More bands find less similar candidates
+
+DEPTHS = ("basic", "detailed")
+
+# Words that ask for a question's explanation. A message naming an ID is
+# only answered from the bank if every other word is one of these, so
+# "is the answer to qr_1 wrong? I think it's B" still reaches the LLM
+EXPLAIN_INTENT = frozenset("""
+explain explanation explaining help solve solution solutions solving work working worked walk through show answer
+question please pls thanks step steps hint how get understand stuck go over tell give see q number
+don t m ll ve re s d
+""".split())
+
+_ID_MENTION = re.compile(r"\b[a-z]+(?:[_-][a-z0-9]+)*[_-][a-z]*\d+\b")
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(1729)  # Fixed so signatures are stable between processes
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE)) for _ in range(BANK_MINHASH_PERMUTATIONS)
+]
+
+def shingles(tokens: List[str], size: int = BANK_SHINGLE_SIZE) -> FrozenSet[str]:
+    """Overlapping word n-grams; texts shorter than one n-gram are a single shingle"""
+    if len(tokens) <= size:
+        return frozenset([" ".join(tokens)]) if tokens else frozenset()
+    return frozenset(" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1))
+
+def minhash(items: FrozenSet[str]) -> Tuple[int, ...]:
+    hashes = [zlib.crc32(item.encode("utf-8")) for item in items]
+    return tuple(min((a * h + b) % _MERSENNE for h in hashes) for a, b in _PERMUTATIONS)
+
+def containment(part: FrozenSet[str], whole: FrozenSet[str]) -> float:
+    """Share of part found in whole"""
+    return len(part & whole) / len(part) if part else 0.0
+
+def bank_answer(question: Dict[str, Any], depth: str = "detailed") -> Optional[str]:
+    """The stored explanation at depth (or the other depth if it has none), with the answer"""
+    explanations = question.get("explanations") or {}
+    explanation = explanations.get(depth) or next(
+        (explanations.get(other) for other in DEPTHS if explanations.get(other)), None
+    )
+    if not explanation:
+        return None
+    if question.get("correct_answer"):
+        return f"**Answer: {question['correct_answer']}**\n\n{explanation}"
+    return explanation
+
+@dataclass
+class BankMatch:
+    question_id: str
+    confidence: float
+    method: str  # "id" or "text"
+
+@dataclass
+class _Fingerprint:
+    question_id: str
+    parts: List[FrozenSet[str]]  # Shingles of the question, and of its passage if it has one
+    vocabulary: Set[str]  # Every token of the item, options included
+
+class _BankIndex:
+    """MinHash LSH over the shingles of every question (with its passage) in a bank snapshot"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.fingerprints: List[_Fingerprint] = []
+        rows = max(1, BANK_MINHASH_PERMUTATIONS // BANK_LSH_BANDS)
+        self.bands = [(start, start + rows) for start in range(0, BANK_MINHASH_PERMUTATIONS - rows + 1, rows)]
+        self.buckets: List[Dict[Tuple[int, ...], List[int]]] = [{} for _ in self.bands]
+
+        for question in snapshot.questions.values():
+            passage = snapshot.passages.get(question.get("passage_id")) or {}
+            question_tokens = tokenize(question.get("question_text") or "")
+            passage_tokens = tokenize(passage.get("passage_text") or "")
+            parts = [part for part in (shingles(question_tokens), shingles(passage_tokens)) if part]
+            if not parts or not bank_answer(question):
+                continue
+            option_tokens = [token for option in question.get("options", []) for token in tokenize(str(option))]
+            row = len(self.fingerprints)
+            self.fingerprints.append(_Fingerprint(
+                question_id=question["id"],
+                parts=parts,
+                vocabulary=set(question_tokens + passage_tokens + option_tokens),
+            ))
+            signature = minhash(frozenset().union(*parts))
+            for buckets, (start, end) in zip(self.buckets, self.bands):
+                buckets.setdefault(signature[start:end], []).append(row)
+
+    def candidates(self, message_shingles: FrozenSet[str]) -> Set[int]:
+        signature = minhash(message_shingles)
+        rows = set()
+        for buckets, (start, end) in zip(self.buckets, self.bands):
+            rows.update(buckets.get(signature[start:end], ()))
+        return rows
+
+class BankRouter:
+    """
+    Answers chat messages about known question bank items from their stored
+    explanations, without calling the LLM.
+
+    A message is routed when it names exactly one question ID and otherwise
+    only asks for an explanation ("explain qr_1", "help with question qr_1"),
+    or when it is a near-duplicate of a question's text and passage.
+    Near-duplicates are found with MinHash LSH over word shingles, then
+    verified exactly: confidence is the lowest of how much of
+    the question and of its passage appear in the message, and how much of
+    the message is made of the item's words, so a pasted question with a
+    different request around it still goes to the LLM. Matches below
+    BANK_MATCH_THRESHOLD, or within BANK_AMBIGUITY_MARGIN of a match on
+    another item, are left to the LLM too, as are questions the conversation
+    has already covered: a follow-up about them needs the LLM, which sees the
+    stored explanation in the history.
+    """
+
+    def __init__(self, bank=question_bank, enabled: bool = BANK_ROUTING_ENABLED):
+        self.bank = bank
+        self.enabled = enabled
+        self._index: Optional[_BankIndex] = None
+        self.checked = 0
+        self.routed = {"id": 0, "text": 0}
+        self.ambiguous = 0
+        self.follow_ups = 0
+
+    def _current_index(self) -> _BankIndex:
+        snapshot = self.bank.snapshot
+        if self._index is None or self._index.snapshot is not snapshot:
+            # Rebuilt after the question bank reloads
+            self._index = _BankIndex(snapshot)
+            logger.info("Built bank routing index over %s questions", len(self._index.fingerprints))
+        return self._index
+
+    def match(self, message: str, covered: Collection[str] = ()) -> Optional[BankMatch]:
+        """The bank question the message is about, if one is clear enough and not among those already covered"""
+        if not self.enabled or not message:
+            return None
+        self.checked += 1
+        with timed(stage="bank_routing"):
+            index = self._current_index()
+            found = self._match_id(message, index) or self._match_text(message, index)
+        if found is None:
+            return None
+        if found.question_id in covered:
+            self.follow_ups += 1
+            return None
+        self.routed[found.method] += 1
+        return found
+
+    def mentions(self, message: str) -> Set[str]:
+        """IDs in the message, normalized; callers check them against the bank"""
+        return {mention.replace("-", "_") for mention in _ID_MENTION.findall(message.lower())}
+
+    def topics(self, message: str, match: Optional[BankMatch] = None) -> List[str]:
+        """The bank questions a turn is about: those it names, and the one it matched"""
+        topics = sorted(self.mentions(message) & self.bank.snapshot.questions.keys()) if self.enabled and message else []
+        if match is not None and match.question_id not in topics:
+            topics.append(match.question_id)
+        return topics
+
+    def _match_id(self, message: str, index: _BankIndex) -> Optional[BankMatch]:
+        lowered = message.lower()
+        mentions = self.mentions(message)
+        if len(mentions & index.snapshot.questions.keys()) > 1:
+            self.ambiguous += 1
+        # Unknown IDs (passages, typos) are left to the LLM along with everything else
+        if len(mentions) != 1 or not mentions <= index.snapshot.questions.keys():
+            return None
+        question_id = mentions.pop()
+        extra = tokenize(_ID_MENTION.sub(" ", lowered))
+        if len(extra) > BANK_ID_MAX_EXTRA_TOKENS or not EXPLAIN_INTENT.issuperset(extra):
+            return None
+        if not bank_answer(index.snapshot.questions[question_id]):
+            return None
+        return BankMatch(question_id=question_id, confidence=1.0, method="id")
+
+    def _match_text(self, message: str, index: _BankIndex) -> Optional[BankMatch]:
+        tokens = tokenize(message)
+        if len(tokens) < BANK_SHINGLE_SIZE:
+            return None
+        message_shingles = shingles(tokens)
+
+        scored = []
+        for row in index.candidates(message_shingles):
+            fingerprint = index.fingerprints[row]
+            coverage = sum(token in fingerprint.vocabulary for token in tokens) / len(tokens)
+            confidence = min([coverage] + [containment(part, message_shingles) for part in fingerprint.parts])
+            scored.append((confidence, fingerprint.question_id))
+        if not scored:
+            return None
+
+        scored.sort(reverse=True)
+        confidence, question_id = scored[0]
+        if confidence < BANK_MATCH_THRESHOLD:
+            return None
+        if len(scored) > 1 and confidence - scored[1][0] < BANK_AMBIGUITY_MARGIN:
+            self.ambiguous += 1
+            return None
+        return BankMatch(question_id=question_id, confidence=round(confidence, 3), method="text")
+
+    def answer(self, message: str, depth: str = "detailed", covered: Collection[str] = ()) -> Optional[Tuple[BankMatch, str]]:
+        """The match and its stored answer at depth, or None to ask the LLM"""
+        found = self.match(message, covered)
+        if found is None:
+            return None
+        question = self.bank.get_question(found.question_id)
+        answer = bank_answer(question, depth) if question else None
+        if answer is None:
+            return None
+        return found, answer
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "indexed": len(self._index.fingerprints) if self._index else 0,
+            "checked": self.checked,
+            "routed": dict(self.routed),
+            "ambiguous": self.ambiguous,
+            "follow_ups": self.follow_ups,
+        }
+
+# Global instance
+bank_router = BankRouter()
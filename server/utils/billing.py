@@ -0,0 +1,138 @@
+import os
+import asyncio
+import hashlib
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+import logging
+
+from .auth import set_stripe_customer_id
+from .cache import TTLCache
+from .stripe_client import get_stripe_client, SUBSCRIPTION_PLANS
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Checkout configuration
+CHECKOUT_DEADLINE_SECONDS = float(os.getenv("CHECKOUT_DEADLINE_SECONDS", "8"))  # Checkout answers 504 after this
+CUSTOMER_PREPROVISION_ENABLED = os.getenv("CUSTOMER_PREPROVISION_ENABLED", "true").lower() == "true"
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "3600"))
+
+_price_cache = TTLCache(maxsize=32, ttl=PRICE_CACHE_TTL)
+
+async def resolve_price_id(plan: str) -> Optional[str]:
+    """
+    The Stripe price for a plan. Plans configured with a lookup key rather
+    than a price ID are resolved once and cached for PRICE_CACHE_TTL, so a
+    price can be swapped in the Stripe dashboard without a redeploy.
+    """
+    configured = SUBSCRIPTION_PLANS[plan]["price_id"]
+    if not configured or configured.startswith("price_"):
+        return configured
+
+    price_id = _price_cache.get(configured)
+    if price_id is None:
+        price_id = await get_stripe_client().get_price_id(configured)
+        if price_id:
+            _price_cache.set(configured, price_id)
+    return price_id
+
+def customer_idempotency_key(user_id: str, email: str, name: Optional[str]) -> str:
+    """
+    Stripe rejects a reused key sent with different parameters, so the key
+    covers them: a changed email or name makes a fresh request, not a 400
+    """
+    digest = hashlib.sha256(f"{email}\x1f{name or ''}".encode("utf-8")).hexdigest()[:16]
+    return f"customer-{user_id}-{digest}"
+
+class CustomerProvisioner:
+    """
+    Creates Stripe customers ahead of checkout.
+
+    A user's customer is created in the background once they show intent to
+    check out (POST /api/checkout/prepare), so checkout usually finds the ID
+    already saved. Concurrent requests for the same user share one creation.
+    Before creating, Stripe is searched for a customer already tagged with
+    the user's ID, which covers a profile write that never landed. The
+    idempotency key covers what search can't see yet: retries and other
+    workers within Stripe's 24 hours get the same customer back, not a
+    duplicate.
+    """
+
+    def __init__(self, enabled: bool = CUSTOMER_PREPROVISION_ENABLED):
+        self.enabled = enabled
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._background = set()  # Keeps fire-and-forget tasks from being garbage collected
+        self.created = 0
+        self.found = 0
+        self.prefetched = 0
+        self.failures = 0
+
+    def _spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def ensure(self, user_id: str, email: str, name: Optional[str] = None) -> str:
+        """The user's Stripe customer ID, creating the customer if needed"""
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = self._spawn(self._create(user_id, email, name))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        # Shielded so a checkout hitting its deadline doesn't abandon a half-made customer
+        return await asyncio.shield(task)
+
+    async def _create(self, user_id: str, email: str, name: Optional[str]) -> str:
+        stripe_client = get_stripe_client()
+        try:
+            customer = await stripe_client.find_customer(user_id)
+        except Exception:
+            customer = None  # Search is only a guard; the idempotency key still prevents duplicates
+        try:
+            if customer is not None:
+                self.found += 1
+                logger.info("Found existing Stripe customer %s for user %s", customer.id, user_id)
+            else:
+                customer = await stripe_client.create_customer(
+                    email=email,
+                    name=name,
+                    user_id=user_id,
+                    idempotency_key=customer_idempotency_key(user_id, email, name)
+                )
+                self.created += 1
+        except Exception:
+            self.failures += 1
+            raise
+        self._spawn(set_stripe_customer_id(user_id, customer.id))
+        return customer.id
+
+    def prefetch(self, user_id: str, email: Optional[str], profile: Optional[Dict[str, Any]]):
+        """On checkout intent: start creating the customer in the background if the profile has none"""
+        if not self.enabled or not email or not profile or profile.get("stripe_customer_id"):
+            return
+        if user_id in self._inflight:
+            return
+        self.prefetched += 1
+        self._spawn(self._prefetch(user_id, email, profile.get("full_name")))
+
+    async def _prefetch(self, user_id: str, email: str, name: Optional[str]):
+        try:
+            await self.ensure(user_id, email, name)
+        except Exception as e:
+            logger.warning("Pre-provisioning Stripe customer for user %s failed: %s", user_id, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._inflight),
+            "created": self.created,
+            "found": self.found,
+            "prefetched": self.prefetched,
+            "failures": self.failures,
+            "prices": _price_cache.stats(),
+        }
+
+# Global instance
+customers = CustomerProvisioner()
@@ -0,0 +1,344 @@
+import os
+import re
+import json
+import uuid
+import asyncio
+from typing import Any, Callable, Collection, Dict, List, Optional
+from dotenv import load_dotenv
+import logging
+
+from .cache import TTLCache
+from .http_session import get_http_session
+from .prompt_builder import count_tokens, truncate_tokens
+from .metrics import timed, record_upstream_error, record_token_usage
+from .request_log import annotate
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Conversation configuration
+CONVERSATIONS_ENABLED = os.getenv("CONVERSATIONS_ENABLED", "true").lower() == "true"
+CONVERSATION_REDIS_URL = os.getenv("CONVERSATION_REDIS_URL")  # Share sessions between workers
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "86400"))  # Idle sessions expire
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000"))  # In-memory backend only
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "3"))  # Always sent verbatim
+CONVERSATION_SUMMARY_TRIGGER_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TRIGGER_TOKENS", "1000"))
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "250"))
+CONVERSATION_SUMMARY_MODEL = os.getenv("CONVERSATION_SUMMARY_MODEL")  # Defaults to the chat model
+# Background tasks don't outlive the response on Vercel, so summarize before returning there
+CONVERSATION_SUMMARIZE_INLINE = os.getenv(
+    "CONVERSATION_SUMMARIZE_INLINE", "true" if os.getenv("VERCEL") else "false"
+).lower() == "true"
+
+SUMMARY_PROMPT = (
+    "You keep notes on a tutoring conversation between a UKCAT student and an assistant. "
+    "Update the notes with the new turns. Keep the topics covered, what the student finds "
+    "difficult, any figures or answers they may refer back to and preferences they stated. "
+    "Reply with the updated notes only, in at most {words} words."
+)
+
+# Each folded message is cut to this before summarization, so one long
+# answer can't blow up the summarizer's input
+SUMMARY_INPUT_TOKENS_PER_MESSAGE = 300
+
+_VALID_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+NEW_SESSION = "new"  # Sent as the session ID to start a conversation
+
+class Conversation:
+    """
+    A session's rolling summary plus the turns not yet folded into it.
+
+    Turns are stored as [message, answer] pairs; folded counts the turns
+    already covered by the summary. Topics are the question bank IDs the
+    conversation has been about, kept when their turns are folded.
+    """
+
+    __slots__ = ("session_id", "owner", "summary", "turns", "folded", "topics")
+
+    def __init__(self, session_id: str, owner: Optional[str], summary: str = "", turns=None, folded: int = 0, topics=None):
+        self.session_id = session_id
+        self.owner = owner
+        self.summary = summary
+        self.turns: List[List[str]] = turns or []
+        self.folded = folded
+        self.topics: List[str] = topics or []
+
+    @classmethod
+    def from_dict(cls, session_id: str, data: Dict[str, Any]) -> "Conversation":
+        return cls(
+            session_id,
+            data.get("owner"),
+            data.get("summary", ""),
+            [list(turn) for turn in data.get("turns", [])],
+            data.get("folded", 0),
+            list(data.get("topics", [])),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"owner": self.owner, "summary": self.summary, "turns": self.turns, "folded": self.folded, "topics": self.topics}
+
+    def render(self) -> str:
+        """The history as prompt context: the summary, then the recent turns verbatim"""
+        sections = []
+        if self.summary:
+            sections.append(f"Earlier in this conversation:\n{self.summary}")
+        if self.turns:
+            sections.append("Recent conversation:\n\n" + "\n\n".join(
+                f"Student: {message}\nAssistant: {answer}" for message, answer in self.turns
+            ))
+        return "\n\n".join(sections)
+
+    def foldable(self, model: str) -> int:
+        """How many of the oldest turns to summarize, 0 while under the token threshold"""
+        if len(self.turns) <= CONVERSATION_RECENT_TURNS:
+            return 0
+        tokens = sum(count_tokens(message, model) + count_tokens(answer, model) for message, answer in self.turns)
+        if tokens <= CONVERSATION_SUMMARY_TRIGGER_TOKENS:
+            return 0
+        return len(self.turns) - CONVERSATION_RECENT_TURNS
+
+class InMemoryConversationBackend:
+    """Sessions for a single worker process, evicted least recently used first"""
+
+    def __init__(self, maxsize: int = CONVERSATION_MAX_SESSIONS, ttl: float = CONVERSATION_TTL):
+        self.sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.sessions.get(session_id)
+
+    async def update(self, session_id: str, mutate: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        # No await between read and write, so this is atomic on the event loop
+        data = mutate(self.sessions.get(session_id))
+        if data is not None:
+            self.sessions.set(session_id, data)
+        return data
+
+    async def delete(self, session_id: str) -> bool:
+        return self.sessions.delete(session_id)
+
+    def size(self) -> Optional[int]:
+        return len(self.sessions)
+
+class RedisConversationBackend:
+    """
+    Sessions shared by all workers through Redis, as JSON with a sliding TTL.
+
+    Updates are optimistic transactions (WATCH/MULTI), so a turn appended by
+    one worker is never lost to a summary written by another. Errors are
+    logged and the conversation carries on without history.
+    """
+
+    def __init__(self, url: str, prefix: str = "conversation", ttl: int = CONVERSATION_TTL):
+        import redis.asyncio as redis  # Optional dependency, only needed when a shared backend is configured
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:{session_id}"
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = await self.client.get(self._key(session_id))
+        except Exception as e:
+            logger.warning("Redis conversation get failed: %s", e)
+            return None
+        return json.loads(raw) if raw else None
+
+    async def update(self, session_id: str, mutate: Callable[[Optional[Dict]], Optional[Dict]]) -> Optional[Dict]:
+        from redis.exceptions import WatchError
+
+        key = self._key(session_id)
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                while True:
+                    try:
+                        await pipe.watch(key)
+                        raw = await pipe.get(key)
+                        data = mutate(json.loads(raw) if raw else None)
+                        if data is None:
+                            await pipe.unwatch()
+                            return None
+                        pipe.multi()
+                        pipe.set(key, json.dumps(data, separators=(",", ":")), ex=self.ttl)
+                        await pipe.execute()
+                        return data
+                    except WatchError:
+                        continue  # Changed by another worker, retry on the new value
+        except Exception as e:
+            logger.warning("Redis conversation update failed: %s", e)
+            return None
+
+    async def delete(self, session_id: str) -> bool:
+        try:
+            return bool(await self.client.delete(self._key(session_id)))
+        except Exception as e:
+            logger.warning("Redis conversation delete failed: %s", e)
+            return False
+
+    def size(self) -> Optional[int]:
+        return None  # Only known to Redis
+
+async def summarize_turns(client, summary: str, turns: List[List[str]]) -> str:
+    """Fold turns into the running summary with one small completion"""
+    model = CONVERSATION_SUMMARY_MODEL or client.model
+    transcript = "\n\n".join(
+        f"Student: {truncate_tokens(message, SUMMARY_INPUT_TOKENS_PER_MESSAGE, model)}\n"
+        f"Assistant: {truncate_tokens(answer, SUMMARY_INPUT_TOKENS_PER_MESSAGE, model)}"
+        for message, answer in turns
+    )
+    words = int(CONVERSATION_SUMMARY_MAX_TOKENS * 0.75)
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT.format(words=words)},
+        {"role": "user", "content": f"Notes so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": CONVERSATION_SUMMARY_MAX_TOKENS,
+        "temperature": 0,
+        "stream": False
+    }
+    headers = {
+        "Authorization": f"Bearer {client.api_key}",
+        "Content-Type": "application/json"
+    }
+
+    try:
+        session = await get_http_session()
+        with timed(stage="summarization"):
+            async with session.post(client.api_base, headers=headers, json=payload) as response:
+                response.raise_for_status()
+                result = await response.json()
+    except Exception as e:
+        record_upstream_error(e)
+        raise
+    usage = result.get("usage") or {}
+    record_token_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    return result["choices"][0]["message"]["content"].strip()
+
+class ConversationStore:
+    """
+    Server-side chat sessions with rolling summarization.
+
+    Each turn is appended verbatim. Once the verbatim turns pass
+    CONVERSATION_SUMMARY_TRIGGER_TOKENS, all but the last
+    CONVERSATION_RECENT_TURNS are folded into the summary by one small
+    completion that sees only the previous summary and the folded turns.
+    Prompts carry the summary and the recent turns, so their size, and the
+    cost of a turn, stays flat however long the conversation runs.
+    Summarization runs after the response unless CONVERSATION_SUMMARIZE_INLINE
+    is set; if it fails the turns stay verbatim and it is retried next turn.
+    """
+
+    def __init__(self, backend=None, enabled: bool = CONVERSATIONS_ENABLED):
+        self.enabled = enabled
+        self.backend = backend or InMemoryConversationBackend()
+        self._summarizing = set()  # Session IDs with a summary in progress in this worker
+        self._tasks = set()  # Keeps background summaries from being garbage collected
+        self.summaries = 0
+        self.summary_failures = 0
+
+    async def load(self, session_id: Optional[str], owner: Optional[str]) -> Optional[Conversation]:
+        """
+        The caller's conversation, or a new one if the ID is NEW_SESSION, unknown,
+        expired or belongs to someone else. None when conversations are
+        disabled or the client sent no ID, so one-off chats store nothing.
+        """
+        if not self.enabled or not session_id:
+            return None
+        if session_id and _VALID_SESSION_ID.match(session_id):
+            data = await self.backend.get(session_id)
+            if data is not None and data.get("owner") == owner:
+                conversation = Conversation.from_dict(session_id, data)
+                annotate(session_id=session_id, conversation_turns=conversation.folded + len(conversation.turns))
+                return conversation
+        conversation = Conversation(uuid.uuid4().hex, owner)
+        annotate(session_id=conversation.session_id, conversation_turns=0)
+        return conversation
+
+    async def get(self, session_id: str, owner: Optional[str]) -> Optional[Conversation]:
+        if not self.enabled or not _VALID_SESSION_ID.match(session_id):
+            return None
+        data = await self.backend.get(session_id)
+        if data is None or data.get("owner") != owner:
+            return None
+        return Conversation.from_dict(session_id, data)
+
+    async def delete(self, session_id: str, owner: Optional[str]) -> bool:
+        if await self.get(session_id, owner) is None:
+            return False
+        return await self.backend.delete(session_id)
+
+    async def record_turn(self, conversation: Optional[Conversation], message: str, answer: str, client, topics: Collection[str] = ()):
+        """Append a finished turn about the given question bank topics, and fold older turns into the summary if due"""
+        if conversation is None:
+            return
+
+        def append(data):
+            current = Conversation.from_dict(conversation.session_id, data) if data else Conversation(conversation.session_id, conversation.owner)
+            current.turns.append([message, answer])
+            current.topics.extend(topic for topic in topics if topic not in current.topics)
+            return current.to_dict()
+
+        data = await self.backend.update(conversation.session_id, append)
+        if data is None:
+            return
+        current = Conversation.from_dict(conversation.session_id, data)
+        if current.foldable(client.model) and not getattr(client, "demo_mode", False):
+            if CONVERSATION_SUMMARIZE_INLINE:
+                await self._summarize(current, client)
+            elif current.session_id not in self._summarizing:
+                task = asyncio.create_task(self._summarize(current, client))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, conversation: Conversation, client):
+        if conversation.session_id in self._summarizing:
+            return
+        self._summarizing.add(conversation.session_id)
+        try:
+            count = conversation.foldable(client.model)
+            try:
+                summary = await summarize_turns(client, conversation.summary, conversation.turns[:count])
+            except Exception as e:
+                self.summary_failures += 1
+                logger.warning("Summarizing conversation %s failed, keeping turns verbatim: %s", conversation.session_id, e)
+                return
+
+            def fold(data):
+                # Skip if another worker folded these turns first
+                if data is None or data.get("folded", 0) != conversation.folded:
+                    return None
+                current = Conversation.from_dict(conversation.session_id, data)
+                current.summary = summary
+                current.turns = current.turns[count:]
+                current.folded += count
+                return current.to_dict()
+
+            if await self.backend.update(conversation.session_id, fold) is not None:
+                self.summaries += 1
+        finally:
+            self._summarizing.discard(conversation.session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "sessions": self.backend.size(),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+        }
+
+def _create_backend():
+    if CONVERSATION_REDIS_URL:
+        try:
+            return RedisConversationBackend(CONVERSATION_REDIS_URL)
+        except Exception as e:
+            logger.error("Could not connect conversation store to Redis, keeping sessions in memory: %s", e)
+    return InMemoryConversationBackend()
+
+# Global instance
+conversations = ConversationStore(_create_backend())
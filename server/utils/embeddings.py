@@ -0,0 +1,161 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+import logging
+
+from .cache import TTLCache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Embedding backend configuration
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()  # "torch" or "onnx"
+EMBEDDING_ONNX_DIR = os.getenv(
+    "EMBEDDING_ONNX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "onnx", EMBEDDING_MODEL)
+)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "model_int8.onnx")
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))  # 0 lets onnxruntime decide
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "256"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key for a text. The model is uncased and its tokenizer ignores
+    runs of whitespace, so texts with the same key embed identically.
+    """
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+class OnnxEmbeddings:
+    """
+    Sentence embeddings from an exported (and usually int8-quantized) ONNX
+    graph of the sentence-transformers model.
+
+    Reproduces the sentence-transformers pipeline for all-MiniLM-L6-v2:
+    tokenize, run the transformer, mean-pool over the attention mask and
+    L2-normalize. Only onnxruntime and tokenizers are needed at runtime, not
+    PyTorch. Create the model files with scripts/export_onnx_embeddings.py.
+    """
+
+    def __init__(
+        self,
+        model_dir: str = EMBEDDING_ONNX_DIR,
+        model_file: str = EMBEDDING_ONNX_FILE,
+        threads: int = EMBEDDING_ONNX_THREADS,
+        max_seq_length: int = EMBEDDING_MAX_SEQ_LENGTH,
+        batch_size: int = EMBEDDING_BATCH_SIZE
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, model_file)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"ONNX model not found at {model_path}")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.batch_size = batch_size
+        logger.info("Loaded ONNX embedding model from %s", model_path)
+
+    def _embed_batch(self, texts: List[str]):
+        import numpy as np
+
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {k: v for k, v in inputs.items() if k in self.input_names})[0]
+
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_batch(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+class CachedEmbeddings:
+    """
+    Bounded LRU cache of embeddings in front of any embeddings backend.
+
+    Only texts missing from the cache are sent to the model, in a single
+    batch, so repeated questions skip the forward pass entirely.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        maxsize: int = QUERY_EMBEDDING_CACHE_SIZE,
+        ttl: Optional[float] = QUERY_EMBEDDING_CACHE_TTL
+    ):
+        self.embeddings = embeddings
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [normalize_query(text) for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                vectors[key] = cached
+
+        if missing:
+            for key, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                vector = list(vector)
+                self.cache.set(key, vector)
+                vectors[key] = vector
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+
+def create_embeddings(backend: str = EMBEDDING_BACKEND, cache: bool = True):
+    """
+    Build the configured embeddings backend, wrapped in the query cache.
+
+    Falls back to the PyTorch backend if the ONNX model or runtime is missing.
+    """
+    embeddings = None
+    if backend == "onnx":
+        try:
+            embeddings = OnnxEmbeddings()
+        except Exception as e:
+            logger.warning("ONNX embeddings unavailable, falling back to torch: %s", e)
+    elif backend != "torch":
+        logger.warning("Unknown EMBEDDING_BACKEND '%s', using torch", backend)
+
+    if embeddings is None:
+        from langchain.embeddings import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+    return CachedEmbeddings(embeddings) if cache else embeddings
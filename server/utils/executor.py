@@ -0,0 +1,59 @@
+import os
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from dotenv import load_dotenv
+import logging
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Thread pool for synchronous SDK calls (Supabase, Stripe)
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "16"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "20"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    """The blocking I/O pool, created on first use and again after a shutdown"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+    return _executor
+
+async def run_blocking(func: Callable[..., Any], *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """
+    Run a blocking call on the dedicated I/O pool without stalling the event loop.
+
+    The pool is bounded, so a burst of slow calls queues up instead of spawning
+    unlimited threads. On timeout the caller gets asyncio.TimeoutError; the
+    worker thread itself cannot be interrupted and finishes in the background.
+    """
+    loop = asyncio.get_running_loop()
+    # Carry context variables (e.g. request IDs) into the worker thread
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    future = loop.run_in_executor(get_executor(), call)
+
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
+
+def shutdown_executor():
+    """
+    Release the pool's idle worker threads. A later app lifespan in the same
+    process (tests, reload) gets a fresh pool.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
@@ -0,0 +1,113 @@
+import os
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+import logging
+
+from .embeddings import EMBEDDING_MODEL
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Versioned index configuration
+UKCAT_INDEX_DIR = os.getenv(
+    "UKCAT_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "ukcat_index")
+)
+UKCAT_INDEX_VERSION = os.getenv("UKCAT_INDEX_VERSION")  # Pin a version instead of following LATEST
+INDEX_FORMAT_VERSION = 1
+
+LATEST_FILE = "LATEST"
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.faiss"
+VECTORS_FILE = "vectors.npy"
+DOCS_FILE = "docs.json"
+
+@dataclass
+class StoredDocument:
+    page_content: str
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+class _Docstore:
+    def __init__(self, documents: Dict[str, StoredDocument]):
+        self._documents = documents
+
+    def search(self, doc_id: str) -> StoredDocument:
+        return self._documents[doc_id]
+
+class IndexStore:
+    """
+    A versioned index written by scripts/build_index.py.
+
+    Exposes the same index, index_to_docstore_id and docstore attributes as
+    the LangChain FAISS store, so RetrievalEngine can search either one.
+    """
+
+    def __init__(self, path: str, manifest: Dict[str, Any], index, docs: List[Dict[str, Any]]):
+        self.path = path
+        self.manifest = manifest
+        self.version = manifest["version"]
+        self.index = index
+        self.index_to_docstore_id = [doc["id"] for doc in docs]
+        self.docstore = _Docstore({
+            doc["id"]: StoredDocument(page_content=doc["content"], metadata={**doc.get("metadata", {}), "doc_id": doc["id"]})
+            for doc in docs
+        })
+        self._normalize_L2 = False  # Vectors are normalized by the embedding model itself
+
+    def documents(self) -> List[StoredDocument]:
+        return [self.docstore.search(doc_id) for doc_id in self.index_to_docstore_id]
+
+def resolve_version_dir(root: str = UKCAT_INDEX_DIR, version: Optional[str] = UKCAT_INDEX_VERSION) -> Optional[str]:
+    """Directory of the pinned version, or of the one LATEST points to"""
+    if not version:
+        latest = os.path.join(root, LATEST_FILE)
+        if not os.path.exists(latest):
+            return None
+        with open(latest) as f:
+            version = f.read().strip()
+    path = os.path.join(root, version)
+    return path if os.path.isdir(path) else None
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+def check_compatibility(manifest: Dict[str, Any], model: str = EMBEDDING_MODEL) -> Optional[str]:
+    """Reason the index can't be served with this build, or None if it can"""
+    if manifest.get("format_version") != INDEX_FORMAT_VERSION:
+        return f"index format {manifest.get('format_version')} is not supported (expected {INDEX_FORMAT_VERSION})"
+    if manifest.get("model") != model:
+        return f"index was built with {manifest.get('model')}, but the server embeds with {model}"
+    return None
+
+def load_index_store(root: str = UKCAT_INDEX_DIR, version: Optional[str] = UKCAT_INDEX_VERSION) -> Optional[IndexStore]:
+    """
+    Load the current index version, memory-mapping the FAISS file.
+
+    Returns None when there is no versioned index or it is incompatible, so
+    the caller can fall back to the legacy pickled store.
+    """
+    path = resolve_version_dir(root, version)
+    if path is None:
+        return None
+
+    manifest = read_manifest(path)
+    problem = check_compatibility(manifest)
+    if problem:
+        logger.error("Ignoring index %s: %s", path, problem)
+        return None
+
+    import faiss
+    index = faiss.read_index(os.path.join(path, INDEX_FILE), faiss.IO_FLAG_MMAP)
+    if index.d != manifest["dimension"] or index.ntotal != manifest["count"]:
+        logger.error("Ignoring index %s: index file does not match its manifest", path)
+        return None
+
+    with open(os.path.join(path, DOCS_FILE), encoding="utf-8") as f:
+        docs = json.load(f)
+
+    logger.info("Loaded index %s (%s documents, model %s)", manifest['version'], manifest['count'], manifest['model'])
+    return IndexStore(path, manifest, index, docs)
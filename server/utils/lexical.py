@@ -0,0 +1,97 @@
+import os
+import re
+import math
+import heapq
+from collections import Counter
+from typing import Dict, List, Sequence, Tuple
+from dotenv import load_dotenv
+import logging
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# BM25 configuration
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Keeps ids such as "qr_1" or "vr_inf_1" as single tokens
+_TOKEN = re.compile(r"[a-z0-9_]+")
+
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i if in into is it its me my of on or so that the
+their them then there these this to was what when where which who why will with you your
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """
+    Inverted index with Okapi BM25 scoring over a fixed list of documents.
+
+    Documents are addressed by their position in the list, which matches the
+    row of the same document in the FAISS index, so lexical and dense
+    results can be fused directly.
+    """
+
+    def __init__(self, texts: Sequence[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[int] = []
+
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings.setdefault(token, []).append((row, tf))
+
+        self.size = len(self.lengths)
+        self.avg_length = (sum(self.lengths) / self.size) if self.size else 0.0
+        self.idf = {
+            token: math.log(1 + (self.size - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
+        # Unknown query terms weigh as much as the rarest possible term
+        self.max_idf = math.log(1 + (self.size + 0.5) / 0.5) if self.size else 0.0
+
+    @classmethod
+    def from_vector_store(cls, vector_store) -> "BM25Index":
+        """Index the documents of a FAISS store, in FAISS row order"""
+        texts = [
+            vector_store.docstore.search(doc_id).page_content
+            for doc_id in vector_store.index_to_docstore_id
+        ]
+        index = cls(texts)
+        logger.info("Built BM25 index over %s documents (%s terms)", index.size, len(index.postings))
+        return index
+
+    def search(self, query: str, k: int) -> Tuple[List[Tuple[int, float]], float]:
+        """
+        Top k (row, score) pairs, plus the query coverage of the best match:
+        the share of the query's IDF mass found in that document.
+        """
+        terms = Counter(tokenize(query))
+        if not terms or not self.size:
+            return [], 0.0
+
+        scores: Dict[int, float] = {}
+        matched: Dict[int, float] = {}
+        for token in terms:
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = self.idf[token]
+            for row, tf in posting:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[row] / self.avg_length)
+                scores[row] = scores.get(row, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[row] = matched.get(row, 0.0) + idf
+
+        if not scores:
+            return [], 0.0
+
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        query_mass = sum(self.idf.get(token, self.max_idf) for token in terms)
+        coverage = matched[top[0][0]] / query_mass if query_mass else 0.0
+        return top, coverage
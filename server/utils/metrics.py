@@ -0,0 +1,268 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from dotenv import load_dotenv
+import logging
+
+from .request_log import record_stage
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Metrics configuration
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PREFIX = "studybyte"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"  # Starlette appends the charset
+
+# Seconds. Covers sub-millisecond cache hits up to slow completions.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# (labels, value) pairs returned by collectors
+Sample = Tuple[Dict[str, Any], float]
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter, one series per label combination"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}"
+            for key, value in values
+        ]
+
+class Histogram:
+    """
+    Cumulative-bucket histogram, one series per label combination.
+
+    An observation is a bisect and three additions under a lock, so timing a
+    stage costs a few microseconds.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(key, list(series[0]), series[1], series[2]) for key, series in self._series.items()]
+
+        lines = []
+        for key, counts, total, count in snapshot:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+_metrics: List[Any] = []
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]] = []
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+def register_collector(collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]):
+    """
+    Add a callable that reports existing counters at scrape time.
+
+    It returns (name, type, help, samples) tuples. This lets components that
+    already count things (caches, single-flight, admission) be exported
+    without touching their hot paths.
+    """
+    _collectors.append(collector)
+
+# Request pipeline metrics
+STAGE_SECONDS = histogram(
+    "stage_duration_seconds",
+    "Time spent in each stage of the request pipeline",
+    ["stage"],
+)
+DEPENDENCY_SECONDS = histogram(
+    "dependency_duration_seconds",
+    "Latency of calls to external services",
+    ["service", "operation", "outcome"],
+)
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds",
+    "Time from request start to the last response byte",
+    ["method", "route", "status"],
+)
+UPSTREAM_ERRORS = counter(
+    "upstream_errors_total",
+    "Failed completion requests to the LLM upstream",
+    ["kind"],
+)
+LLM_TOKENS = counter(
+    "llm_tokens_total",
+    "Tokens sent to and received from the LLM upstream",
+    ["direction"],
+)
+def observe_stage(stage: str, seconds: float):
+    """Record a stage duration in the histogram and in the current request's log record"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    record_stage(stage, seconds)
+
+@contextmanager
+def timed(metric: Histogram = STAGE_SECONDS, **labels):
+    """Observe the duration of the block in seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metric.observe(elapsed, **labels)
+        if metric is STAGE_SECONDS:
+            record_stage(labels["stage"], elapsed)
+
+@contextmanager
+def timed_call(service: str, operation: str):
+    """Time an external call, labelled with whether it raised"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        DEPENDENCY_SECONDS.observe(elapsed, service=service, operation=operation, outcome=outcome)
+        record_stage(f"{service}.{operation}", elapsed)
+
+def record_upstream_error(error: BaseException):
+    """Count a failed upstream call by HTTP status, timeout or connection failure"""
+    status = getattr(error, "status", None)
+    if status:
+        kind = f"http_{status}"
+    elif isinstance(error, TimeoutError) or type(error).__name__ == "TimeoutError":
+        kind = "timeout"
+    elif "Connect" in type(error).__name__ or isinstance(error, ConnectionError):
+        kind = "connection"
+    else:
+        kind = "other"
+    UPSTREAM_ERRORS.inc(kind=kind)
+
+def record_token_usage(prompt_tokens: int, completion_tokens: int):
+    LLM_TOKENS.inc(prompt_tokens, direction="prompt")
+    LLM_TOKENS.inc(completion_tokens, direction="completion")
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+
+    for collector in _collectors:
+        try:
+            families = list(collector())
+        except Exception as e:
+            logger.warning("Metrics collector failed: %s", e)
+            continue
+        for name, metric_type, help, samples in families:
+            name = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """
+    Records each HTTP request's duration by route template, measured to the
+    end of the response body so streamed responses are timed in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                # Templates rather than raw paths keep the number of series bounded
+                route=getattr(route, "path", "unmatched"),
+                status=status_code,
+            )
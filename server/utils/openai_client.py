@@ -1,13 +1,20 @@
 import os
-import aiohttp
-import json
-from typing import Optional, AsyncGenerator, List, Dict
+import time
+import threading
+from typing import Optional, AsyncGenerator, Dict
 from dotenv import load_dotenv
 import logging
-import asyncio
 from fastapi import WebSocket
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import FAISS
+from .http_session import get_http_session
+from .response_cache import ResponseCache
+from .streaming import iter_completion_tokens, stream_frames, encode_frames
+from .retrieval import RetrievalEngine, RetrievalResult
+from .embeddings import create_embeddings
+from .index_store import load_index_store
+from .prompt_builder import build_prompt, count_tokens
+from .single_flight import SingleFlight
+from .metrics import timed, observe_stage, record_upstream_error, record_token_usage
+from .request_log import annotate, log_sampled, redact
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -28,130 +35,109 @@ class OpenAIClient:
         logger.info("OpenAI API key found")
         self.model = os.getenv("MODEL_NAME", "gpt-4-turbo-preview")
         self.max_tokens = int(os.getenv("MAX_TOKENS", "2000"))
-        self.api_base = "https://api.openai.com/v1/chat/completions"
+        # Any compatible server works, e.g. the load-test stand-in
+        api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
+        self.api_base = f"{api_base}/chat/completions"
         
-        # Initialize embeddings and vector store for RAG
-        self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        # Initialize embeddings (EMBEDDING_BACKEND, behind a query cache) and
+        # vector store for RAG. The model is only loaded once the client is
+        # actually needed.
+        self.embeddings = create_embeddings()
         self.vector_store = None
+        self.retriever = None
         
         # Load pre-computed embeddings
         self._load_embeddings()
+
+        # Exact and semantic answer cache, sharing the RAG query embeddings
+        self.response_cache = ResponseCache()
+        self.flights = SingleFlight()
         
-        logger.info(f"Initialized OpenAI client with model: {self.model}")
+        logger.info("Initialized OpenAI client with model: %s", self.model)
 
     def _load_embeddings(self):
         """Load pre-computed embeddings from disk"""
         try:
+            # Prefer the versioned, memory-mapped index from scripts/build_index.py
+            self.vector_store = load_index_store()
             embeddings_path = "data/ukcat_embeddings"
-            if os.path.exists(embeddings_path):
+            if self.vector_store is None and os.path.exists(embeddings_path):
                 logger.info("Loading pre-computed embeddings...")
+                from langchain.vectorstores import FAISS
                 self.vector_store = FAISS.load_local(
                     embeddings_path,
                     self.embeddings
                 )
+
+            if self.vector_store is not None:
+                self.retriever = RetrievalEngine(self.embeddings, self.vector_store)
                 logger.info("Successfully loaded embeddings")
             else:
-                logger.warning("No pre-computed embeddings found. Please run generate_embeddings.py first.")
-                self.vector_store = None
+                logger.warning("No pre-computed embeddings found. Please run scripts/build_index.py first.")
         except Exception as e:
-            logger.error(f"Error loading embeddings: {str(e)}")
+            logger.error("Error loading embeddings: %s", e)
             self.vector_store = None
 
-    def _get_relevant_context(self, query: str, k: int = 3) -> str:
+    def _log_prompt(self, message: str, prompt):
+        annotate(prompt_tokens=prompt.usage["total"], rag_used=bool(prompt.rag_context))
+        if prompt.truncated:
+            annotate(prompt_truncated=prompt.truncated, dropped_chunks=prompt.dropped_chunks)
+        log_sampled(logger, "Prompt for %s: model=%s usage=%s", redact(message), self.model, prompt.usage)
+
+    async def _get_relevant_context(self, query: str, k: int = 3) -> Optional[RetrievalResult]:
         """Retrieve relevant context from the vector store"""
-        if not self.vector_store:
-            return ""
-            
-        docs = self.vector_store.similarity_search(query, k=k)
-        context = "\n\n".join([doc.page_content for doc in docs])
-        
-        if context:
-            logger.info("🔍 RAG: Found relevant context from UKCAT data")
-            logger.info(f"Number of relevant documents found: {len(docs)}")
-        else:
-            logger.info("🔍 RAG: No relevant context found")
+        if not self.retriever:
+            return None
             
-        return context
+        result = await self.retriever.retrieve(query, k=k)
+        annotate(retrieval_mode=result.mode, rag_documents=len(result.documents))
+        return result
+
+    async def generate_response(self, message: str, context: Optional[str] = None, use_cache: bool = True) -> str:
+        """Identical concurrent requests share one upstream completion"""
+        key = self.flights.fingerprint(message, context, self.model, self.max_tokens)
+        return await self.flights.do(key, lambda: self._generate_response(message, context, use_cache))
+
+    async def _generate_response(self, message: str, context: Optional[str] = None, use_cache: bool = True) -> str:
+        cache_key = self.response_cache.make_key(message, context, self.model)
+        cached = self.response_cache.get_exact(cache_key, use_cache)
+        if cached is not None:
+            annotate(response_cache="exact")
+            return cached
 
-    async def generate_response(self, message: str, context: Optional[str] = None) -> str:
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
 
-        # Get relevant UKCAT context if available
-        logger.info("🔍 Searching for relevant UKCAT context...")
-        ukcat_context = self._get_relevant_context(message)
-        
-        # Log the retrieved context
-        if ukcat_context:
-            logger.info("📚 Retrieved UKCAT Context:")
-            logger.info(f"Context length: {len(ukcat_context)} characters")
-            logger.info(f"Context preview: {ukcat_context[:200]}...")
-        else:
-            logger.info("❌ No UKCAT context found")
-        
-        if context:
-            logger.info("📝 Additional Context provided:")
-            logger.info(f"Context length: {len(context)} characters")
-            logger.info(f"Context preview: {context[:200]}...")
-        
-        # Build messages with all available context
-        messages = []
-        
-        # Add system message defining the AI's role
-        system_message = {
-            "role": "system",
-            "content": "You are a helpful AI assistant specialized in helping students prepare for the UKCAT (UK Clinical Aptitude Test). Your role is to provide accurate, relevant, and detailed explanations using the provided UKCAT context to help students understand concepts, solve problems, and improve their test-taking skills. Always be supportive, encouraging, and focus on helping students learn and understand the material."
-        }
-        messages.append(system_message)
-        logger.info("📝 System Message:")
-        logger.info(f"System message length: {len(system_message['content'])} characters")
-        
-        # Add UKCAT context if available
-        if ukcat_context:
-            context_message = {
-                "role": "system",
-                "content": f"UKCAT Context:\n{ukcat_context}"
-            }
-            messages.append(context_message)
-            logger.info("✨ Using RAG: Including UKCAT context in response")
-            logger.info(f"UKCAT context message length: {len(context_message['content'])} characters")
-        
-        # Add additional context if provided
-        if context:
-            additional_context = {
-                "role": "system",
-                "content": f"Additional Context:\n{context}"
-            }
-            messages.append(additional_context)
-            logger.info(f"Additional context message length: {len(additional_context['content'])} characters")
-        
-        # Add the user's message
-        user_message = {
-            "role": "user",
-            "content": message
-        }
-        messages.append(user_message)
-        logger.info(f"User message length: {len(message)} characters")
+        # Get relevant UKCAT context if available; its query embedding also feeds the semantic cache
+        retrieval = await self._get_relevant_context(message)
+        query_embedding = retrieval.embedding if retrieval else None
+        if query_embedding is not None:
+            cached = self.response_cache.get_semantic(message, context, self.model, query_embedding, use_cache)
+            if cached is not None:
+                annotate(response_cache="semantic")
+                return cached
+        annotate(response_cache="miss")
+
+        prompt = build_prompt(
+            message,
+            self.model,
+            context=context,
+            chunks=[doc.content for doc in retrieval.documents] if retrieval else ()
+        )
+        self._log_prompt(message, prompt)
 
         payload = {
             "model": self.model,
-            "messages": messages,
+            "messages": prompt.messages,
             "max_tokens": self.max_tokens,
             "stream": False
         }
 
-        # Log the payload (excluding API key for security)
-        logger.info("📤 Sending Payload:")
-        logger.info(f"Model: {payload['model']}")
-        logger.info(f"Max tokens: {payload['max_tokens']}")
-        logger.info(f"Total messages: {len(messages)}")
-        logger.info(f"Total content length: {sum(len(msg['content']) for msg in messages)} characters")
-
         try:
-            logger.info(f"Sending request to OpenAI API with message: {message[:50]}...")
-            async with aiohttp.ClientSession() as session:
+            session = await get_http_session()
+            with timed(stage="upstream"):
                 async with session.post(
                     f"{self.api_base}",
                     headers=headers,
@@ -159,138 +145,136 @@ class OpenAIClient:
                 ) as response:
                     response.raise_for_status()
                     result = await response.json()
-                    logger.info("✅ Successfully received response from OpenAI API")
-                    logger.info(f"Response length: {len(result['choices'][0]['message']['content'])} characters")
-                    return result["choices"][0]["message"]["content"]
+            answer = result["choices"][0]["message"]["content"]
+            usage = result.get("usage") or {}
+            completion_tokens = usage.get("completion_tokens") or count_tokens(answer, self.model)
+            record_token_usage(usage.get("prompt_tokens", prompt.usage["total"]), completion_tokens)
+            annotate(completion_tokens=completion_tokens)
+            self.response_cache.store(cache_key, message, context, self.model, answer, query_embedding)
+            return answer
         except Exception as e:
-            logger.error(f"❌ OpenAI API error: {str(e)}")
+            record_upstream_error(e)
+            logger.error("❌ OpenAI API error: %s", e)
             raise Exception(f"OpenAI API error: {str(e)}")
 
-    async def generate_stream(self, websocket: WebSocket, message: str, context: Optional[str] = None):
+    async def stream_response(
+        self,
+        message: str,
+        context: Optional[str] = None,
+        metadata: Optional[Dict] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Yield completion tokens as they arrive, sharing one upstream stream
+        between identical concurrent requests
+        """
+        key = self.flights.fingerprint(message, context, self.model, self.max_tokens)
+        async for token in self.flights.stream(key, lambda md: self._stream_response(message, context, md), metadata):
+            yield token
+
+    async def _stream_response(
+        self,
+        message: str,
+        context: Optional[str] = None,
+        metadata: Optional[Dict] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Yield completion tokens as they arrive from the API.
+
+        If a metadata dict is passed it is filled with the retrieved RAG context
+        before the first token is yielded.
+        """
+        cache_key = self.response_cache.make_key(message, context, self.model)
+        cached = self.response_cache.get_exact(cache_key)
+        if cached is not None:
+            annotate(response_cache="exact")
+            yield cached
+            return
+
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "Accept": "text/event-stream"
         }
 
-        # Get relevant UKCAT context if available
-        logger.info("🔍 Searching for relevant UKCAT context...")
-        ukcat_context = self._get_relevant_context(message)
-        
-        # Build messages with all available context
-        messages = []
-        
-        # Add system message defining the AI's role
-        system_message = {
-            "role": "system",
-            "content": "You are a helpful AI assistant specialized in helping students prepare for the UKCAT (UK Clinical Aptitude Test). Your role is to provide accurate, relevant, and detailed explanations using the provided UKCAT context to help students understand concepts, solve problems, and improve their test-taking skills. Always be supportive, encouraging, and focus on helping students learn and understand the material."
-        }
-        messages.append(system_message)
-        
-        # Add UKCAT context if available
-        if ukcat_context:
-            context_message = {
-                "role": "system",
-                "content": f"UKCAT Context:\n{ukcat_context}"
-            }
-            messages.append(context_message)
-            logger.info("✨ Using RAG: Including UKCAT context in response")
-        
-        # Add additional context if provided
-        if context:
-            additional_context = {
-                "role": "system",
-                "content": f"Additional Context:\n{context}"
-            }
-            messages.append(additional_context)
-        
-        # Add the user's message
-        user_message = {
-            "role": "user",
-            "content": message
-        }
-        messages.append(user_message)
+        # Get relevant UKCAT context if available; its query embedding also feeds the semantic cache
+        retrieval = await self._get_relevant_context(message)
+        query_embedding = retrieval.embedding if retrieval else None
+        if query_embedding is not None:
+            cached = self.response_cache.get_semantic(message, context, self.model, query_embedding)
+            if cached is not None:
+                annotate(response_cache="semantic")
+                yield cached
+                return
+        annotate(response_cache="miss")
+
+        prompt = build_prompt(
+            message,
+            self.model,
+            context=context,
+            chunks=[doc.content for doc in retrieval.documents] if retrieval else ()
+        )
+        self._log_prompt(message, prompt)
 
         payload = {
             "model": self.model,
-            "messages": messages,
+            "messages": prompt.messages,
             "max_tokens": self.max_tokens,
             "stream": True
         }
 
-        # Log the complete payload (excluding API key)
-        logger.info("📤 Complete Payload being sent:")
-        logger.info(json.dumps(payload, indent=2))
-        logger.info("System messages content:")
-        for i, msg in enumerate(messages):
-            if msg["role"] == "system":
-                logger.info(f"System message {i+1}:")
-                logger.info(msg["content"])
-        logger.info("User message content:")
-        logger.info(user_message["content"])
+        if metadata is not None:
+            metadata["ragContext"] = prompt.rag_context or None
+            metadata["promptTokens"] = prompt.usage
 
         try:
-            logger.info(f"Starting streaming request to OpenAI API...")
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base}",
-                    headers=headers,
-                    json=payload
-                ) as response:
-                    response.raise_for_status()
-                    accumulated_message = ""
-                    
-                    async for line in response.content:
-                        line = line.decode('utf-8').strip()
-                        if line.startswith('data: '):
-                            try:
-                                json_str = line[6:]  # Remove "data: " prefix
-                                if json_str.strip() == "[DONE]":
-                                    break
-                                
-                                chunk = json.loads(json_str)
-                                if chunk["choices"][0]["finish_reason"] is not None:
-                                    break
-                                    
-                                content = chunk["choices"][0]["delta"].get("content", "")
-                                if content:
-                                    accumulated_message += content
-                                    metadata = {
-                                        "ragContext": ukcat_context if ukcat_context else None
-                                    }
-                                    await websocket.send_text(json.dumps({
-                                        "type": "stream",
-                                        "content": content,
-                                        "full_content": accumulated_message,
-                                        "metadata": metadata
-                                    }))
-                                    await asyncio.sleep(0.01)  # Small delay to prevent overwhelming the client
-                            except json.JSONDecodeError as e:
-                                logger.error(f"Error parsing streaming response: {e}")
-                                continue
-                    
-                    # Send final message
-                    metadata = {
-                        "ragContext": ukcat_context if ukcat_context else None
-                    }
-                    await websocket.send_text(json.dumps({
-                        "type": "end",
-                        "content": accumulated_message,
-                        "metadata": metadata
-                    }))
-                    
+            session = await get_http_session()
+            started = time.perf_counter()
+            async with session.post(
+                f"{self.api_base}",
+                headers=headers,
+                json=payload
+            ) as response:
+                response.raise_for_status()
+                parts = []
+                async for content in iter_completion_tokens(response):
+                    if not parts:
+                        observe_stage("upstream_first_token", time.perf_counter() - started)
+                    parts.append(content)
+                    yield content
+            observe_stage("upstream_stream", time.perf_counter() - started)
+            answer = "".join(parts)
+            completion_tokens = count_tokens(answer, self.model)
+            record_token_usage(prompt.usage["total"], completion_tokens)
+            annotate(completion_tokens=completion_tokens)
+            self.response_cache.store(cache_key, message, context, self.model, answer, query_embedding)
         except Exception as e:
-            logger.error(f"Streaming error: {str(e)}")
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "content": str(e)
-            }))
+            record_upstream_error(e)
+            logger.error("Streaming error: %s", e)
             raise
 
-# Create a singleton instance
-try:
-    openai_client = OpenAIClient()
-    logger.info("Successfully initialized OpenAI client")
-except Exception as e:
-    logger.error(f"Failed to initialize OpenAI client: {str(e)}")
-    raise 
\ No newline at end of file
+    async def generate_stream(self, websocket: WebSocket, message: str, context: Optional[str] = None):
+        metadata = {}
+        async for text in encode_frames(stream_frames(self.stream_response(message, context, metadata), metadata)):
+            await websocket.send_text(text)
+
+_openai_client: Optional[OpenAIClient] = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> OpenAIClient:
+    """
+    Return the shared OpenAI client, creating it on first use.
+
+    Loading the embedding model and FAISS index takes seconds, so it happens
+    on the first RAG request (or during warmup) rather than at import time.
+    """
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                try:
+                    _openai_client = OpenAIClient()
+                    logger.info("Successfully initialized OpenAI client")
+                except Exception as e:
+                    logger.error("Failed to initialize OpenAI client: %s", e)
+                    raise
+    return _openai_client 
\ No newline at end of file
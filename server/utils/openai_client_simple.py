@@ -1,10 +1,18 @@
 import os
-import aiohttp
-import json
-from typing import Optional
+import time
+import asyncio
+import threading
+from typing import Any, Optional, AsyncGenerator, Dict
 from dotenv import load_dotenv
 import logging
 from fastapi import WebSocket
+from .http_session import get_http_session
+from .response_cache import QueryEmbedder, ResponseCache, SEMANTIC_CACHE_ENABLED
+from .streaming import iter_completion_tokens, stream_frames, encode_frames
+from .prompt_builder import build_prompt, count_tokens
+from .single_flight import SingleFlight
+from .metrics import timed, observe_stage, record_upstream_error, record_token_usage
+from .request_log import annotate, log_sampled, redact
 
 # Configure logging based on environment
 log_level = logging.WARNING if os.getenv("VERCEL") else logging.INFO
@@ -14,6 +22,9 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+class FallbackAnswer(str):
+    """Text returned in place of a completion (demo mode, upstream failure); not worth keeping in a conversation"""
+
 class OpenAIClient:
     def __init__(self):
         self.api_key = os.getenv("OPENAI_API_KEY")
@@ -28,103 +39,248 @@ class OpenAIClient:
         
         self.model = os.getenv("MODEL_NAME", "gpt-4-turbo-preview")
         self.max_tokens = int(os.getenv("MAX_TOKENS", "2000"))
-        self.api_base = "https://api.openai.com/v1/chat/completions"
+        # Any compatible server works, e.g. the load-test stand-in
+        api_base = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
+        self.api_base = f"{api_base}/chat/completions"
+
+        # Exact and semantic answer cache. Without the RAG model, questions
+        # are embedded by the local ONNX model or the embeddings endpoint
+        self.embedder = QueryEmbedder(api_base, self.api_key)
+        self.response_cache = ResponseCache(semantic=SEMANTIC_CACHE_ENABLED and self.embedder.enabled, max_distance=self.embedder.max_distance)
+        self.flights = SingleFlight()
         
         if not os.getenv("VERCEL"):  # Only log in development
-            logger.info(f"Initialized OpenAI client with model: {self.model}")
+            logger.info("Initialized OpenAI client with model: %s", self.model)
+
+    def _build_prompt(self, message: str, context: Optional[str] = None):
+        prompt = build_prompt(message, self.model, context=context)
+        annotate(prompt_tokens=prompt.usage["total"])
+        if prompt.truncated:
+            annotate(prompt_truncated=prompt.truncated)
+        log_sampled(logger, "Prompt for %s: model=%s usage=%s", redact(message), self.model, prompt.usage)
+        return prompt
+
+    def _cached_answer(self, cache_key: str, message: str, context: Optional[str], use_cache: bool = True):
+        """
+        (answer, embedding task): the exact-tier answer, or None and the
+        question's embedding, started in the background
+        """
+        cached = self.response_cache.get_exact(cache_key, use_cache)
+        if cached is not None:
+            annotate(response_cache="exact")
+            return cached, None
+        if not self.response_cache.semantic_applies(message, context, use_cache):
+            annotate(response_cache="miss")
+            return None, None
+        return None, asyncio.ensure_future(self.embedder.embed(message))
+
+    async def _semantic_race(
+        self,
+        upstream: asyncio.Future,
+        embedding: Optional[asyncio.Future],
+        message: str,
+        context: Optional[str],
+        use_cache: bool = True
+    ) -> Optional[str]:
+        """
+        A semantic-tier answer if the question's embedding arrives and matches
+        before upstream is done, cancelling upstream; else None. Misses never
+        wait for the embedding.
+        """
+        if embedding is None:
+            return None
+        await asyncio.wait({upstream, embedding}, return_when=asyncio.FIRST_COMPLETED)
+        if embedding.done() and not upstream.done() and embedding.result() is not None:
+            cached = self.response_cache.get_semantic(message, context, self.model, embedding.result(), use_cache)
+            if cached is not None:
+                upstream.cancel()
+                annotate(response_cache="semantic")
+                return cached
+        annotate(response_cache="miss")
+        return None
+
+    def _store(self, cache_key: str, message: str, context: Optional[str], answer: str, embedding: Optional[asyncio.Future]):
+        """Cache a new answer, adding it to the semantic tier once its embedding is ready"""
+        if embedding is None or not embedding.done():
+            self.response_cache.store(cache_key, message, context, self.model, answer)
+            if embedding is not None:
+                def store_semantic(task: asyncio.Future):
+                    if not task.cancelled() and task.result() is not None:
+                        self.response_cache.store(cache_key, message, context, self.model, answer, task.result())
+                embedding.add_done_callback(store_semantic)
+            return
+        self.response_cache.store(cache_key, message, context, self.model, answer, embedding.result())
+
+    async def _complete(self, headers: Dict[str, str], payload: Dict[str, Any]) -> Dict[str, Any]:
+        session = await get_http_session()
+        with timed(stage="upstream"):
+            async with session.post(
+                self.api_base,
+                headers=headers,
+                json=payload
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def _upstream_tokens(self, headers: Dict[str, str], payload: Dict[str, Any]) -> AsyncGenerator[str, None]:
+        session = await get_http_session()
+        started = time.perf_counter()
+        first = True
+        try:
+            async with session.post(
+                self.api_base,
+                headers=headers,
+                json=payload
+            ) as response:
+                response.raise_for_status()
+                async for content in iter_completion_tokens(response):
+                    if first:
+                        first = False
+                        observe_stage("upstream_first_token", time.perf_counter() - started)
+                    yield content
+        except Exception as e:
+            record_upstream_error(e)
+            raise
+        observe_stage("upstream_stream", time.perf_counter() - started)
 
-    async def generate_response(self, message: str, context: Optional[str] = None) -> str:
+    async def generate_response(self, message: str, context: Optional[str] = None, use_cache: bool = True) -> str:
+        """Identical concurrent requests share one upstream completion"""
+        key = self.flights.fingerprint(message, context, self.model, self.max_tokens)
+        return await self.flights.do(key, lambda: self._generate_response(message, context, use_cache))
+
+    async def _generate_response(self, message: str, context: Optional[str] = None, use_cache: bool = True) -> str:
         # Demo mode for testing without API key
         if self.demo_mode:
             logger.warning("Running in demo mode (no API key)")
-            return f"Demo response: You asked '{message}'. This is a test response since no OpenAI API key is configured."
+            return FallbackAnswer(f"Demo response: You asked '{message}'. This is a test response since no OpenAI API key is configured.")
+        
+        cache_key = self.response_cache.make_key(message, context, self.model)
+        cached, embedding = self._cached_answer(cache_key, message, context, use_cache)
+        if cached is not None:
+            return cached
         
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
 
-        # Build messages
-        messages = []
-        
-        # Add system message
-        system_message = {
-            "role": "system",
-            "content": "You are a helpful AI assistant specialized in helping students prepare for the UKCAT (UK Clinical Aptitude Test). Provide clear, accurate explanations and help students understand concepts and solve problems."
-        }
-        messages.append(system_message)
-        
-        # Add context if provided
-        if context:
-            context_message = {
-                "role": "system", 
-                "content": f"Additional Context: {context}"
-            }
-            messages.append(context_message)
-        
-        # Add user message
-        messages.append({
-            "role": "user",
-            "content": message
-        })
-
+        prompt = self._build_prompt(message, context)
         payload = {
             "model": self.model,
-            "messages": messages,
+            "messages": prompt.messages,
             "max_tokens": self.max_tokens,
             "stream": False
         }
 
+        # The completion starts right away; a semantic hit arriving first cancels it
+        completion = asyncio.ensure_future(self._complete(headers, payload))
         try:
-            if not os.getenv("VERCEL"):  # Only log in development
-                logger.info(f"Sending request to OpenAI API...")
-            
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_base,
-                    headers=headers,
-                    json=payload
-                ) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-                    
-                    if not os.getenv("VERCEL"):  # Only log in development
-                        logger.info("✅ Received response from OpenAI")
-                    
-                    return result["choices"][0]["message"]["content"]
+            cached = await self._semantic_race(completion, embedding, message, context, use_cache)
+            if cached is not None:
+                return cached
+            result = await completion
+
+            answer = result["choices"][0]["message"]["content"]
+            usage = result.get("usage") or {}
+            completion_tokens = usage.get("completion_tokens") or count_tokens(answer, self.model)
+            record_token_usage(usage.get("prompt_tokens", prompt.usage["total"]), completion_tokens)
+            annotate(completion_tokens=completion_tokens)
+            self._store(cache_key, message, context, answer, embedding)
+            return answer
         except Exception as e:
-            logger.error(f"❌ OpenAI API error: {str(e)}")
-            return f"I'm having trouble connecting to OpenAI right now. Error: {str(e)}"
+            record_upstream_error(e)
+            logger.error("❌ OpenAI API error: %s", e)
+            return FallbackAnswer(f"I'm having trouble connecting to OpenAI right now. Error: {str(e)}")
+        finally:
+            completion.cancel()
 
-    async def generate_stream(self, websocket: WebSocket, message: str, context: Optional[str] = None):
-        try:
-            # Get full response
+    async def stream_response(
+        self,
+        message: str,
+        context: Optional[str] = None,
+        metadata: Optional[Dict] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Yield completion tokens as they arrive, sharing one upstream stream
+        between identical concurrent requests
+        """
+        key = self.flights.fingerprint(message, context, self.model, self.max_tokens)
+        async for token in self.flights.stream(key, lambda md: self._stream_response(message, context, md), metadata):
+            yield token
+
+    async def _stream_response(
+        self,
+        message: str,
+        context: Optional[str] = None,
+        metadata: Optional[Dict] = None
+    ) -> AsyncGenerator[str, None]:
+        """Yield completion tokens as they arrive from the API"""
+        if self.demo_mode:
+            # No upstream to stream from, so replay the demo answer word by word
             response = await self.generate_response(message, context)
-            
-            # Send in chunks to simulate streaming
-            words = response.split(' ')
-            full_content = ""
-            
-            for word in words:
-                full_content += word + " "
-                await websocket.send_text(json.dumps({
-                    "type": "stream",
-                    "content": word + " ",
-                    "full_content": full_content.strip()
-                }))
-                
-            # Send end message
-            await websocket.send_text(json.dumps({
-                "type": "end", 
-                "content": full_content.strip()
-            }))
-            
-        except Exception as e:
-            logger.error(f"Streaming error: {str(e)}")
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "content": str(e)
-            }))
-
-# Create global instance
-openai_client = OpenAIClient() 
\ No newline at end of file
+            for word in response.split(' '):
+                yield word + " "
+            return
+
+        cache_key = self.response_cache.make_key(message, context, self.model)
+        cached, embedding = self._cached_answer(cache_key, message, context)
+        if cached is not None:
+            yield cached
+            return
+
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        }
+        prompt = self._build_prompt(message, context)
+        payload = {
+            "model": self.model,
+            "messages": prompt.messages,
+            "max_tokens": self.max_tokens,
+            "stream": True
+        }
+
+        # The stream starts right away; a semantic hit before its first token cancels it
+        tokens = self._upstream_tokens(headers, payload)
+        first = asyncio.ensure_future(tokens.__anext__())
+        try:
+            cached = await self._semantic_race(first, embedding, message, context)
+            if cached is not None:
+                yield cached
+                return
+            try:
+                parts = [await first]
+            except StopAsyncIteration:
+                parts = []
+            if parts:
+                yield parts[0]
+            async for content in tokens:
+                parts.append(content)
+                yield content
+        finally:
+            if not first.done():
+                first.cancel()
+                await asyncio.wait({first})
+            await tokens.aclose()
+        answer = "".join(parts)
+        completion_tokens = count_tokens(answer, self.model)
+        record_token_usage(prompt.usage["total"], completion_tokens)
+        annotate(completion_tokens=completion_tokens)
+        self._store(cache_key, message, context, answer, embedding)
+
+    async def generate_stream(self, websocket: WebSocket, message: str, context: Optional[str] = None):
+        async for text in encode_frames(stream_frames(self.stream_response(message, context))):
+            await websocket.send_text(text)
+
+_openai_client: Optional[OpenAIClient] = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> OpenAIClient:
+    """Return the shared OpenAI client, creating it on first use"""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                _openai_client = OpenAIClient()
+    return _openai_client
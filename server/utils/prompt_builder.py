@@ -0,0 +1,224 @@
+import os
+import re
+import math
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+from dotenv import load_dotenv
+import logging
+
+from .lexical import tokenize
+from .response_cache import normalize_text
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Prompt budget configuration
+PROMPT_INPUT_TOKEN_BUDGET = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", "3000"))
+PROMPT_CONTEXT_SHARE = float(os.getenv("PROMPT_CONTEXT_SHARE", "0.4"))  # Of the room left after system prompt and message
+PROMPT_MIN_CHUNK_TOKENS = int(os.getenv("PROMPT_MIN_CHUNK_TOKENS", "32"))
+
+# Shared by both clients. Kept first and unchanged between requests so the
+# upstream can reuse its cached prefix.
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant specialized in helping students prepare for the UKCAT "
+    "(UK Clinical Aptitude Test). Give accurate, clear explanations, using the UKCAT context "
+    "when it is provided, to help students understand concepts, solve problems and improve "
+    "their test-taking skills. Be supportive and encouraging."
+)
+
+# Per-message framing tokens in the chat format, the reply primer and the
+# section headings around the context
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+SECTION_HEADER_TOKENS = 16
+
+_PARAGRAPHS = re.compile(r"\n\s*\n")
+_SENTENCES = re.compile(r"(?<=[.!?])\s+")
+
+_encoders: Dict[str, Any] = {}
+_encoders_lock = threading.Lock()
+
+def _encoder(model: str):
+    """tiktoken encoding for the model, or None if tiktoken isn't installed"""
+    with _encoders_lock:
+        if model not in _encoders:
+            try:
+                import tiktoken
+                try:
+                    _encoders[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encoders[model] = tiktoken.get_encoding("cl100k_base")
+            except ImportError:
+                logger.warning("tiktoken not installed, estimating prompt tokens from characters")
+                _encoders[model] = None
+        return _encoders[model]
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoder = _encoder(model)
+    if encoder is None:
+        return math.ceil(len(text) / 4)
+    return len(encoder.encode(text))
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Cut text down to max_tokens, at a word boundary where possible"""
+    if max_tokens <= 0:
+        return ""
+    encoder = _encoder(model)
+    if encoder is None:
+        cut = text[:max_tokens * 4]
+    else:
+        tokens = encoder.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoder.decode(tokens[:max_tokens])
+    if len(cut) < len(text) and " " in cut:
+        cut = cut[:cut.rindex(" ")]
+    return cut.rstrip()
+
+@dataclass
+class Prompt:
+    messages: List[Dict[str, str]]
+    usage: Dict[str, int]  # Tokens per component, plus total and budget
+    rag_context: str  # The retrieved text that made it into the prompt
+    dropped_chunks: int = 0
+    truncated: List[str] = field(default_factory=list)  # Components that were cut to fit
+
+def _segments(text: str) -> List[str]:
+    """Paragraphs, or sentences if the text is a single paragraph"""
+    parts = [part.strip() for part in _PARAGRAPHS.split(text) if part.strip()]
+    if len(parts) <= 1:
+        parts = [part.strip() for part in _SENTENCES.split(text) if part.strip()]
+    return parts
+
+def _fit_context(context: str, message: str, budget: int, model: str) -> str:
+    """
+    Keep the context segments most relevant to the message within budget.
+
+    Segments are ranked by term overlap with the message, most recent first
+    on ties, and emitted in their original order.
+    """
+    if count_tokens(context, model) <= budget:
+        return context
+
+    segments = _segments(context)
+    query = set(tokenize(message))
+    ranked = sorted(
+        range(len(segments)),
+        key=lambda i: (len(query & set(tokenize(segments[i]))), i),
+        reverse=True,
+    )
+
+    kept, used = set(), 0
+    for i in ranked:
+        cost = count_tokens(segments[i], model)
+        if used + cost <= budget:
+            kept.add(i)
+            used += cost
+
+    if not kept:
+        # Nothing fits whole: keep the start of the best segment
+        return truncate_tokens(segments[ranked[0]], budget, model)
+    return "\n\n".join(segments[i] for i in sorted(kept))
+
+def _fit_chunks(chunks: Sequence[str], budget: int, model: str):
+    """Take retrieved chunks in rank order until the budget runs out"""
+    kept, used, truncated = [], 0, False
+    for chunk in chunks:
+        cost = count_tokens(chunk, model)
+        if used + cost <= budget:
+            kept.append(chunk)
+            used += cost
+            continue
+        room = budget - used
+        if room >= PROMPT_MIN_CHUNK_TOKENS:
+            kept.append(truncate_tokens(chunk, room, model))
+            truncated = True
+        break
+    return kept, truncated
+
+def build_prompt(
+    message: str,
+    model: str,
+    context: Optional[str] = None,
+    chunks: Sequence[str] = (),
+    budget: int = PROMPT_INPUT_TOKEN_BUDGET
+) -> Prompt:
+    """
+    Assemble the chat messages for one request within an input token budget.
+
+    The system prompt and the user's message are always sent in full. The
+    remaining budget is split between the caller's additional context (at
+    most PROMPT_CONTEXT_SHARE of it, unless the RAG chunks leave room) and
+    the retrieved chunks, which are deduplicated against each other and
+    against the context and taken in retrieval rank order.
+    """
+    context = (context or "").strip()
+    fixed = (
+        count_tokens(SYSTEM_PROMPT, model)
+        + count_tokens(message, model)
+        + 3 * MESSAGE_OVERHEAD_TOKENS
+        + REPLY_OVERHEAD_TOKENS
+        + SECTION_HEADER_TOKENS
+    )
+    room = max(0, budget - fixed)
+
+    # Drop chunks the caller already sent back in the context, and repeats
+    seen = set()
+    unique_chunks = []
+    for chunk in chunks:
+        key = normalize_text(chunk)
+        if key and key not in seen and key not in normalize_text(context):
+            seen.add(key)
+            unique_chunks.append(chunk)
+
+    chunks_need = sum(count_tokens(chunk, model) for chunk in unique_chunks)
+    context_cap = max(int(room * PROMPT_CONTEXT_SHARE), room - chunks_need)
+    fitted_context = _fit_context(context, message, context_cap, model) if context else ""
+    context_tokens = count_tokens(fitted_context, model)
+
+    kept_chunks, chunk_truncated = _fit_chunks(unique_chunks, room - context_tokens, model)
+    rag_context = "\n\n".join(kept_chunks)
+
+    sections = []
+    if rag_context:
+        sections.append(f"UKCAT Context:\n{rag_context}")
+    if fitted_context:
+        sections.append(f"Additional Context:\n{fitted_context}")
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if sections:
+        messages.append({"role": "system", "content": "\n\n".join(sections)})
+    messages.append({"role": "user", "content": message})
+
+    truncated = []
+    if fitted_context != context:
+        truncated.append("context")
+    if chunk_truncated or len(kept_chunks) < len(unique_chunks):
+        truncated.append("rag")
+
+    usage = {
+        "system": count_tokens(SYSTEM_PROMPT, model),
+        "rag": count_tokens(rag_context, model),
+        "context": context_tokens,
+        "message": count_tokens(message, model),
+    }
+    total = (
+        sum(count_tokens(m["content"], model) for m in messages)
+        + len(messages) * MESSAGE_OVERHEAD_TOKENS
+        + REPLY_OVERHEAD_TOKENS
+    )
+    usage["overhead"] = total - sum(usage.values())
+    usage["total"] = total
+    usage["budget"] = budget
+
+    return Prompt(
+        messages=messages,
+        usage=usage,
+        rag_context=rag_context,
+        dropped_chunks=len(chunks) - len(kept_chunks),
+        truncated=truncated,
+    )
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import random
+import threading
+from itertools import product
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+import logging
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Question bank configuration
+QUESTION_BANK_DIR = os.getenv(
+    "QUESTION_BANK_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+)
+QUESTION_BANK_RELOAD_INTERVAL = float(os.getenv("QUESTION_BANK_RELOAD_INTERVAL", "5"))
+QUESTION_BANK_MAX_PAGE_SIZE = int(os.getenv("QUESTION_BANK_MAX_PAGE_SIZE", "100"))
+
+FacetKey = Tuple[Optional[str], Optional[str], Optional[str]]  # (section, category, difficulty)
+
+def _facet(value: Optional[str]) -> Optional[str]:
+    return value.strip().lower() if value else None
+
+class _BankSnapshot:
+    """
+    Immutable, fully indexed view of the question files.
+
+    Every question is registered under all combinations of its section,
+    category and difficulty (each either set or a wildcard), so any filter
+    resolves with a single dict lookup. Question and passage payloads are
+    built once here and served as-is.
+    """
+
+    def __init__(self):
+        self.questions: Dict[str, Dict[str, Any]] = {}
+        self.passages: Dict[str, Dict[str, Any]] = {}
+        self.by_facets: Dict[FacetKey, List[str]] = {}
+        self.by_tag: Dict[str, List[str]] = {}
+        self.sections: Dict[str, Dict[str, Any]] = {}
+        self.facet_counts: Dict[str, Dict[str, int]] = {"section": {}, "category": {}, "difficulty": {}}
+
+    def add_question(self, question: Dict[str, Any], section: str, category: str, passage_id: Optional[str] = None):
+        explanations = question.get("explanations") or {"detailed": question.get("explanation")}
+        payload = {
+            "id": question["id"],
+            "section": section,
+            "category": category,
+            "difficulty": question.get("difficulty"),
+            "question_text": question.get("question_text"),
+            "options": question.get("options", []),
+            "correct_answer": question.get("correct_answer"),
+            "explanations": explanations,
+            "tags": question.get("tags", []),
+            "passage_id": passage_id,
+        }
+        self.questions[payload["id"]] = payload
+
+        values = (_facet(section), _facet(category), _facet(payload["difficulty"]))
+        for key in product(*[(value, None) for value in values]):
+            self.by_facets.setdefault(key, []).append(payload["id"])
+        for tag in payload["tags"]:
+            self.by_tag.setdefault(_facet(tag), []).append(payload["id"])
+        for facet, counts in self.facet_counts.items():
+            value = payload.get(facet) or "unknown"
+            counts[value] = counts.get(value, 0) + 1
+
+    def load_file(self, path: str):
+        section = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        category = data.get("category", section)
+        self.sections[section] = {
+            "section": section,
+            "title": data.get("title"),
+            "category": category,
+            "description": data.get("description"),
+        }
+
+        for question in data.get("questions", []):
+            self.add_question(question, section, category)
+
+        for passage in data.get("passages", []):
+            question_ids = [question["id"] for question in passage.get("questions", [])]
+            self.passages[passage["id"]] = {
+                "id": passage["id"],
+                "section": section,
+                "category": category,
+                "passage_text": passage.get("passage_text"),
+                "source": passage.get("source"),
+                "question_ids": question_ids,
+            }
+            for question in passage.get("questions", []):
+                self.add_question(question, section, category, passage_id=passage["id"])
+            self.passages[passage["id"]]["questions"] = [self.questions[qid] for qid in question_ids]
+
+class QuestionBank:
+    """
+    In-memory UKCAT question bank loaded from data/*.json.
+
+    Reads never touch disk, an LLM or the database. Changed files are picked up
+    by a background reload that swaps in a new snapshot atomically.
+    """
+
+    def __init__(self, data_dir: str = QUESTION_BANK_DIR, reload_interval: float = QUESTION_BANK_RELOAD_INTERVAL):
+        self.data_dir = os.path.abspath(data_dir)
+        self.reload_interval = reload_interval
+        self._snapshot: Optional[_BankSnapshot] = None
+        self._mtimes: Dict[str, float] = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._reloading = False
+
+    def _scan(self) -> Dict[str, float]:
+        mtimes = {}
+        for name in sorted(os.listdir(self.data_dir)):
+            if name.endswith(".json"):
+                path = os.path.join(self.data_dir, name)
+                mtimes[path] = os.path.getmtime(path)
+        return mtimes
+
+    def load(self):
+        """(Re)build the snapshot from disk"""
+        started = time.perf_counter()
+        mtimes = self._scan()
+        snapshot = _BankSnapshot()
+        for path in mtimes:
+            try:
+                snapshot.load_file(path)
+            except Exception as e:
+                logger.error("Error loading question file %s: %s", path, e)
+
+        self._snapshot = snapshot
+        self._mtimes = mtimes
+        self._checked_at = time.monotonic()
+        logger.info(
+            "Loaded question bank: %s questions, %s passages in %.1f ms", len(snapshot.questions), len(snapshot.passages), (time.perf_counter() - started) * 1000
+        )
+
+    def _reload_in_background(self):
+        try:
+            self.load()
+        finally:
+            self._reloading = False
+
+    @property
+    def snapshot(self) -> _BankSnapshot:
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.load()
+            return self._snapshot
+
+        now = time.monotonic()
+        if self.reload_interval > 0 and now - self._checked_at > self.reload_interval:
+            self._checked_at = now
+            try:
+                changed = self._scan() != self._mtimes
+            except OSError as e:
+                logger.error("Error checking question files: %s", e)
+                changed = False
+            if changed and not self._reloading:
+                self._reloading = True
+                logger.info("Question files changed, reloading question bank")
+                threading.Thread(target=self._reload_in_background, daemon=True).start()
+        return self._snapshot
+
+    def get_question(self, question_id: str) -> Optional[Dict[str, Any]]:
+        return self.snapshot.questions.get(question_id)
+
+    def get_passage(self, passage_id: str) -> Optional[Dict[str, Any]]:
+        return self.snapshot.passages.get(passage_id)
+
+    def _filter(
+        self,
+        section: Optional[str],
+        category: Optional[str],
+        difficulty: Optional[str],
+        tag: Optional[str]
+    ) -> Tuple[_BankSnapshot, List[str]]:
+        snapshot = self.snapshot
+        ids = snapshot.by_facets.get((_facet(section), _facet(category), _facet(difficulty)), [])
+        if tag:
+            tagged = set(snapshot.by_tag.get(_facet(tag), []))
+            ids = [qid for qid in ids if qid in tagged]
+        return snapshot, ids
+
+    def list_questions(
+        self,
+        section: Optional[str] = None,
+        category: Optional[str] = None,
+        difficulty: Optional[str] = None,
+        tag: Optional[str] = None,
+        page: int = 1,
+        page_size: int = 20
+    ) -> Dict[str, Any]:
+        page = max(1, page)
+        page_size = max(1, min(page_size, QUESTION_BANK_MAX_PAGE_SIZE))
+        snapshot, ids = self._filter(section, category, difficulty, tag)
+        start = (page - 1) * page_size
+        return {
+            "items": [snapshot.questions[qid] for qid in ids[start:start + page_size]],
+            "page": page,
+            "page_size": page_size,
+            "total": len(ids),
+        }
+
+    def sample_questions(
+        self,
+        count: int = 10,
+        section: Optional[str] = None,
+        category: Optional[str] = None,
+        difficulty: Optional[str] = None,
+        tag: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        count = max(1, min(count, QUESTION_BANK_MAX_PAGE_SIZE))
+        snapshot, ids = self._filter(section, category, difficulty, tag)
+        return [snapshot.questions[qid] for qid in random.sample(ids, min(count, len(ids)))]
+
+    def facets(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {"sections": list(snapshot.sections.values()), "counts": snapshot.facet_counts}
+
+# Global instance
+question_bank = QuestionBank()
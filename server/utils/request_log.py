@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import contextvars
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+import logging
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+# One structured record per request; route this logger separately to ship
+# only the request records
+request_logger = logging.getLogger("studybyte.requests")
+
+# Request logging configuration
+REQUEST_LOG_ENABLED = os.getenv("REQUEST_LOG_ENABLED", "true").lower() == "true"
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))  # Share of requests that log verbose details
+LOG_USER_CONTENT = os.getenv("LOG_USER_CONTENT", "false").lower() == "true"  # Log messages and answers unredacted
+REQUEST_ID_HEADER = "x-request-id"
+
+# Kept at INFO even where the root logger is quieter (WARNING on Vercel):
+# the per-request record replaces the chatty lines, it is not one of them
+request_logger.setLevel(logging.getLevelName(os.getenv("REQUEST_LOG_LEVEL", "INFO").upper()))
+
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class RequestContext:
+    """Per-request state collected while the request runs and logged once at the end"""
+
+    __slots__ = ("request_id", "sampled", "stages", "fields")
+
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.sampled = sampled
+        self.stages: Dict[str, float] = {}  # Stage -> total milliseconds
+        self.fields: Dict[str, Any] = {}
+
+_current: contextvars.ContextVar[Optional[RequestContext]] = contextvars.ContextVar("request_context", default=None)
+
+def current_request_id() -> Optional[str]:
+    context = _current.get()
+    return context.request_id if context else None
+
+def record_stage(stage: str, seconds: float):
+    """Add time spent in a stage to the current request's record"""
+    context = _current.get()
+    if context is not None:
+        context.stages[stage] = context.stages.get(stage, 0.0) + seconds * 1000
+
+def annotate(**fields):
+    """Attach fields (cache outcome, tier, token counts...) to the current request's record"""
+    context = _current.get()
+    if context is not None:
+        context.fields.update(fields)
+
+def debug_sampled() -> bool:
+    """Whether the current request was picked to log verbose details"""
+    context = _current.get()
+    return context is not None and context.sampled
+
+def log_sampled(log: logging.Logger, msg: str, *args):
+    """
+    Verbose detail: logged at DEBUG when that level is on, otherwise at INFO
+    for the LOG_DEBUG_SAMPLE_RATE share of requests only
+    """
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(msg, *args)
+    elif debug_sampled():
+        log.info(msg, *args)
+
+def redact(text: Optional[str]) -> Optional[str]:
+    """
+    Replace user content with its length and a short hash, so log lines can
+    still be correlated without storing what the user wrote
+    """
+    if text is None or LOG_USER_CONTENT:
+        return text
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return f"<redacted len={len(text)} sha256={digest}>"
+
+class _LazyJSON:
+    """Serialized only if the record is actually emitted"""
+
+    __slots__ = ("record",)
+
+    def __init__(self, record: Dict[str, Any]):
+        self.record = record
+
+    def __str__(self) -> str:
+        return json.dumps(self.record, separators=(",", ":"), default=str)
+
+class RequestLogMiddleware:
+    """
+    Assigns each HTTP request an ID (reusing a valid incoming X-Request-ID),
+    returns it in the response headers and writes one structured record when
+    the response body has been sent. Stage timings and fields added during
+    the request end up in that record.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not REQUEST_LOG_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope.get("headers", ()):
+            if name == REQUEST_ID_HEADER.encode():
+                incoming = value.decode("latin-1")
+                break
+        request_id = incoming if incoming and _VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex
+        context = RequestContext(request_id, random.random() < LOG_DEBUG_SAMPLE_RATE)
+        token = _current.set(context)
+
+        started = time.perf_counter()
+        status_code = 500
+        response_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_bytes
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER.encode(), request_id.encode())
+                ]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if request_logger.isEnabledFor(logging.INFO):
+                route = scope.get("route")
+                record = {
+                    "request_id": request_id,
+                    "method": scope["method"],
+                    "route": getattr(route, "path", scope["path"]),
+                    "status": status_code,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+                    "response_bytes": response_bytes,
+                    "stages_ms": {stage: round(ms, 2) for stage, ms in context.stages.items()},
+                    **context.fields,
+                }
+                if context.sampled:
+                    record["sampled"] = True
+                request_logger.info("request %s", _LazyJSON(record))
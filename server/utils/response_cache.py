@@ -0,0 +1,264 @@
+import os
+import re
+import hashlib
+import importlib.util
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+from dotenv import load_dotenv
+import logging
+import aiohttp
+
+from .cache import TTLCache
+from .embeddings import EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_FILE
+from .executor import run_blocking
+from .http_session import get_http_session
+from .metrics import timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Response cache configuration
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.08"))  # Tuned for all-MiniLM-L6-v2
+SEMANTIC_CACHE_MIN_CHARS = int(os.getenv("SEMANTIC_CACHE_MIN_CHARS", "12"))
+SEMANTIC_CACHE_MAX_CONTEXT_CHARS = int(os.getenv("SEMANTIC_CACHE_MAX_CONTEXT_CHARS", "200"))
+# Clients without the RAG model embed questions themselves: "local" runs the
+# ONNX export of all-MiniLM-L6-v2 (scripts/export_onnx_embeddings.py), "api"
+# calls the embeddings endpoint, "auto" is local when the export is installed
+SEMANTIC_CACHE_EMBEDDINGS = os.getenv("SEMANTIC_CACHE_EMBEDDINGS", "auto").lower()
+SEMANTIC_CACHE_EMBEDDING_MODEL = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL", "text-embedding-3-small")  # For "api"
+# text-embedding-3-small spreads paraphrases further apart than MiniLM, so
+# the API embeddings get their own threshold
+SEMANTIC_CACHE_API_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_API_MAX_DISTANCE", "0.15"))
+SEMANTIC_CACHE_EMBEDDING_TIMEOUT = float(os.getenv("SEMANTIC_CACHE_EMBEDDING_TIMEOUT", "2"))  # Seconds; slower API embeddings are dropped
+
+_WHITESPACE = re.compile(r"\s+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+def normalize_text(text: Optional[str]) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    if not text:
+        return ""
+    return _WHITESPACE.sub(" ", text).strip().lower().rstrip("?!. ")
+
+class ResponseCache:
+    """
+    Two-tier cache for LLM answers.
+
+    The exact tier is keyed on the normalized message, context and model. The
+    semantic tier compares query embeddings and returns a cached answer when a
+    new question is within SEMANTIC_CACHE_MAX_DISTANCE cosine distance of a
+    previous one with the same model and context. Questions whose numbers
+    differ never match semantically, since "3 tickets" and "4 tickets" embed
+    almost identically but have different answers. The distance threshold
+    depends on the embedding model.
+    """
+
+    def __init__(self, semantic: bool = SEMANTIC_CACHE_ENABLED, max_distance: float = SEMANTIC_CACHE_MAX_DISTANCE):
+        self.exact = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+        if semantic and importlib.util.find_spec("numpy") is None:
+            logger.warning("numpy is not installed, the semantic response cache is disabled")
+            semantic = False
+        self.semantic_enabled = semantic
+        self.max_distance = max_distance
+        self.semantic = TTLCache(maxsize=SEMANTIC_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+        self._matrix = None
+        self._matrix_keys: List[str] = []
+        self._matrix_version = -1
+        self._version = 0
+        self._lock = threading.Lock()
+        self.semantic_hits = 0
+        self.semantic_misses = 0
+        self.exact_bypasses = 0
+        self.semantic_bypasses = 0
+
+    @staticmethod
+    def make_key(message: str, context: Optional[str], model: str) -> str:
+        raw = "\x1f".join([model, normalize_text(context), normalize_text(message)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get_exact(self, key: str, use_cache: bool = True) -> Optional[str]:
+        if not RESPONSE_CACHE_ENABLED or not use_cache:
+            self.exact_bypasses += 1
+            return None
+        return self.exact.get(key)
+
+    def semantic_applies(self, message: str, context: Optional[str], use_cache: bool = True) -> bool:
+        """Per-tier bypass rules for the semantic cache"""
+        return (
+            RESPONSE_CACHE_ENABLED
+            and self.semantic_enabled
+            and use_cache
+            and len(normalize_text(message)) >= SEMANTIC_CACHE_MIN_CHARS
+            and len(context or "") <= SEMANTIC_CACHE_MAX_CONTEXT_CHARS
+        )
+
+    def _scope(self, context: Optional[str], model: str) -> str:
+        return f"{model}\x1f{normalize_text(context)}"
+
+    def _snapshot(self):
+        """Stack the cached vectors into one matrix, rebuilt only after writes"""
+        import numpy as np
+
+        with self._lock:
+            if self._matrix_version != self._version:
+                keys, vectors = [], []
+                for key, entry in self.semantic.items():
+                    keys.append(key)
+                    vectors.append(entry["vector"])
+                self._matrix = np.vstack(vectors) if vectors else None
+                self._matrix_keys = keys
+                self._matrix_version = self._version
+            return self._matrix, self._matrix_keys
+
+    def get_semantic(
+        self,
+        message: str,
+        context: Optional[str],
+        model: str,
+        vector: Sequence[float],
+        use_cache: bool = True
+    ) -> Optional[str]:
+        import numpy as np
+
+        if not self.semantic_applies(message, context, use_cache):
+            self.semantic_bypasses += 1
+            return None
+
+        matrix, keys = self._snapshot()
+        if matrix is None:
+            self.semantic_misses += 1
+            return None
+
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        similarities = matrix @ query
+        scope = self._scope(context, model)
+        numbers = _NUMBER.findall(message)
+
+        for index in np.argsort(-similarities):
+            if 1.0 - float(similarities[index]) > self.max_distance:
+                break
+            entry = self.semantic.get(keys[index])
+            if entry is None:
+                continue
+            if entry["scope"] == scope and entry["numbers"] == numbers:
+                self.semantic_hits += 1
+                return entry["answer"]
+
+        self.semantic_misses += 1
+        return None
+
+    def store(
+        self,
+        key: str,
+        message: str,
+        context: Optional[str],
+        model: str,
+        answer: str,
+        vector: Optional[Sequence[float]] = None
+    ):
+        if not RESPONSE_CACHE_ENABLED:
+            return
+
+        self.exact.set(key, answer)
+        if vector is not None and self.semantic_applies(message, context):
+            import numpy as np
+
+            normalized = np.asarray(vector, dtype=np.float32)
+            normalized = normalized / (np.linalg.norm(normalized) or 1.0)
+            self.semantic.set(key, {
+                "vector": normalized,
+                "answer": answer,
+                "scope": self._scope(context, model),
+                "numbers": _NUMBER.findall(message),
+            })
+            with self._lock:
+                self._version += 1
+
+    def stats(self) -> Dict[str, Any]:
+        semantic_lookups = self.semantic_hits + self.semantic_misses
+        return {
+            "exact": {**self.exact.stats(), "bypasses": self.exact_bypasses},
+            "semantic": {
+                "size": len(self.semantic),
+                "hits": self.semantic_hits,
+                "misses": self.semantic_misses,
+                "bypasses": self.semantic_bypasses,
+                "hit_rate": round(self.semantic_hits / semantic_lookups, 4) if semantic_lookups else 0.0,
+            },
+        }
+
+class QueryEmbedder:
+    """
+    Question embeddings for the semantic tier of a client without the RAG
+    model, with the distance threshold that suits them.
+
+    The local model is loaded on first use and run on the blocking I/O pool;
+    repeated questions skip it through the query embedding cache.
+    """
+
+    def __init__(self, api_base: str, api_key: Optional[str], mode: str = SEMANTIC_CACHE_EMBEDDINGS):
+        self.embeddings_url = f"{api_base}/embeddings"
+        self.api_key = api_key
+        local_available = (
+            importlib.util.find_spec("onnxruntime") is not None
+            and importlib.util.find_spec("tokenizers") is not None
+            and os.path.exists(os.path.join(EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_FILE))
+        )
+        if mode == "auto":
+            mode = "local" if local_available else "api"
+        elif mode == "local" and not local_available:
+            logger.warning("The ONNX embedding model isn't installed, the semantic response cache is disabled")
+            mode = "off"
+        elif mode not in ("local", "api", "off"):
+            logger.warning("Unknown SEMANTIC_CACHE_EMBEDDINGS '%s', the semantic response cache is disabled", mode)
+            mode = "off"
+        self.mode = mode
+        self.max_distance = SEMANTIC_CACHE_API_MAX_DISTANCE if mode == "api" else SEMANTIC_CACHE_MAX_DISTANCE
+        self._local = None
+        self._local_lock = threading.Lock()
+        logger.info("Semantic response cache embeddings: %s", mode)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _embed_local(self, text: str) -> List[float]:
+        from .embeddings import CachedEmbeddings, OnnxEmbeddings
+
+        if self._local is None:
+            with self._local_lock:
+                if self._local is None:
+                    self._local = CachedEmbeddings(OnnxEmbeddings())
+        return self._local.embed_query(text)
+
+    async def _embed_api(self, text: str) -> List[float]:
+        session = await get_http_session()
+        async with session.post(
+            self.embeddings_url,
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            json={"model": SEMANTIC_CACHE_EMBEDDING_MODEL, "input": text},
+            timeout=aiohttp.ClientTimeout(total=SEMANTIC_CACHE_EMBEDDING_TIMEOUT)
+        ) as response:
+            response.raise_for_status()
+            result = await response.json()
+        return result["data"][0]["embedding"]
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """The text's embedding, None if embedding is off or fails"""
+        if not self.enabled:
+            return None
+        try:
+            with timed(stage="embedding"):
+                if self.mode == "local":
+                    return await run_blocking(self._embed_local, text)
+                return await self._embed_api(text)
+        except Exception as e:
+            logger.warning("Query embedding failed, skipping the semantic cache: %s", e)
+            return None
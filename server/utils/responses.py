@@ -0,0 +1,148 @@
+import os
+import gzip
+from typing import Any, Optional
+from fastapi.responses import JSONResponse
+from dotenv import load_dotenv
+import logging
+
+from .metrics import timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Only gzip is offered without it
+    brotli = None
+
+# Response compression configuration
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))  # Smaller bodies gain less than the headers and CPU cost
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))  # 11 is far slower for little gain on JSON
+
+# Streams are sent frame by frame as they are produced; buffering them to
+# compress would hold back every token until the end
+UNCOMPRESSED_TYPES = ("text/event-stream", "application/x-ndjson")
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response encoded with orjson (several times faster than the json
+    module on long answer strings), timed as the "serialization" stage
+    """
+
+    def render(self, content: Any) -> bytes:
+        with timed(stage="serialization"):
+            if orjson is None:
+                return super().render(content)
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+def _accepted_encodings(header: str):
+    """Encodings the client accepts, by q-value"""
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    return accepted
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """brotli if installed and accepted, else gzip, else None"""
+    accepted = _accepted_encodings(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best, best_quality = None, 0.0
+    for encoding in candidates:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(body: bytes, encoding: str) -> bytes:
+    with timed(stage="compression"):
+        if encoding == "br":
+            return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+        return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+class CompressionMiddleware:
+    """
+    Compresses complete responses with brotli or gzip, as negotiated by
+    Accept-Encoding, once they reach COMPRESSION_MIN_BYTES.
+
+    Only responses sent as a single body are compressed: streaming routes
+    (SSE and NDJSON) and anything else sent in chunks pass through
+    untouched, so frames still reach the client as they are produced.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for name, value in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                headers = {name.lower(): value for name, value in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if (
+                    b"content-encoding" in headers
+                    or content_type.startswith(UNCOMPRESSED_TYPES)
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                ):
+                    await send(message)
+                else:
+                    start_message = message  # Held until we know whether the body is complete
+                return
+
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            body = message.get("body", b"")
+            headers = [(name, value) for name, value in start.get("headers", []) if name.lower() != b"vary"]
+            vary = [value for name, value in start.get("headers", []) if name.lower() == b"vary"]
+            headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+
+            if message.get("more_body", False) or len(body) < self.minimum_size:
+                await send({**start, "headers": headers})
+                await send(message)
+                return
+
+            compressed = compress(body, encoding)
+            headers = [(name, value) for name, value in headers if name.lower() != b"content-length"]
+            headers += [(b"content-encoding", encoding.encode()), (b"content-length", str(len(compressed)).encode())]
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,282 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+import logging
+
+from .lexical import BM25Index
+from .metrics import STAGE_SECONDS, observe_stage
+from .request_log import record_stage
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Retrieval engine configuration
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "2"))
+RETRIEVAL_BATCH_WINDOW_MS = float(os.getenv("RETRIEVAL_BATCH_WINDOW_MS", "5"))
+RETRIEVAL_MAX_BATCH_SIZE = int(os.getenv("RETRIEVAL_MAX_BATCH_SIZE", "32"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()  # "hybrid", "dense" or "lexical"
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))  # Per ranker, before fusion
+RRF_K = int(os.getenv("RRF_K", "60"))
+LEXICAL_FAST_PATH_ENABLED = os.getenv("LEXICAL_FAST_PATH_ENABLED", "true").lower() == "true"
+LEXICAL_FAST_PATH_COVERAGE = float(os.getenv("LEXICAL_FAST_PATH_COVERAGE", "0.9"))
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv("LEXICAL_FAST_PATH_MARGIN", "2.0"))
+
+RETRIEVAL_MODES = ("hybrid", "dense", "lexical")
+
+@dataclass
+class ScoredDocument:
+    content: str
+    score: float  # Ranking score in the result's mode, higher is better
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    distance: Optional[float] = None  # Raw FAISS distance, lower is closer
+    lexical_score: Optional[float] = None  # BM25 score
+
+@dataclass
+class RetrievalResult:
+    documents: List[ScoredDocument]
+    embedding: Optional[List[float]]  # None when the dense search was skipped
+    timings: Dict[str, float]
+    mode: str = "dense"  # "dense", "hybrid", "lexical" or "lexical_fast_path"
+
+    @property
+    def context(self) -> str:
+        return "\n\n".join(doc.content for doc in self.documents)
+
+@dataclass
+class _DenseResult(RetrievalResult):
+    dense_hits: List[Tuple[int, float]] = field(default_factory=list)  # (row, distance), closest first
+
+class _PendingQuery:
+    __slots__ = ("text", "k", "future", "enqueued_at")
+
+    def __init__(self, text: str, k: int, future: asyncio.Future, enqueued_at: float):
+        self.text = text
+        self.k = k
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+class RetrievalEngine:
+    """
+    Hybrid lexical and dense retrieval over the FAISS vector store.
+
+    Dense queries arriving within RETRIEVAL_BATCH_WINDOW_MS of each other are
+    micro-batched: their embeddings are computed in a single model forward
+    pass and searched with one batched FAISS call on a worker thread, so
+    concurrent requests share the CPU work instead of serializing on the
+    event loop.
+
+    In hybrid mode a BM25 index over the same documents is searched first.
+    If its top results clearly cover the query and stand well apart from the
+    rest (ids like "qr_1", exact passage phrases), they are returned without
+    embedding the query at all. Otherwise the BM25 and FAISS rankings are
+    merged with reciprocal rank fusion.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        vector_store,
+        workers: int = RETRIEVAL_WORKERS,
+        batch_window_ms: float = RETRIEVAL_BATCH_WINDOW_MS,
+        max_batch_size: int = RETRIEVAL_MAX_BATCH_SIZE,
+        mode: str = RETRIEVAL_MODE
+    ):
+        if mode not in RETRIEVAL_MODES:
+            logger.warning("Unknown RETRIEVAL_MODE '%s', using hybrid", mode)
+            mode = "hybrid"
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.mode = mode
+        self.lexical = BM25Index.from_vector_store(vector_store)
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retrieval")
+        self._pending: List[_PendingQuery] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.queries = 0
+        self.fast_paths = 0
+
+    def _document(self, row: int) -> ScoredDocument:
+        doc = self.vector_store.docstore.search(self.vector_store.index_to_docstore_id[row])
+        return ScoredDocument(content=doc.page_content, score=0.0, metadata=dict(doc.metadata or {}))
+
+    def _lexical_is_decisive(self, hits: List[Tuple[int, float]], coverage: float, k: int) -> bool:
+        """The top k lexical hits cover the query and clearly outscore the next one"""
+        if not hits or coverage < LEXICAL_FAST_PATH_COVERAGE:
+            return False
+        if len(hits) <= k:
+            return True
+        return hits[k - 1][1] >= LEXICAL_FAST_PATH_MARGIN * hits[k][1]
+
+    async def retrieve(self, query: str, k: int = RETRIEVAL_TOP_K, mode: Optional[str] = None) -> RetrievalResult:
+        mode = mode or self.mode
+        started = time.perf_counter()
+
+        lexical_hits: List[Tuple[int, float]] = []
+        if mode != "dense":
+            # BM25 over this corpus takes well under a millisecond, so it runs inline
+            lexical_hits, coverage = self.lexical.search(query, max(k + 1, RETRIEVAL_CANDIDATES))
+            lexical_ms = (time.perf_counter() - started) * 1000
+            observe_stage("lexical_search", lexical_ms / 1000)
+
+            fast_path = mode == "hybrid" and LEXICAL_FAST_PATH_ENABLED and self._lexical_is_decisive(lexical_hits, coverage, k)
+            if mode == "lexical" or fast_path:
+                if fast_path:
+                    self.fast_paths += 1
+                documents = []
+                for row, score in lexical_hits[:k]:
+                    doc = self._document(row)
+                    doc.score = doc.lexical_score = score
+                    documents.append(doc)
+                return RetrievalResult(
+                    documents=documents,
+                    embedding=None,
+                    timings={"lexical_ms": lexical_ms, "total_ms": (time.perf_counter() - started) * 1000},
+                    mode="lexical_fast_path" if fast_path else "lexical",
+                )
+
+        candidates = k if mode == "dense" else max(k, RETRIEVAL_CANDIDATES)
+        result = await self._dense(query, candidates)
+        # The batch ran in its own task, so attribute its share to this request's log record
+        record_stage("retrieval_queue", result.timings["queue_ms"] / 1000)
+        record_stage("embedding", result.timings["embed_ms"] / 1000)
+        record_stage("vector_search", result.timings["search_ms"] / 1000)
+        if mode == "dense":
+            for row, distance in result.dense_hits:
+                doc = self._document(row)
+                doc.score, doc.distance = -distance, distance
+                result.documents.append(doc)
+            return result
+
+        # Reciprocal rank fusion of the BM25 and FAISS rankings
+        fused: Dict[int, float] = {}
+        for ranking in (lexical_hits, result.dense_hits):
+            for rank, (row, _) in enumerate(ranking):
+                fused[row] = fused.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+        lexical_scores = dict(lexical_hits)
+        distances = dict(result.dense_hits)
+        documents = []
+        for row in sorted(fused, key=fused.get, reverse=True)[:k]:
+            doc = self._document(row)
+            doc.score = fused[row]
+            doc.distance = distances.get(row)
+            doc.lexical_score = lexical_scores.get(row)
+            documents.append(doc)
+
+        return RetrievalResult(
+            documents=documents,
+            embedding=result.embedding,
+            timings={
+                **result.timings,
+                "lexical_ms": lexical_ms,
+                "total_ms": (time.perf_counter() - started) * 1000,
+            },
+            mode="hybrid",
+        )
+
+    async def _dense(self, query: str, k: int) -> "_DenseResult":
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(_PendingQuery(query, k, future, time.perf_counter()))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[_PendingQuery]):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            vectors, hits, embed_ms, search_ms = await loop.run_in_executor(
+                self._executor, self._embed_and_search, batch
+            )
+        except Exception as e:
+            logger.error("Retrieval batch failed: %s", e)
+            for pending in batch:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.queries += len(batch)
+        # Once per batch: the forward pass and FAISS search are shared by its queries
+        STAGE_SECONDS.observe(embed_ms / 1000, stage="embedding")
+        STAGE_SECONDS.observe(search_ms / 1000, stage="vector_search")
+        for pending, vector, dense_hits in zip(batch, vectors, hits):
+            if pending.future.done():
+                continue  # Caller was cancelled
+            pending.future.set_result(_DenseResult(
+                documents=[],
+                dense_hits=dense_hits,
+                embedding=vector,
+                timings={
+                    "queue_ms": (started - pending.enqueued_at) * 1000,
+                    "embed_ms": embed_ms,
+                    "search_ms": search_ms,
+                    "total_ms": (time.perf_counter() - pending.enqueued_at) * 1000,
+                    "batch_size": len(batch),
+                },
+            ))
+            STAGE_SECONDS.observe(started - pending.enqueued_at, stage="retrieval_queue")
+
+    def _embed_and_search(self, batch: List[_PendingQuery]) -> Tuple[List, List, float, float]:
+        """Runs on a worker thread: one forward pass and one FAISS search for the whole batch"""
+        import numpy as np
+
+        # Identical queries in the same window are embedded once
+        unique_texts = list(dict.fromkeys(pending.text for pending in batch))
+
+        embed_started = time.perf_counter()
+        unique_vectors = self.embeddings.embed_documents(unique_texts)
+        embed_ms = (time.perf_counter() - embed_started) * 1000
+
+        by_text = dict(zip(unique_texts, unique_vectors))
+        vectors = [list(by_text[pending.text]) for pending in batch]
+
+        search_started = time.perf_counter()
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if getattr(self.vector_store, "_normalize_L2", False):
+            import faiss
+            faiss.normalize_L2(matrix)
+        k = min(max(pending.k for pending in batch), self.vector_store.index.ntotal)
+        distances, indices = self.vector_store.index.search(matrix, k) if k > 0 else ([], [])
+
+        hits = []
+        for row, pending in enumerate(batch):
+            hits.append([
+                (int(indices[row][column]), float(distances[row][column]))
+                for column in range(min(pending.k, k))
+                if int(indices[row][column]) != -1
+            ])
+        search_ms = (time.perf_counter() - search_started) * 1000
+
+        return vectors, hits, embed_ms, search_ms
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "batches": self.batches,
+            "queries": self.queries,
+            "lexical_fast_paths": self.fast_paths,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+        }
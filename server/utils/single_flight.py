@@ -0,0 +1,168 @@
+import os
+import asyncio
+import hashlib
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from dotenv import load_dotenv
+import logging
+
+from .response_cache import normalize_text
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Request coalescing configuration
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+class _Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # Streaming flights only
+        self.tokens: List[str] = []
+        self.metadata: Dict[str, Any] = {}
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent upstream calls into one.
+
+    The first caller for a fingerprint (the leader) starts the call as a
+    task; callers arriving while it is in flight (followers) wait on the same
+    task and get the same result or exception. Streaming followers replay the
+    tokens produced so far and then tail the live stream. The task belongs to
+    no single caller: it keeps running while anyone is waiting and is
+    cancelled once the last waiter goes away.
+    """
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        self.requests = 0
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def fingerprint(message: str, context: Optional[str], model: str, max_tokens: int) -> str:
+        raw = "\x1f".join([model, str(max_tokens), normalize_text(context), normalize_text(message)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _join(self, key: str) -> tuple:
+        self.requests += 1
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight(key)
+            self._flights[key] = flight
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.waiters += 1
+        return flight, leader
+
+    def _start(self, flight: _Flight, coro: Awaitable):
+        flight.task = asyncio.ensure_future(coro)
+
+        def finished(task: asyncio.Task):
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            if not task.cancelled():
+                task.exception()  # Mark as retrieved; waiters get it through the task
+
+        flight.task.add_done_callback(finished)
+
+    def _leave(self, flight: _Flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Nobody is left to receive the result
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.task.cancel()
+            self.cancelled += 1
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Await factory(), or the identical call already in flight"""
+        if not self.enabled:
+            return await factory()
+
+        flight, leader = self._join(f"do:{key}")
+        if leader:
+            self._start(flight, factory())
+        try:
+            # Shielded so one caller's cancellation doesn't cancel the others
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def stream(
+        self,
+        key: str,
+        factory: Callable[[Dict[str, Any]], AsyncIterator[str]],
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> AsyncGenerator[str, None]:
+        """
+        Yield the tokens of factory(metadata), or of the identical stream in flight.
+
+        The leader's metadata (e.g. the RAG context) is copied into each
+        caller's metadata dict before its first token.
+        """
+        if not self.enabled:
+            async for token in factory(metadata if metadata is not None else {}):
+                yield token
+            return
+
+        flight, leader = self._join(f"stream:{key}")
+        if leader:
+            self._start(flight, self._pump(flight, factory))
+
+        position = 0
+        copied = False
+        try:
+            while True:
+                if not copied and metadata is not None and (flight.tokens or flight.done):
+                    metadata.update(flight.metadata)
+                    copied = True
+                if position < len(flight.tokens):
+                    position += 1
+                    yield flight.tokens[position - 1]
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            self._leave(flight)
+
+    async def _pump(self, flight: _Flight, factory: Callable[[Dict[str, Any]], AsyncIterator[str]]):
+        try:
+            async for token in factory(flight.metadata):
+                flight.tokens.append(token)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "requests": self.requests,
+            "upstream_calls": self.leaders,
+            "coalesced": self.followers,
+            "coalescing_ratio": round(self.followers / self.requests, 4) if self.requests else 0.0,
+            "cancelled": self.cancelled,
+            "in_flight": len(self._flights),
+        }
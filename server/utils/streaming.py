@@ -0,0 +1,191 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, Optional
+from dotenv import load_dotenv
+import logging
+
+from .metrics import observe_stage
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Streaming wire protocol
+#
+# v1 frames, in order:
+#   {"type": "start", "v": 1, "metadata": {...}}   sent once, before any delta
+#   {"type": "delta", "seq": n, "content": "..."}  only the new text since the last frame
+#   {"type": "end", "frames": n, "length": bytes, "sha256": hex}
+#   {"type": "error", "content": "..."}           replaces "end" if generation fails
+#
+# "length" and "sha256" are computed over the UTF-8 encoding of the full answer
+# so clients can verify that the deltas were reassembled correctly.
+STREAM_PROTOCOL_VERSION = 1
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "64"))
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv("STREAM_FLUSH_INTERVAL_MS", "50"))
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+async def iter_completion_tokens(response) -> AsyncGenerator[str, None]:
+    """
+    Yield content tokens from an OpenAI chat-completions event stream as they arrive
+    """
+    async for line in response.content:
+        line = line.decode('utf-8').strip()
+        if not line.startswith('data: '):
+            continue
+
+        json_str = line[6:]  # Remove "data: " prefix
+        if json_str.strip() == "[DONE]":
+            break
+
+        try:
+            chunk = json.loads(json_str)
+        except json.JSONDecodeError as e:
+            logger.error("Error parsing streaming response: %s", e)
+            continue
+
+        choice = chunk["choices"][0]
+        content = choice.get("delta", {}).get("content")
+        if content:
+            yield content
+        if choice.get("finish_reason") is not None:
+            break
+
+async def coalesce_tokens(
+    tokens: AsyncIterator[str],
+    flush_bytes: int = STREAM_FLUSH_BYTES,
+    flush_interval: float = STREAM_FLUSH_INTERVAL_MS / 1000
+) -> AsyncGenerator[str, None]:
+    """
+    Merge small tokens into larger chunks.
+
+    A chunk is flushed once it reaches flush_bytes or has waited flush_interval
+    seconds, whichever comes first. The first token is flushed immediately so
+    coalescing never delays time-to-first-token.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for token in tokens:
+                await queue.put(token)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(_Failure(e))
+
+    task = asyncio.create_task(pump())
+    buffer = []
+    size = 0
+    deadline = 0.0
+    first = True
+
+    try:
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield "".join(buffer)
+                buffer, size = [], 0
+                continue
+
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+
+            if first:
+                first = False
+                yield item
+                continue
+
+            if not buffer:
+                deadline = loop.time() + flush_interval
+            buffer.append(item)
+            size += len(item.encode('utf-8'))
+            if size >= flush_bytes:
+                yield "".join(buffer)
+                buffer, size = [], 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if not task.done():
+            task.cancel()
+
+async def stream_frames(
+    tokens: AsyncIterator[str],
+    metadata: Optional[Dict] = None
+) -> AsyncGenerator[Dict, None]:
+    """
+    Encode a token stream as v1 protocol frames.
+
+    The start frame is sent with the first delta, by which point the client
+    has filled in the metadata (e.g. the RAG context).
+    """
+    digest = hashlib.sha256()
+    length = 0
+    seq = 0
+    started = False
+
+    def start_frame():
+        return {"type": "start", "v": STREAM_PROTOCOL_VERSION, "metadata": metadata or {}}
+
+    chunks = coalesce_tokens(tokens)
+    try:
+        async for chunk in chunks:
+            if not started:
+                started = True
+                yield start_frame()
+
+            encoded = chunk.encode('utf-8')
+            digest.update(encoded)
+            length += len(encoded)
+            yield {"type": "delta", "seq": seq, "content": chunk}
+            seq += 1
+
+        if not started:
+            yield start_frame()
+        yield {"type": "end", "frames": seq, "length": length, "sha256": digest.hexdigest()}
+    except Exception as e:
+        logger.error("Streaming error: %s", e)
+        yield {"type": "error", "content": str(e)}
+    finally:
+        # Stops the upstream request if the client went away mid-stream
+        await chunks.aclose()
+
+def encode_frame(frame: Dict) -> str:
+    """Serialize a protocol frame as compact JSON"""
+    return json.dumps(frame, separators=(",", ":"))
+
+def sse_event(data: dict) -> str:
+    """Format a dict as a Server-Sent Events message"""
+    return f"data: {encode_frame(data)}\n\n"
+
+async def encode_frames(
+    frames: AsyncGenerator[Dict, None],
+    encode: Callable[[Dict], str] = encode_frame
+) -> AsyncGenerator[str, None]:
+    """
+    Serialize a stream's frames. The frame_serialization stage is observed
+    once per stream, with the total, rather than once per frame.
+    """
+    seconds = 0.0
+    try:
+        async for frame in frames:
+            started = time.perf_counter()
+            text = encode(frame)
+            seconds += time.perf_counter() - started
+            yield text
+    finally:
+        await frames.aclose()
+        observe_stage("frame_serialization", seconds)
@@ -1,37 +1,87 @@
+from __future__ import annotations
+
 import os
-import stripe
-from typing import Dict, Optional, List
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, List
 from dotenv import load_dotenv
 import logging
 
+from .executor import run_blocking, STRIPE_TIMEOUT
+from .metrics import timed_call
+
 load_dotenv()
 
+if TYPE_CHECKING:
+    import stripe
+
 logger = logging.getLogger(__name__)
 
-# Initialize Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")  # Override for stripe-mock or the load-test stand-in
 
 class StripeClient:
     def __init__(self):
-        if not stripe.api_key:
+        if not STRIPE_SECRET_KEY:
             raise ValueError("STRIPE_SECRET_KEY environment variable is not set")
-        
+
+        # The SDK is imported here rather than at module level so that
+        # importing this module (e.g. for SUBSCRIPTION_PLANS) stays cheap
+        import stripe
+        stripe.api_key = STRIPE_SECRET_KEY
+        if STRIPE_API_BASE:
+            stripe.api_base = STRIPE_API_BASE
+        self.stripe = stripe
         self.webhook_secret = STRIPE_WEBHOOK_SECRET
         logger.info("Stripe client initialized")
 
-    async def create_customer(self, email: str, name: Optional[str] = None) -> stripe.Customer:
-        """Create a new Stripe customer"""
+    async def create_customer(
+        self,
+        email: str,
+        name: Optional[str] = None,
+        user_id: Optional[str] = None,
+        idempotency_key: Optional[str] = None
+    ) -> stripe.Customer:
+        """
+        Create a new Stripe customer. Repeating a call with the same
+        idempotency key (within Stripe's 24 hours) returns the same customer.
+        """
+        metadata = {"source": "studybyte"}
+        if user_id:
+            metadata["user_id"] = user_id
         try:
-            customer = stripe.Customer.create(
-                email=email,
-                name=name,
-                metadata={"source": "studybyte"}
-            )
-            logger.info(f"Created Stripe customer: {customer.id}")
+            with timed_call("stripe", "customers.create"):
+                customer = await run_blocking(
+                    self.stripe.Customer.create,
+                    timeout=STRIPE_TIMEOUT,
+                    idempotency_key=idempotency_key,
+                    email=email,
+                    name=name,
+                    metadata=metadata
+                )
+            logger.info("Created Stripe customer: %s", customer.id)
             return customer
         except Exception as e:
-            logger.error(f"Error creating Stripe customer: {str(e)}")
+            logger.error("Error creating Stripe customer: %s", e)
+            raise
+
+    async def find_customer(self, user_id: str) -> Optional[stripe.Customer]:
+        """
+        The customer created for a user, found by metadata.user_id. Search
+        results can lag writes by up to a minute.
+        """
+        query = "metadata['user_id']:'{}'".format(user_id.replace("'", "\\'"))
+        try:
+            with timed_call("stripe", "customers.search"):
+                result = await run_blocking(
+                    self.stripe.Customer.search,
+                    timeout=STRIPE_TIMEOUT,
+                    query=query,
+                    limit=1
+                )
+            return result.data[0] if result.data else None
+        except Exception as e:
+            logger.error("Error searching Stripe customers for user %s: %s", user_id, e)
             raise
 
     async def create_checkout_session(
@@ -44,27 +94,30 @@ class StripeClient:
     ) -> stripe.checkout.Session:
         """Create a Stripe Checkout session"""
         try:
-            session = stripe.checkout.Session.create(
-                customer=customer_id,
-                payment_method_types=['card'],
-                line_items=[{
-                    'price': price_id,
-                    'quantity': 1,
-                }],
-                mode='subscription',
-                success_url=success_url,
-                cancel_url=cancel_url,
-                metadata={
-                    "user_id": user_id,
-                    "source": "studybyte"
-                },
-                allow_promotion_codes=True,
-                billing_address_collection='required',
-            )
-            logger.info(f"Created checkout session: {session.id}")
+            with timed_call("stripe", "checkout.sessions.create"):
+                session = await run_blocking(
+                    self.stripe.checkout.Session.create,
+                    timeout=STRIPE_TIMEOUT,
+                    customer=customer_id,
+                    payment_method_types=['card'],
+                    line_items=[{
+                        'price': price_id,
+                        'quantity': 1,
+                    }],
+                    mode='subscription',
+                    success_url=success_url,
+                    cancel_url=cancel_url,
+                    metadata={
+                        "user_id": user_id,
+                        "source": "studybyte"
+                    },
+                    allow_promotion_codes=True,
+                    billing_address_collection='required',
+                )
+            logger.info("Created checkout session: %s", session.id)
             return session
         except Exception as e:
-            logger.error(f"Error creating checkout session: {str(e)}")
+            logger.error("Error creating checkout session: %s", e)
             raise
 
     async def create_billing_portal_session(
@@ -74,56 +127,114 @@ class StripeClient:
     ) -> stripe.billing_portal.Session:
         """Create a customer portal session for subscription management"""
         try:
-            session = stripe.billing_portal.Session.create(
-                customer=customer_id,
-                return_url=return_url,
-            )
-            logger.info(f"Created billing portal session: {session.id}")
+            with timed_call("stripe", "billing_portal.sessions.create"):
+                session = await run_blocking(
+                    self.stripe.billing_portal.Session.create,
+                    timeout=STRIPE_TIMEOUT,
+                    customer=customer_id,
+                    return_url=return_url,
+                )
+            logger.info("Created billing portal session: %s", session.id)
             return session
         except Exception as e:
-            logger.error(f"Error creating billing portal session: {str(e)}")
+            logger.error("Error creating billing portal session: %s", e)
             raise
 
     def get_customer_subscriptions(self, customer_id: str) -> List[stripe.Subscription]:
-        """Get all subscriptions for a customer"""
+        """Get all subscriptions for a customer (blocks; use get_customer_subscriptions_async in the app)"""
         try:
-            subscriptions = stripe.Subscription.list(customer=customer_id)
+            with timed_call("stripe", "subscriptions.list"):
+                subscriptions = self.stripe.Subscription.list(customer=customer_id)
             return subscriptions.data
         except Exception as e:
-            logger.error(f"Error fetching subscriptions: {str(e)}")
+            logger.error("Error fetching subscriptions: %s", e)
+            raise
+
+    async def get_customer_subscriptions_async(self, customer_id: str) -> List[stripe.Subscription]:
+        """Get all subscriptions for a customer without blocking the event loop"""
+        try:
+            with timed_call("stripe", "subscriptions.list"):
+                subscriptions = await run_blocking(
+                    self.stripe.Subscription.list,
+                    timeout=STRIPE_TIMEOUT,
+                    customer=customer_id
+                )
+            return subscriptions.data
+        except Exception as e:
+            logger.error("Error fetching subscriptions: %s", e)
+            raise
+
+    async def get_price_id(self, lookup_key: str) -> Optional[str]:
+        """Resolve a price lookup key to the ID of the active price it points at"""
+        try:
+            with timed_call("stripe", "prices.list"):
+                prices = await run_blocking(
+                    self.stripe.Price.list,
+                    timeout=STRIPE_TIMEOUT,
+                    lookup_keys=[lookup_key],
+                    active=True,
+                    limit=1
+                )
+            return prices.data[0].id if prices.data else None
+        except Exception as e:
+            logger.error("Error looking up price %s: %s", lookup_key, e)
             raise
 
     def verify_webhook_signature(self, payload: bytes, signature: str) -> stripe.Event:
         """Verify webhook signature and return event"""
         try:
-            event = stripe.Webhook.construct_event(
+            event = self.stripe.Webhook.construct_event(
                 payload, signature, self.webhook_secret
             )
             return event
         except ValueError as e:
-            logger.error(f"Invalid payload: {str(e)}")
+            logger.error("Invalid payload: %s", e)
             raise
-        except stripe.error.SignatureVerificationError as e:
-            logger.error(f"Invalid signature: {str(e)}")
+        except self.stripe.error.SignatureVerificationError as e:
+            logger.error("Invalid signature: %s", e)
             raise
 
     def get_subscription_status(self, subscription_id: str) -> str:
-        """Get subscription status"""
+        """Get subscription status (blocks; use get_subscription_status_async in the app)"""
         try:
-            subscription = stripe.Subscription.retrieve(subscription_id)
+            with timed_call("stripe", "subscriptions.retrieve"):
+                subscription = self.stripe.Subscription.retrieve(subscription_id)
             return subscription.status
         except Exception as e:
-            logger.error(f"Error fetching subscription status: {str(e)}")
+            logger.error("Error fetching subscription status: %s", e)
             raise
 
-# Global instance
-stripe_client = StripeClient()
+    async def get_subscription_status_async(self, subscription_id: str) -> str:
+        """Get subscription status without blocking the event loop"""
+        try:
+            with timed_call("stripe", "subscriptions.retrieve"):
+                subscription = await run_blocking(
+                    self.stripe.Subscription.retrieve,
+                    subscription_id,
+                    timeout=STRIPE_TIMEOUT
+                )
+            return subscription.status
+        except Exception as e:
+            logger.error("Error fetching subscription status: %s", e)
+            raise
+
+_stripe_client: Optional[StripeClient] = None
+_stripe_client_lock = threading.Lock()
+
+def get_stripe_client() -> StripeClient:
+    """Return the shared Stripe client, creating it on first use"""
+    global _stripe_client
+    if _stripe_client is None:
+        with _stripe_client_lock:
+            if _stripe_client is None:
+                _stripe_client = StripeClient()
+    return _stripe_client
 
 # Subscription plans configuration
 SUBSCRIPTION_PLANS = {
     "premium": {
         "name": "StudyByte Premium",
-        "price_id": os.getenv("STRIPE_PREMIUM_PRICE_ID"),
+        "price_id": os.getenv("STRIPE_PREMIUM_PRICE_ID"),  # A price ID, or a price lookup key
         "features": [
             "Unlimited AI chat sessions",
             "Advanced UKCAT question analysis",
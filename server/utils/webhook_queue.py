@@ -0,0 +1,333 @@
+import os
+import random
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+import logging
+
+from .auth import update_subscription_status
+from .cache import TTLCache
+from .metrics import timed
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Webhook queue configuration
+# Background work doesn't outlive the response on Vercel, so events are
+# processed before acknowledging there
+WEBHOOK_QUEUE_ENABLED = os.getenv("WEBHOOK_QUEUE_ENABLED", "false" if os.getenv("VERCEL") else "true").lower() == "true"
+WEBHOOK_REDIS_URL = os.getenv("WEBHOOK_REDIS_URL")  # Share event deduplication between workers
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", "259200"))  # Stripe retries deliveries for up to 3 days
+WEBHOOK_DEDUPE_SIZE = int(os.getenv("WEBHOOK_DEDUPE_SIZE", "100000"))
+WEBHOOK_COALESCE_MS = int(os.getenv("WEBHOOK_COALESCE_MS", "250"))  # Wait for more events for the same customer
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "1"))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.getenv("WEBHOOK_RETRY_MAX_SECONDS", "60"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))  # Seconds to flush pending writes on shutdown
+
+@dataclass
+class ProfileWrite:
+    """The subscription state one or more events leave a user's profile in"""
+    key: str  # Stripe customer, or the user if there is none
+    user_id: str
+    subscription_status: str
+    stripe_customer_id: Optional[str]
+    created: int  # Of the newest event folded in
+    event_ids: List[str] = field(default_factory=list)
+    attempts: int = 0
+
+def plan_write(event) -> Optional[ProfileWrite]:
+    """The profile write a Stripe event calls for, None if it only needs logging"""
+    obj = event.data.object
+    if event.type in ("customer.subscription.created", "customer.subscription.updated", "customer.subscription.deleted"):
+        user_id = (obj.get("metadata") or {}).get("user_id")
+        if not user_id:
+            return None
+        customer_id = obj.get("customer")
+        if event.type == "customer.subscription.deleted":
+            status, customer_id = "free", None
+        else:
+            status = "active" if obj.get("status") == "active" else "inactive"
+        return ProfileWrite(
+            key=obj.get("customer") or f"user:{user_id}",
+            user_id=user_id,
+            subscription_status=status,
+            stripe_customer_id=customer_id,
+            created=event.created,
+            event_ids=[event.id],
+        )
+
+    if event.type == "invoice.payment_succeeded" and obj.get("subscription"):
+        logger.info("Payment succeeded for subscription %s", obj.get("subscription"))
+    elif event.type == "invoice.payment_failed" and obj.get("subscription"):
+        logger.warning("Payment failed for subscription %s", obj.get("subscription"))
+    return None
+
+class InMemoryEventDedupe:
+    """Event IDs seen by this worker process"""
+
+    def __init__(self):
+        self.seen = TTLCache(maxsize=WEBHOOK_DEDUPE_SIZE, ttl=WEBHOOK_DEDUPE_TTL)
+
+    async def first_seen(self, event_id: str) -> bool:
+        if self.seen.get(event_id) is not None:
+            return False
+        self.seen.set(event_id, True)
+        return True
+
+    async def forget(self, event_id: str):
+        self.seen.delete(event_id)
+
+class RedisEventDedupe:
+    """
+    Event IDs seen by any worker, as Redis keys set with NX. If Redis is
+    unreachable events are processed anyway: the profile writes are
+    idempotent, so a duplicate costs a write, not correctness.
+    """
+
+    def __init__(self, url: str, prefix: str = "webhook"):
+        import redis.asyncio as redis  # Optional dependency, only needed when a shared backend is configured
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+
+    async def first_seen(self, event_id: str) -> bool:
+        try:
+            return bool(await self.client.set(f"{self.prefix}:{event_id}", 1, nx=True, ex=WEBHOOK_DEDUPE_TTL))
+        except Exception as e:
+            logger.warning("Redis webhook dedupe failed, processing event: %s", e)
+            return True
+
+    async def forget(self, event_id: str):
+        try:
+            await self.client.delete(f"{self.prefix}:{event_id}")
+        except Exception as e:
+            logger.warning("Redis webhook dedupe delete failed: %s", e)
+
+class WebhookQueue:
+    """
+    Takes verified Stripe events off the request path.
+
+    Events are deduplicated by ID when they arrive, so redeliveries are
+    acknowledged without doing anything. Profile writes are keyed by
+    customer and wait WEBHOOK_COALESCE_MS before running, so a burst of
+    events for one customer (created, updated, invoice...) ends in a single
+    write of the newest state. A background worker pool applies the writes,
+    one at a time per customer, retrying failures with jittered exponential
+    backoff up to WEBHOOK_MAX_ATTEMPTS. When the queue is disabled (on
+    Vercel) writes run before the webhook is acknowledged, and a failure is
+    returned to Stripe so that Stripe retries instead.
+
+    While the last write failed, the queue is unhealthy: new events are
+    written before acknowledging, as if it were disabled, so that Stripe
+    keeps retrying them until the database recovers. A write that exhausts
+    its attempts has its events removed from the dedupe set, so that a
+    redelivery or a resend from the Stripe dashboard is applied.
+    """
+
+    def __init__(self, dedupe=None, enabled: bool = WEBHOOK_QUEUE_ENABLED):
+        self.enabled = enabled
+        self.dedupe = dedupe or InMemoryEventDedupe()
+        self._pending: Dict[str, ProfileWrite] = {}
+        self._active: Dict[str, ProfileWrite] = {}  # Writes in progress, by key
+        self._ready: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self.healthy = True
+        self.received = 0
+        self.duplicates = 0
+        self.coalesced = 0
+        self.written = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def start(self):
+        if not self.enabled or self._workers:
+            return
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(WEBHOOK_WORKERS)]
+
+    async def stop(self):
+        """
+        Flush pending writes, waiting at most WEBHOOK_DRAIN_TIMEOUT. Writes
+        whose retry falls due after the workers are gone get one last try
+        inline; anything left is logged with its event IDs to resend.
+        """
+        if not self._workers:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WEBHOOK_DRAIN_TIMEOUT
+        for key, timer in list(self._timers.items()):
+            timer.cancel()
+            self._ready.put_nowait(key)
+        self._timers.clear()
+        try:
+            await asyncio.wait_for(self._ready.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Shut down with %s webhook writes pending", len(self._pending) + len(self._active))
+        interrupted = list(self._active.values())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        # Retries armed during the drain would fire into a queue nobody reads
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for write in interrupted:
+            await self._give_up(write, "interrupted by shutdown")
+        while self._pending:
+            _, write = self._pending.popitem()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                await self._give_up(write, "not applied before shutdown")
+                continue
+            try:
+                await asyncio.wait_for(self._apply(write), remaining)
+            except Exception as e:
+                await self._give_up(write, e)
+
+    async def submit(self, event) -> bool:
+        """Accept a verified event; False if it was already seen"""
+        self.received += 1
+        if not await self.dedupe.first_seen(event.id):
+            self.duplicates += 1
+            logger.info("Ignoring duplicate webhook event %s", event.id)
+            return False
+
+        write = plan_write(event)
+        if write is None:
+            return True
+
+        if not self.enabled or not self._workers or not self.healthy:
+            write = self._take_pending(write)
+            try:
+                await self._apply(write)
+            except Exception:
+                await self._forget(write)  # Let Stripe's retry through
+                raise
+            return True
+
+        self._schedule(write, WEBHOOK_COALESCE_MS / 1000)
+        return True
+
+    def _merge(self, pending: ProfileWrite, write: ProfileWrite) -> ProfileWrite:
+        self.coalesced += 1
+        newest = write if write.created >= pending.created else pending
+        newest.event_ids = pending.event_ids + write.event_ids
+        newest.attempts = max(write.attempts, pending.attempts)
+        return newest
+
+    def _take_pending(self, write: ProfileWrite) -> ProfileWrite:
+        """Fold a write still waiting for the same customer into one about to run inline"""
+        timer = self._timers.pop(write.key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(write.key, None)
+        return write if pending is None else self._merge(pending, write)
+
+    def _schedule(self, write: ProfileWrite, delay: float):
+        """Queue a write after delay, merging it with one already pending for the customer"""
+        pending = self._pending.get(write.key)
+        if pending is not None:
+            self._pending[write.key] = self._merge(pending, write)
+            return
+
+        self._pending[write.key] = write
+        self._timers[write.key] = asyncio.get_running_loop().call_later(delay, self._release, write.key)
+
+    def _release(self, key: str):
+        self._timers.pop(key, None)
+        self._ready.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            try:
+                if key in self._active:
+                    # An older write for this customer is still running; go after it
+                    self._timers[key] = asyncio.get_running_loop().call_later(WEBHOOK_COALESCE_MS / 1000, self._release, key)
+                    continue
+                write = self._pending.pop(key, None)
+                if write is None:
+                    continue
+
+                self._active[key] = write
+                try:
+                    await self._apply(write)
+                except Exception as e:
+                    await self._retry(write, e)
+                finally:
+                    self._active.pop(key, None)
+            finally:
+                self._ready.task_done()
+
+    async def _apply(self, write: ProfileWrite):
+        try:
+            with timed(stage="webhook_write"):
+                await update_subscription_status(
+                    write.user_id, write.subscription_status, write.stripe_customer_id, raise_errors=True
+                )
+        except Exception:
+            self.healthy = False
+            raise
+        self.healthy = True
+        self.written += 1
+        logger.info(
+            "Updated subscription status for user %s: %s (%s events)",
+            write.user_id, write.subscription_status, len(write.event_ids)
+        )
+
+    async def _forget(self, write: ProfileWrite):
+        for event_id in write.event_ids:
+            await self.dedupe.forget(event_id)
+
+    async def _give_up(self, write: ProfileWrite, error):
+        self.failed += 1
+        await self._forget(write)
+        logger.error(
+            "Giving up on subscription update for user %s after %s attempts; resend events %s from Stripe to apply them: %s",
+            write.user_id, write.attempts, ", ".join(write.event_ids), error
+        )
+
+    async def _retry(self, write: ProfileWrite, error: Exception):
+        write.attempts += 1
+        if write.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            await self._give_up(write, error)
+            return
+        self.retries += 1
+        delay = min(WEBHOOK_RETRY_MAX_SECONDS, WEBHOOK_RETRY_BASE_SECONDS * 2 ** (write.attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        logger.warning(
+            "Subscription update for user %s failed (attempt %s), retrying in %.1fs: %s",
+            write.user_id, write.attempts, delay, error
+        )
+        self._schedule(write, delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "healthy": self.healthy,
+            "pending": len(self._pending),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+def _create_dedupe():
+    if WEBHOOK_REDIS_URL:
+        try:
+            return RedisEventDedupe(WEBHOOK_REDIS_URL)
+        except Exception as e:
+            logger.error("Could not connect webhook dedupe to Redis, deduplicating in memory: %s", e)
+    return InMemoryEventDedupe()
+
+# Global instance
+webhook_queue = WebhookQueue(_create_dedupe())